@@ -0,0 +1,300 @@
+"""
+Benchmark harness for regex.py.
+
+Generates reproducible synthetic directory trees, runs each of the three
+operation modes ('match', 'invert', 'replace') over them headless, and
+prints one JSON document with throughput, latency to the first result,
+peak memory and the time spent per stage (walk, read, decode, match,
+write; see RunProgress in regex.py). Run it before and after a change to
+try_open_text_file, regex_replace_and_store, iter_file_paths and the like,
+and compare the two outputs.
+
+    python benchmark.py --output before.json
+    python benchmark.py --scenario many-small --mode match --repeat 5
+
+Every measured run happens in a fresh interpreter, so caches (encodings,
+compiled patterns, the operating system's view of the pool) do not leak
+between runs and peak memory is that run's own. The result cache is never
+used. 'invert' and 'replace' rewrite files, so each run gets its own copy
+of the generated tree.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Scenario name -> what to generate; sizes are multiplied by --scale
+SCENARIOS = {
+    'many-small': "4,000 UTF-8 files of about 4 KB in nested directories",
+    'few-huge': "2 UTF-8 files of about 32 MB each, streamed in 'invert' and 'replace' (see STREAM_THRESHOLD)",
+    'mixed-encodings': "1,200 files of about 8 KB in UTF-8, UTF-8 with BOM, UTF-16, cp1252 and ISO-8859-1",
+    'binary-noise': "600 text files of about 8 KB next to 300 binary files and text files with binary noise",
+}
+# Mode -> (pattern, replacement); 'id=[0-9]+' stays byte-level searchable
+MODES = {
+    'match': (r'id=[0-9]+', None),
+    'invert': (r'ERROR[^\n]*\n', ''),
+    'replace': (r'id=([0-9]+)', r'ident=\1'),
+}
+# Files larger than this are streamed (process_file's stream_threshold). Well
+# below regex.py's default, so few-huge exercises the streaming path even
+# with a small --scale, and well above every file of the other scenarios.
+# 'match' searches the bytes (mmap) whatever the size, so it never streams
+STREAM_THRESHOLD = 1024 * 1024
+# Keys of a run's measurements that get a median over the repeats
+MEASUREMENTS = ('elapsed', 'first_result', 'files_per_sec', 'mb_per_sec',
+                'peak_rss_kb', 'peak_rss_children_kb')
+
+LEVELS = ('DEBUG', 'INFO', 'INFO', 'INFO', 'WARNING', 'ERROR')
+WORDS = ('request', 'served', 'cache', 'miss', 'user', 'session', 'timeout',
+         'retry', 'queue', 'flushed', 'worker', 'started', 'stopped', 'payload')
+# Words outside ASCII, so decoding is exercised; each fits the encodings it is used with
+ACCENTED_WORDS = ('café', 'naïve', 'façade', 'Zürich', 'señor', 'crème')
+EURO_WORDS = ('€uro', 'price€')
+
+
+def make_lines(rng, count, extra_words=()):
+    """Return `count` log-like lines of text (each ending in '\\n')."""
+    words = WORDS + tuple(extra_words)
+    lines = []
+    for _ in range(count):
+        message = ' '.join(rng.choice(words) for _ in range(rng.randint(3, 9)))
+        lines.append(f"2024-05-{rng.randint(1, 28):02d} {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}"
+                     f" {rng.choice(LEVELS)} id={rng.randint(1, 99999)} {message}\n")
+    return lines
+
+def make_text(rng, size, extra_words=()):
+    """Return about `size` characters of log-like text."""
+    lines = []
+    length = 0
+    while length < size:
+        line = make_lines(rng, 1, extra_words)[0]
+        lines.append(line)
+        length += len(line)
+    return ''.join(lines)
+
+def write_text(path, text, encoding):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding=encoding, newline='') as f:
+        f.write(text)
+
+def write_bytes(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def nested_path(root, index, extension='.log', per_directory=100):
+    """Spread generated files over two levels of directories."""
+    return os.path.join(root, f"d{index // (per_directory * 10)}", f"s{index // per_directory}",
+                        f"file{index}{extension}")
+
+def generate_tree(scenario, root, seed=0, scale=1.0):
+    """Write the synthetic tree for a scenario (see SCENARIOS) below root."""
+    rng = random.Random(f"{scenario}:{seed}")
+
+    def count(n):
+        return max(1, int(n * scale))
+
+    if scenario == 'many-small':
+        for index in range(count(4000)):
+            write_text(nested_path(root, index), make_text(rng, 4096), 'utf-8')
+    elif scenario == 'few-huge':
+        # Repeating a 1 MB block keeps generation fast; the regex work is the same
+        block = make_text(rng, 1024 * 1024)
+        for index in range(2):
+            path = os.path.join(root, f"huge{index}.log")
+            os.makedirs(root, exist_ok=True)
+            with open(path, 'w', encoding='utf-8', newline='') as f:
+                for _ in range(count(32)):
+                    f.write(block)
+    elif scenario == 'mixed-encodings':
+        encodings = (
+            ('utf-8', ACCENTED_WORDS + EURO_WORDS),
+            ('utf-8-sig', ACCENTED_WORDS + EURO_WORDS),
+            ('utf-16', ACCENTED_WORDS + EURO_WORDS),
+            ('cp1252', ACCENTED_WORDS + EURO_WORDS),
+            ('iso-8859-1', ACCENTED_WORDS),
+        )
+        for index in range(count(1200)):
+            encoding, extra_words = encodings[index % len(encodings)]
+            write_text(nested_path(root, index, '.txt'), make_text(rng, 8192, extra_words), encoding)
+    elif scenario == 'binary-noise':
+        for index in range(count(600)):
+            text = make_text(rng, 8192)
+            if index % 4 == 0:
+                # Text with a burst of non-NUL noise in it, still read as text
+                noise = rng.randbytes(256).replace(b'\0', b'\1')
+                middle = len(text) // 2
+                write_bytes(nested_path(root, index),
+                            text[:middle].encode('utf-8') + noise + text[middle:].encode('utf-8'))
+            else:
+                write_text(nested_path(root, index), text, 'utf-8')
+        for index in range(count(300)):
+            write_bytes(nested_path(root, index, '.bin'), rng.randbytes(16384))
+    else:
+        raise ValueError(f"unknown scenario {scenario!r}")
+
+def tree_size(root):
+    """Return (file_count, total_bytes) of a directory tree."""
+    files = 0
+    total = 0
+    for directory, _, names in os.walk(root):
+        for name in names:
+            files += 1
+            total += os.path.getsize(os.path.join(directory, name))
+    return files, total
+
+def peak_rss_kb(who):
+    """Peak resident set size in KB of this process or of its waited-for children (None if unknown)."""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+
+def run_once(root, mode, workers):
+    """
+    Process the tree at root in one mode, the way the command line does, and
+    return the measurements. This is what each fresh interpreter runs.
+    """
+    # This script sits next to regex.py, so this is the tool, not the regex package
+    import regex as regex_tool
+
+    pattern, replacement = MODES[mode]
+    progress = regex_tool.RunProgress()
+    sizes = {}
+    file_paths = regex_tool.iter_prefetched(progress.track_paths(regex_tool.iter_file_paths(
+        root,
+        skip_binary=True,
+        sizes=sizes,
+    ), sizes))
+    results = regex_tool.iter_file_results(
+        file_paths, pattern, mode, replacement,
+        workers=workers,
+        cache_path=None,
+        stream_threshold=STREAM_THRESHOLD,
+        with_spans=mode == 'match',
+    )
+    for result in results:
+        progress.add_result(result)
+    progress.finish()
+    report = progress.snapshot()
+    report['peak_rss_kb'] = peak_rss_kb('self')
+    report['peak_rss_children_kb'] = peak_rss_kb('children')
+    return report
+
+def measure(root, mode, workers):
+    """Run run_once in a fresh interpreter and return its measurements."""
+    completed = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--run-once', root, '--mode', mode,
+         '--workers', str(workers)],
+        stdout=subprocess.PIPE, check=True
+    )
+    return json.loads(completed.stdout)
+
+def median_of(runs, key):
+    values = [run[key] for run in runs if run.get(key) is not None]
+    return statistics.median(values) if values else None
+
+def run_benchmarks(scenarios, modes, workers, repeat, seed, scale, keep_dir=None):
+    """Generate each scenario once and measure every mode `repeat` times on fresh copies."""
+    base = keep_dir or tempfile.mkdtemp(prefix='regex-benchmark-')
+    results = []
+    try:
+        for scenario in scenarios:
+            template = os.path.join(base, scenario)
+            if not os.path.isdir(template):
+                started = time.perf_counter()
+                generate_tree(scenario, template, seed, scale)
+                print(f"Generated {scenario} in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+            files, total_bytes = tree_size(template)
+            for mode in modes:
+                runs = []
+                for attempt in range(repeat):
+                    work = os.path.join(base, f"{scenario}.run")
+                    shutil.rmtree(work, ignore_errors=True)
+                    shutil.copytree(template, work)
+                    try:
+                        runs.append(measure(work, mode, workers))
+                    finally:
+                        shutil.rmtree(work, ignore_errors=True)
+                    print(f"{scenario} {mode} #{attempt + 1}: {runs[-1]['elapsed']:.2f}s", file=sys.stderr)
+                results.append({
+                    'scenario': scenario,
+                    'mode': mode,
+                    'files': files,
+                    'bytes': total_bytes,
+                    'median': {key: median_of(runs, key) for key in MEASUREMENTS},
+                    'stages': {stage: median_of([run['stages'] for run in runs], stage)
+                               for stage in runs[0]['stages']},
+                    'runs': runs,
+                })
+    finally:
+        if keep_dir is None:
+            shutil.rmtree(base, ignore_errors=True)
+    return results
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(
+        description="Benchmark regex.py on synthetic trees and print the results as JSON."
+    )
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help="scenario to run (repeatable; default: all)")
+    parser.add_argument('--mode', action='append', choices=sorted(MODES),
+                        help="operation mode to run (repeatable; default: all)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="worker processes, as for regex.py (default: CPU count)")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per scenario and mode (default: 3)")
+    parser.add_argument('--seed', type=int, default=0, help="seed for the generated trees (default: 0)")
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help="multiply the number (or, for few-huge, size) of files by this")
+    parser.add_argument('--keep', metavar='DIR',
+                        help="generate the trees in DIR and keep them for later runs with the same options")
+    parser.add_argument('--output', metavar='FILE', help="write the JSON here instead of stdout")
+    parser.add_argument('--run-once', metavar='DIR', help=argparse.SUPPRESS)
+    return parser
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    if args.run_once:
+        json.dump(run_once(args.run_once, args.mode[0], max(1, args.workers)), sys.stdout)
+        return 0
+
+    scenarios = args.scenario or list(SCENARIOS)
+    modes = args.mode or list(MODES)
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'options': {
+            'workers': max(1, args.workers),
+            'repeat': max(1, args.repeat),
+            'seed': args.seed,
+            'scale': args.scale,
+        },
+        'patterns': {mode: MODES[mode] for mode in modes},
+        'results': run_benchmarks(scenarios, modes, max(1, args.workers), max(1, args.repeat),
+                                  args.seed, args.scale, args.keep),
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
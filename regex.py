@@ -1,535 +1,5446 @@
-import os
-import re
-import tkinter as tk
-from tkinter import filedialog, messagebox
-# https://chatgpt.com/share/677c1371-29e0-8010-9ea3-ffea5e57840f
-# manual changes:
-# lines 158-159:
-#            else:
-#                output_widget.insert(tk.END, f"No change needed: {filepath}\n")
-
-
-ENCODINGS_TO_TRY = [
-    'utf-8',
-    'utf-16',
-    'cp1252',
-    'iso-8859-1'
-]
-
-def try_open_text_file(filepath):
-    """
-    Attempt to open and read the file using multiple encodings.
-    Returns (content, encoding) if successful, or (None, None) if not.
-    """
-    for enc in ENCODINGS_TO_TRY:
-        try:
-            with open(filepath, 'r', encoding=enc) as f:
-                return f.read(), enc
-        except UnicodeDecodeError:
-            pass
-        except FileNotFoundError:
-            return None, None
-        except PermissionError:
-            return None, None
-        except Exception as e:
-            print(f"Unexpected error while reading '{filepath}' with encoding '{enc}': {e}")
-            return None, None
-    return None, None
-
-def regex_replace_and_store(content, compiled_pattern, mode, replace_pattern=None):
-    """
-    Depending on the selected mode:
-    
-    1. 'match':
-       - Detect all matches. No modifications.
-       - Returns (None, list_of_matches).
-
-    2. 'invert':
-       - Treat all non-matching text as if it matched,
-         and keep the actual matches unchanged.
-       - If replace_pattern is provided, replace the non-matching segments with it,
-         otherwise remove them.
-       - Returns (updated_content, None).
-
-    3. 'replace':
-       - Standard search-and-replace for the matched text.
-       - Returns (updated_content, None).
-    """
-    try:
-        if mode == 'match':
-            all_matches = compiled_pattern.findall(content)
-            return None, all_matches
-
-        elif mode == 'invert':
-            parts = compiled_pattern.split(content)
-            updated_segments = []
-            for i, segment in enumerate(parts):
-                if i % 2 == 1:  # matched text
-                    updated_segments.append(segment)
-                else:           # non-matching text
-                    if replace_pattern is not None:
-                        updated_segments.append(replace_pattern)
-                    else:
-                        updated_segments.append('')
-            updated_content = ''.join(updated_segments)
-            return updated_content, None
-
-        elif mode == 'replace':
-            updated_content = compiled_pattern.sub(
-                replace_pattern if replace_pattern else '',
-                content
-            )
-            return updated_content, None
-
-        else:
-            return None, None
-
-    except re.error as e:
-        print(f"Regex error: {e}")
-        return None, None
-
-def process_files(file_paths, match_pattern, mode, replace_pattern, output_widget):
-    """
-    Process each file in file_paths according to the chosen mode:
-      - 'match': Log matches, no modifications
-      - 'invert': Remove or replace non-matching parts
-      - 'replace': Replace matched text
-
-    Attempts multiple encodings. Skips files that cannot be read.
-    """
-    try:
-        compiled_pattern = re.compile(f'({match_pattern})')
-    except re.error as e:
-        output_widget.insert(tk.END, f"Invalid Regex: {e}\n")
-        output_widget.see(tk.END)
-        return
-
-    processed_count = 0
-    skipped_count = 0
-    matched_files = 0  # Only used in 'match' mode
-
-    for filepath in file_paths:
-        if not os.path.isfile(filepath):
-            continue
-
-        content, used_encoding = try_open_text_file(filepath)
-        if content is None:
-            skipped_count += 1
-            output_widget.insert(tk.END, f"Skipping (unreadable or missing permissions): {filepath}\n")
-            output_widget.see(tk.END)
-            continue
-
-        updated_content, matches = regex_replace_and_store(
-            content=content,
-            compiled_pattern=compiled_pattern,
-            mode=mode,
-            replace_pattern=replace_pattern
-        )
-
-        if mode != 'match' and updated_content is None and matches is None:
-            # Means a regex error or some unexpected error
-            skipped_count += 1
-            output_widget.insert(tk.END, f"Skipping (regex error): {filepath}\n")
-            output_widget.see(tk.END)
-            continue
-
-        if mode == 'match':
-            if matches is None:
-                skipped_count += 1
-                output_widget.insert(tk.END, f"Skipping (regex error): {filepath}\n")
-                output_widget.see(tk.END)
-                continue
-            if matches:
-                matched_files += 1
-                output_widget.insert(
-                    tk.END,
-                    f"[MATCH FOUND] {filepath} [Encoding: {used_encoding}] -> Matches: {matches}\n"
-                )
-        else:  # 'invert' or 'replace'
-            if updated_content is not None and updated_content != content:
-                try:
-                    with open(filepath, 'w', encoding=used_encoding) as out_file:
-                        out_file.write(updated_content)
-                    output_widget.insert(
-                        tk.END, f"Processed file: {filepath} [Encoding: {used_encoding}]\n"
-                    )
-                except PermissionError:
-                    output_widget.insert(
-                        tk.END, f"Skipping (no permission to write): {filepath}\n"
-                    )
-                except Exception as e:
-                    output_widget.insert(
-                        tk.END, f"Skipping (error writing to file {filepath}): {e}\n"
-                    )
-
-        processed_count += 1
-        output_widget.see(tk.END)
-
-    # Summaries
-    output_widget.insert(tk.END, "\n--- Summary ---\n")
-    output_widget.insert(tk.END, f"Processed files: {processed_count}\n")
-    output_widget.insert(tk.END, f"Skipped files:   {skipped_count}\n")
-    if mode == 'match':
-        output_widget.insert(tk.END, f"Files with matches: {matched_files}\n")
-    output_widget.insert(tk.END, "-----------------\n\n")
-    output_widget.see(tk.END)
-
-def process_multiline_string(text_input, match_pattern, mode, replace_pattern, output_widget):
-    """
-    Process a user-provided multiline string instead of files.
-    Logs results to the output widget.
-    """
-    try:
-        compiled_pattern = re.compile(f'({match_pattern})')
-    except re.error as e:
-        output_widget.insert(tk.END, f"Invalid Regex: {e}\n")
-        output_widget.see(tk.END)
-        return text_input
-
-    try:
-        updated_content, matches = regex_replace_and_store(
-            content=text_input,
-            compiled_pattern=compiled_pattern,
-            mode=mode,
-            replace_pattern=replace_pattern
-        )
-    except Exception as e:
-        output_widget.insert(tk.END, f"Error processing string with regex: {e}\n")
-        output_widget.see(tk.END)
-        return text_input
-
-    if updated_content is None and matches is None:
-        output_widget.insert(tk.END, "Skipping due to regex error.\n")
-        output_widget.see(tk.END)
-        return text_input
-
-    if mode == 'match':
-        if matches:
-            output_widget.insert(tk.END, f"Matches found: {matches}\n")
-        else:
-            output_widget.insert(tk.END, "No matches found.\n")
-        return text_input
-    else:
-        # 'invert' or 'replace'
-        if updated_content != text_input:
-            output_widget.insert(tk.END, "The text was modified.\n")
-            output_widget.insert(tk.END, "--- Updated Text Below ---\n")
-            output_widget.insert(tk.END, updated_content + "\n\n")
-        else:
-            output_widget.insert(tk.END, "No change needed.\n")
-        return updated_content
-
-def gather_file_paths(input_type, path, extension_filter=None):
-    """
-    Return a list of file paths for 'single' or 'directory'.
-    If extension_filter is provided (non-empty), only files matching that extension
-    will be included. Otherwise, all files are included.
-    """
-    # Normalize extension_filter for easier checking
-    if extension_filter:
-        # If the user typed "txt" instead of ".txt", add the leading dot
-        extension_filter = extension_filter.strip()
-        if not extension_filter.startswith('.'):
-            extension_filter = '.' + extension_filter
-        extension_filter = extension_filter.lower()
-
-    try:
-        if input_type == 'single':
-            # Single file input -> ignore extension filter here
-            return [path] if os.path.isfile(path) else []
-        else:
-            file_paths = []
-            for root, _, files in os.walk(path):
-                for filename in files:
-                    # If filter is specified, check extension
-                    if extension_filter:
-                        # Compare end of filename with extension filter
-                        if not filename.lower().endswith(extension_filter):
-                            continue
-                    file_paths.append(os.path.join(root, filename))
-            return file_paths
-    except Exception as e:
-        print(f"Error gathering file paths: {e}")
-        return []
-
-class RegexApp:
-    def __init__(self, root):
-        self.root = root
-        self.root.title("Regex Utility")
-
-        # 1) Frame: Input Source (directory vs. single file vs. multiline string)
-        input_src_frame = tk.Frame(root, padx=10, pady=5)
-        input_src_frame.pack(fill=tk.X)
-
-        tk.Label(input_src_frame, text="Input Source:").pack(side=tk.LEFT)
-        self.input_type_var = tk.StringVar(value='directory')
-
-        tk.Radiobutton(
-            input_src_frame, text="Directory", variable=self.input_type_var,
-            value='directory', command=self.update_ui_for_input_type
-        ).pack(side=tk.LEFT, padx=5)
-
-        tk.Radiobutton(
-            input_src_frame, text="Single File", variable=self.input_type_var,
-            value='single', command=self.update_ui_for_input_type
-        ).pack(side=tk.LEFT, padx=5)
-
-        tk.Radiobutton(
-            input_src_frame, text="Multiline String", variable=self.input_type_var,
-            value='string', command=self.update_ui_for_input_type
-        ).pack(side=tk.LEFT, padx=5)
-
-        # 2) Frame that will contain either path_frame or text_frame
-        self.input_details_frame = tk.Frame(root, padx=10, pady=5)
-        self.input_details_frame.pack(fill=tk.X)
-
-        # 2a) Path frame (for directory/single-file)
-        self.path_frame = tk.Frame(self.input_details_frame)
-        tk.Label(self.path_frame, text="Path:").pack(side=tk.LEFT)
-        self.path_var = tk.StringVar()
-        self.path_entry = tk.Entry(self.path_frame, textvariable=self.path_var, width=50)
-        self.path_entry.pack(side=tk.LEFT, padx=5)
-        self.browse_button = tk.Button(self.path_frame, text="Browse", command=self.on_browse)
-        self.browse_button.pack(side=tk.LEFT, padx=5)
-
-        # 2b) Extension filter frame (only applies to 'directory')
-        self.ext_filter_frame = tk.Frame(self.input_details_frame, pady=2)
-        tk.Label(self.ext_filter_frame, text="File Extension Filter (optional):").pack(side=tk.LEFT)
-        self.extension_var = tk.StringVar()
-        self.ext_entry = tk.Entry(self.ext_filter_frame, textvariable=self.extension_var, width=8)
-        self.ext_entry.pack(side=tk.LEFT, padx=5)
-
-        # 2c) Text frame (for multiline string)
-        self.text_frame = tk.Frame(self.input_details_frame)
-        tk.Label(self.text_frame, text="Enter/paste your text below:").pack(anchor='w')
-
-        # Set default (minimum) height to 1
-        self.text_widget = tk.Text(self.text_frame, height=1, wrap=tk.WORD)
-        self.text_widget.pack(fill=tk.X, expand=True)
-        self.text_widget.bind("<KeyRelease>", self.auto_resize_text)
-
-        # 3) Frame: Regex pattern
-        regex_frame = tk.Frame(root, padx=10, pady=5)
-        regex_frame.pack(fill=tk.X)
-        tk.Label(regex_frame, text="Regex pattern:").pack(side=tk.LEFT)
-        self.regex_var = tk.StringVar()
-        self.regex_entry = tk.Entry(regex_frame, textvariable=self.regex_var, width=50)
-        self.regex_entry.pack(side=tk.LEFT, padx=5)
-
-        # 4) Frame: Operation mode
-        mode_frame = tk.Frame(root, padx=10, pady=5)
-        mode_frame.pack(fill=tk.X)
-        tk.Label(mode_frame, text="Operation Mode:").pack(side=tk.LEFT)
-        self.mode_var = tk.StringVar(value='match')
-
-        tk.Radiobutton(
-            mode_frame, text="Just Match",
-            variable=self.mode_var, value='match',
-            command=self.update_replacement_state
-        ).pack(side=tk.LEFT, padx=5)
-
-        tk.Radiobutton(
-            mode_frame, text="Invert Match",
-            variable=self.mode_var, value='invert',
-            command=self.update_replacement_state
-        ).pack(side=tk.LEFT, padx=5)
-
-        tk.Radiobutton(
-            mode_frame, text="Replace",
-            variable=self.mode_var, value='replace',
-            command=self.update_replacement_state
-        ).pack(side=tk.LEFT, padx=5)
-
-        # 5) Frame: Replacement pattern
-        replace_frame = tk.Frame(root, padx=10, pady=5)
-        replace_frame.pack(fill=tk.X)
-        tk.Label(replace_frame, text="Replacement pattern:").pack(side=tk.LEFT)
-        self.replace_var = tk.StringVar()
-        self.replace_entry = tk.Entry(replace_frame, textvariable=self.replace_var, width=50)
-        self.replace_entry.pack(side=tk.LEFT, padx=5)
-
-        # 6) Frame: Process button
-        button_frame = tk.Frame(root, padx=10, pady=5)
-        button_frame.pack(fill=tk.X)
-        tk.Button(button_frame, text="Process", command=self.on_process).pack(side=tk.LEFT)
-
-        # 7) Frame: Output (log)
-        output_frame = tk.Frame(root, padx=10, pady=10)
-        output_frame.pack(fill=tk.BOTH, expand=True)
-        tk.Label(output_frame, text="Console Output:").pack(anchor="w")
-        self.output_text = tk.Text(output_frame, height=15)
-        self.output_text.pack(fill=tk.BOTH, expand=True)
-
-        # Initialize UI
-        self.update_ui_for_input_type()
-        self.update_replacement_state()
-
-    def update_ui_for_input_type(self):
-        """ Show path_frame + extension filter if directory, or just path_frame if single file, or text_frame if string. """
-        input_type = self.input_type_var.get()
-
-        # Hide all relevant frames first
-        self.path_frame.pack_forget()
-        self.ext_filter_frame.pack_forget()
-        self.text_frame.pack_forget()
-
-        if input_type == 'directory':
-            # Show path frame and the extension filter frame
-            self.path_frame.pack(fill=tk.X)
-            self.ext_filter_frame.pack(fill=tk.X, padx=5)
-        elif input_type == 'single':
-            # Show path frame, hide extension filter
-            self.path_frame.pack(fill=tk.X)
-        else:  # 'string'
-            # Show text frame
-            self.text_frame.pack(fill=tk.X, expand=True)
-
-    def on_browse(self):
-        """Handle the Browse button for file/directory modes."""
-        input_type = self.input_type_var.get()
-        try:
-            if input_type == 'single':
-                filepath = filedialog.askopenfilename(
-                    title="Select a single file",
-                    filetypes=[("All files", "*.*")]
-                )
-                if filepath:
-                    self.path_var.set(filepath)
-            elif input_type == 'directory':
-                directory = filedialog.askdirectory(title="Select a directory containing files")
-                if directory:
-                    self.path_var.set(directory)
-        except Exception as e:
-            messagebox.showerror("Error", f"Error during file/directory selection: {e}")
-
-    def update_replacement_state(self):
-        """Enable or disable the replacement pattern entry based on selected mode."""
-        mode = self.mode_var.get()
-        if mode == 'match':
-            self.replace_entry.configure(state=tk.DISABLED)
-            self.replace_var.set('')
-        else:
-            self.replace_entry.configure(state=tk.NORMAL)
-
-    def on_process(self):
-        """Collect user inputs and run the process."""
-        input_type = self.input_type_var.get()  # 'single', 'directory', or 'string'
-        path = self.path_var.get().strip()
-        match_regex = self.regex_var.get().strip()
-        mode = self.mode_var.get()
-        replace_pattern = self.replace_var.get().strip() or None
-
-        # Only applies if user selected directory
-        extension_filter = None
-        if input_type == 'directory':
-            extension_filter = self.extension_var.get().strip() or None
-
-        if not match_regex:
-            messagebox.showwarning("Missing Regex", "Please provide a regex pattern.")
-            return
-
-        # Warn if we're about to modify files
-        if mode in ('invert', 'replace') and input_type != 'string':
-            proceed = messagebox.askyesno(
-                "Warning",
-                "This operation may permanently modify files. Do you want to continue?"
-            )
-            if not proceed:
-                return
-
-        # Clear the output
-        self.output_text.delete("1.0", tk.END)
-
-        try:
-            if input_type == 'string':
-                # Handle multiline string
-                text_input = self.text_widget.get("1.0", tk.END).rstrip('\n')
-                if not text_input:
-                    messagebox.showwarning("Empty Text", "Please enter or paste some text.")
-                    return
-
-                self.output_text.insert(tk.END, f"Starting processing in '{mode}' mode (Multiline String)...\n\n")
-                process_multiline_string(
-                    text_input=text_input,
-                    match_pattern=match_regex,
-                    mode=mode,
-                    replace_pattern=replace_pattern,
-                    output_widget=self.output_text
-                )
-                self.output_text.insert(tk.END, "Processing complete.\n")
-                self.output_text.see(tk.END)
-                messagebox.showinfo("Done", "Processing completed!")
-
-            elif input_type == 'single':
-                # Single file
-                if not os.path.isfile(path):
-                    messagebox.showerror("Invalid File", "The selected path is not a valid file.")
-                    return
-                file_paths = [path]
-
-                self.output_text.insert(tk.END, f"Starting processing in '{mode}' mode...\n\n")
-                process_files(
-                    file_paths=file_paths,
-                    match_pattern=match_regex,
-                    mode=mode,
-                    replace_pattern=replace_pattern,
-                    output_widget=self.output_text
-                )
-                self.output_text.insert(tk.END, "Processing complete.\n")
-                self.output_text.see(tk.END)
-                messagebox.showinfo("Done", "Processing completed!")
-
-            else:
-                # Directory
-                if not os.path.isdir(path):
-                    messagebox.showerror("Invalid Directory", "The selected path is not a valid directory.")
-                    return
-
-                file_paths = gather_file_paths(
-                    input_type='directory',
-                    path=path,
-                    extension_filter=extension_filter
-                )
-
-                if not file_paths:
-                    messagebox.showwarning("No Files", "No files found to process.")
-                    return
-
-                self.output_text.insert(tk.END, f"Starting processing in '{mode}' mode...\n\n")
-                process_files(
-                    file_paths=file_paths,
-                    match_pattern=match_regex,
-                    mode=mode,
-                    replace_pattern=replace_pattern,
-                    output_widget=self.output_text
-                )
-                self.output_text.insert(tk.END, "Processing complete.\n")
-                self.output_text.see(tk.END)
-                messagebox.showinfo("Done", "Processing completed!")
-
-        except Exception as e:
-            messagebox.showerror("Error", f"An unexpected error occurred: {e}")
-
-    def auto_resize_text(self, event):
-        """
-        Dynamically adjust the text widget height based on the line count.
-        """
-        try:
-            line_count = int(self.text_widget.index("end-1c").split('.')[0])
-            min_height = 1
-            max_height = 20
-            new_height = max(min_height, min(line_count, max_height))
-            self.text_widget.config(height=new_height)
-        except Exception as e:
-            print(f"Error resizing text widget: {e}")
-
-def main():
-    try:
-        root = tk.Tk()
-        app = RegexApp(root)
-        root.mainloop()
-    except Exception as e:
-        print(f"Fatal error: {e}")
-
-if __name__ == "__main__":
-    main()
+import argparse
+import bisect
+import codecs
+import collections
+import contextlib
+import difflib
+import fnmatch
+import functools
+import gzip
+import io
+import itertools
+import json
+import mmap
+import multiprocessing
+import operator
+import os
+import queue
+import re
+import select
+import shutil
+import signal
+import sqlite3
+import stat
+import struct
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+try:
+    from re import _parser as sre_parse  # Python 3.11+
+except ImportError:
+    import sre_parse
+# Python builds without these compression libraries cannot search .bz2 / .xz files
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+try:
+    import lzma
+except ImportError:
+    lzma = None
+# https://chatgpt.com/share/677c1371-29e0-8010-9ea3-ffea5e57840f
+# manual changes:
+# lines 158-159:
+#            else:
+#                output_widget.insert(tk.END, f"No change needed: {filepath}\n")
+
+
+# tkinter is imported by load_tkinter() when the GUI starts, so the
+# command-line interface and the worker processes never load it.
+tk = filedialog = messagebox = None
+
+# Index for appending to an output widget (same value as tkinter.END)
+END = 'end'
+
+ENCODINGS_TO_TRY = [
+    'utf-8',
+    'utf-16',
+    'cp1252',
+    'iso-8859-1'
+]
+
+# Worker processes used by process_files (1 = run inline, no pool)
+DEFAULT_WORKERS = os.cpu_count() or 1
+# Jobs queued per worker, so lazy path iterables are never drained up front
+JOBS_PER_WORKER = 4
+# How often a background run checks for cancellation
+CANCEL_POLL_SECONDS = 0.2
+# Threads that write rewritten files back while the next file is matched
+# (single-process runs; pool workers write their own files)
+DEFAULT_WRITE_WORKERS = 2
+# How often the GUI drains the background run's output queue
+OUTPUT_POLL_MS = 50
+# Pause after the last keystroke before the live preview searches again
+LIVE_PREVIEW_DELAY_MS = 250
+# Matches the live preview keeps (and can highlight) per evaluation
+LIVE_PREVIEW_MAX_MATCHES = 100000
+# Matches listed per file in the console before the rest is folded away
+DEFAULT_MAX_MATCHES_SHOWN = 20
+# Full match lists kept in memory by a ResultStore before moving to disk
+RESULT_STORE_SPILL_BYTES = 64 * 1024 * 1024
+
+# Files larger than this are scanned in windows instead of being read whole
+DEFAULT_STREAM_THRESHOLD = 64 * 1024 * 1024
+# Characters decoded per read while streaming
+STREAM_CHUNK_CHARS = 1024 * 1024
+# Longest match the streaming scanner guarantees to find intact
+DEFAULT_MAX_MATCH_LENGTH = 4096
+# Unchanged lines shown around each change in dry-run diffs
+DIFF_CONTEXT_LINES = 3
+
+# Bytes sampled from the start of a file to choose its encoding
+SNIFF_BYTES = 64 * 1024
+# Encodings the bytes-level search can run on directly
+ASCII_COMPATIBLE_ENCODINGS = ('utf-8', 'cp1252', 'iso-8859-1')
+
+# Persistent 'match' result cache (see ResultCache); bump the version
+# whenever a change makes previously stored results invalid
+RESULT_CACHE_VERSION = 8
+RESULT_CACHE_MAX_ENTRIES = 200000
+RESULT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+RESULT_CACHE_COMMIT_EVERY = 500
+# Undo journals (create_journal) older than this many seconds are removed
+JOURNAL_MAX_AGE = 14 * 24 * 3600
+
+# Required literals checked per file by the literal prefilter
+MAX_PREFILTER_LITERALS = 3
+
+# Bytes sniffed for NULs when deciding whether a file is binary
+BINARY_SNIFF_BYTES = 8192
+# Archives and compressed files searched member by member in 'match' mode
+# (process_archive), by file name suffix; tarballs must come before .gz etc.
+ARCHIVE_SUFFIXES = (
+    ('.tar', 'tar'), ('.tar.gz', 'tar'), ('.tgz', 'tar'), ('.tar.bz2', 'tar'),
+    ('.tbz2', 'tar'), ('.tar.xz', 'tar'), ('.txz', 'tar'),
+    ('.zip', 'zip'), ('.gz', 'gzip'), ('.bz2', 'bz2'), ('.xz', 'xz'), ('.lzma', 'xz'),
+)
+# Separates an archive's path from a member's name, as in logs.zip!app/today.log
+ARCHIVE_MEMBER_SEPARATOR = '!'
+# Discovered paths buffered between the directory walk and the workers
+WALK_QUEUE_SIZE = 1024
+# Directory filters offered in the GUI
+DEFAULT_EXCLUDE_DIRS = '.git, .hg, .svn, node_modules, __pycache__'
+DEFAULT_IGNORE_FILES = ('.gitignore',)
+
+# Flags the user can switch on for a run, by name (GUI checkboxes, CLI options)
+PATTERN_FLAGS = {
+    'IGNORECASE': re.IGNORECASE,
+    'MULTILINE': re.MULTILINE,
+    'DOTALL': re.DOTALL,
+    'VERBOSE': re.VERBOSE,
+}
+# Compiled (pattern, flags, engine) combinations kept by compile_pattern
+PATTERN_CACHE_SIZE = 256
+# Regex engines: stdlib 're', the third-party 'regex' module (with its own
+# timeouts) and Google's RE2 bindings ('re2', linear time, no backreferences
+# or lookarounds). 'auto' picks one per pattern, see resolve_engine.
+ENGINES = ('auto', 're', 'regex', 're2')
+# Seconds the GUI lets one search run before giving up on the file (or the
+# text box); see WatchedPattern for what counts as one search
+DEFAULT_MATCH_TIMEOUT = 30
+# How often match_watchdog checks on the running search, in seconds
+MATCH_WATCH_TICK = 0.05
+# Where a run's time goes (see RunProgress); process_file times all but 'walk'
+STAGES = ('walk', 'read', 'decode', 'match', 'write')
+# How often the command line redraws its --progress line, in seconds
+PROGRESS_INTERVAL = 0.5
+
+# Watch mode (FileWatcher): seconds between checks for new or grown files
+DEFAULT_WATCH_INTERVAL = 2.0
+# With inotify, also check every file by stat every this many intervals
+# (inotify does not see changes made by other machines on network shares)
+WATCH_SWEEP_EVERY = 30
+# After the first inotify event, wait this long so a burst of writes is read at once
+WATCH_SETTLE_SECONDS = 0.1
+# Appended bytes read (and searched) at a time
+WATCH_READ_BYTES = 16 * 1024 * 1024
+# Bytes before the remembered offset compared on every change, to tell a
+# file that was appended to from one that was rewritten
+WATCH_TAIL_BYTES = 64
+
+# path -> (size, mtime_ns, encoding) from earlier runs; see remember_encoding
+ENCODING_CACHE = collections.OrderedDict()
+ENCODING_CACHE_MAX = 500000
+
+def detect_encoding(sample):
+    """
+    Choose an encoding from a sample of the first bytes of a file.
+    BOMs decide first; UTF-16 without a BOM is only assumed when the sample
+    shows its typical NUL byte layout (so binaries are not taken for UTF-16);
+    otherwise the first of ENCODINGS_TO_TRY that decodes the sample wins.
+    """
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+
+    if b'\x00' in sample:
+        pairs = len(sample) // 2
+        even_nuls = sample[0:pairs * 2:2].count(0)
+        odd_nuls = sample[1:pairs * 2:2].count(0)
+        # Mostly-ASCII UTF-16 text has a NUL in every other byte and none in between
+        if pairs and odd_nuls > pairs * 0.3 and even_nuls == 0:
+            return 'utf-16-le'
+        if pairs and even_nuls > pairs * 0.3 and odd_nuls == 0:
+            return 'utf-16-be'
+
+    for enc in encoding_fallbacks('utf-8'):
+        try:
+            # final=False: the sample may end in the middle of a character
+            codecs.getincrementaldecoder(enc)().decode(sample, final=False)
+            return enc
+        except UnicodeDecodeError:
+            pass
+    return 'iso-8859-1'
+
+def encoding_fallbacks(encoding):
+    """Return encoding followed by the ENCODINGS_TO_TRY entries to fall back on if it fails."""
+    candidates = [enc for enc in ENCODINGS_TO_TRY if enc != 'utf-16']
+    if encoding in candidates:
+        return candidates[candidates.index(encoding):]
+    return [encoding] + candidates
+
+def decode_text(data, encoding):
+    """
+    Decode a file's bytes, starting with the given encoding and falling back
+    along encoding_fallbacks. Line endings are normalised to '\\n' the same way
+    reading the file in text mode would. Returns (content, encoding) or (None, None).
+    """
+    for enc in encoding_fallbacks(encoding):
+        try:
+            content = data.decode(enc)
+        except UnicodeDecodeError:
+            continue
+        if '\r' in content:
+            content = content.replace('\r\n', '\n').replace('\r', '\n')
+        return content, enc
+    return None, None
+
+def remember_encoding(result):
+    """Store the encoding found for a processed file (see process_file) in ENCODING_CACHE."""
+    if result.get('encoding') and result.get('stat'):
+        size, mtime_ns = result['stat']
+        ENCODING_CACHE[result['path']] = (size, mtime_ns, result['encoding'])
+        ENCODING_CACHE.move_to_end(result['path'])
+        while len(ENCODING_CACHE) > ENCODING_CACHE_MAX:
+            ENCODING_CACHE.popitem(last=False)
+
+def add_stage_time(timings, stage, since):
+    """Add the time since the perf_counter() reading `since` to timings[stage]; returns a fresh reading."""
+    now = time.perf_counter()
+    timings[stage] = timings.get(stage, 0.0) + now - since
+    return now
+
+def try_open_text_file(filepath, encoding=None, timings=None):
+    """
+    Read the file once and decode it, trying multiple encodings on that buffer.
+    The encoding is taken from `encoding` when known (e.g. cached from an
+    earlier run), otherwise detected from the first bytes (detect_encoding).
+    Returns (content, encoding) if successful, or (None, None) if not.
+    If a timings dict is given, the time spent is added to its 'read' and 'decode'.
+    """
+    clock = time.perf_counter()
+    try:
+        with open(filepath, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None, None
+    except PermissionError:
+        return None, None
+    except Exception as e:
+        print(f"Unexpected error while reading '{filepath}': {e}", file=sys.stderr)
+        return None, None
+
+    if timings is not None:
+        clock = add_stage_time(timings, 'read', clock)
+    if encoding is None:
+        encoding = detect_encoding(data[:SNIFF_BYTES])
+    decoded = decode_text(data, encoding)
+    if timings is not None:
+        add_stage_time(timings, 'decode', clock)
+    return decoded
+
+class MatchTimeout(BaseException):
+    """
+    Raised when a file takes longer than its match_timeout.
+    Like KeyboardInterrupt it is not an Exception, so the `except Exception`
+    handlers on the way up clean up after themselves instead of swallowing it.
+    """
+
+@functools.lru_cache(maxsize=None)
+def load_engine(name):
+    """Return the module behind a regex engine name, or None if it is not installed."""
+    if name == 're':
+        return re
+    if name == 're2':
+        try:
+            import re2
+        except ImportError:
+            return None
+        return re2
+    if name == 'regex':
+        # This file is called regex.py too, so its own directory has to be
+        # kept off the path; imported under that name itself, it hides the module.
+        here = os.path.dirname(os.path.abspath(__file__))
+        own = sys.modules.get('regex')
+        if own is not None and os.path.dirname(os.path.abspath(getattr(own, '__file__', '') or '')) == here:
+            return None
+        saved_path = sys.path[:]
+        sys.path[:] = [p for p in sys.path if os.path.abspath(p or os.curdir) != here]
+        try:
+            import regex as regex_module
+        except ImportError:
+            return None
+        finally:
+            sys.path[:] = saved_path
+        return regex_module
+    return None
+
+def has_nested_quantifiers(parsed):
+    """True if an unbounded repeat contains another one, as in (a+)+ or (\\w*\\s?)*."""
+    repeat_ops = (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT)
+
+    def walk(items, inside_repeat):
+        for op, av in items:
+            if op in repeat_ops:
+                unbounded = av[1] == sre_parse.MAXREPEAT
+                if unbounded and inside_repeat:
+                    return True
+                if walk(av[2], inside_repeat or unbounded):
+                    return True
+            elif op == sre_parse.SUBPATTERN:
+                if walk(av[3], inside_repeat):
+                    return True
+            elif op == sre_parse.BRANCH:
+                if any(walk(branch, inside_repeat) for branch in av[1]):
+                    return True
+            elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+                if walk(av[1], inside_repeat):
+                    return True
+        return False
+
+    return walk(parsed, False)
+
+@functools.lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def resolve_engine(pattern, flags=0, engine='re'):
+    """
+    Return the engine that will run pattern: `engine` itself, or for 'auto'
+    stdlib 're' unless the pattern nests unbounded quantifiers (the usual
+    cause of catastrophic backtracking). Those go to RE2 if it is installed
+    and supports the pattern, else to the 'regex' module (which can at least
+    time out on its own), else to 're'.
+    """
+    if engine != 'auto':
+        return engine
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except re.error:
+        return 're'
+    if not has_nested_quantifiers(parsed):
+        return 're'
+    for candidate in ('re2', 'regex'):
+        if load_engine(candidate) is None:
+            continue
+        try:
+            compile_with_engine(pattern, flags, candidate)
+        except re.error:
+            continue
+        return candidate
+    return 're'
+
+def compile_with_engine(pattern, flags, engine):
+    """Compile pattern with one engine; every engine's syntax errors are raised as re.error."""
+    module = load_engine(engine)
+    if module is None:
+        raise re.error(f"regex engine '{engine}' is not installed")
+    if engine == 're':
+        return re.compile(pattern, flags)
+    if engine == 're2':
+        # RE2 has no VERBOSE; the other flags become inline flags
+        if flags & re.VERBOSE:
+            raise re.error("RE2 does not support VERBOSE patterns")
+        inline = ''.join(letter for flag, letter in ((re.IGNORECASE, 'i'), (re.MULTILINE, 'm'), (re.DOTALL, 's'))
+                         if flags & flag)
+        options = module.Options()
+        options.log_errors = False
+        try:
+            return module.compile(f'(?{inline}){pattern}' if inline else pattern, options)
+        except module.error as e:
+            message = e.args[0] if e.args else e
+            if isinstance(message, bytes):
+                message = message.decode('utf-8', 'replace')
+            raise re.error(f"{message}")
+    try:
+        return module.compile(pattern, flags)
+    except module.error as e:
+        raise re.error(f"{e}")
+
+@functools.lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def compile_pattern(pattern, flags=0, engine='re'):
+    """
+    Compile pattern with flags (a combination of PATTERN_FLAGS) on a regex
+    engine (see ENGINES / resolve_engine), reusing earlier compilations:
+    repeated runs and every file of a run share one compiled pattern per
+    (pattern, flags, engine). Raises re.error.
+    """
+    return compile_with_engine(pattern, flags, resolve_engine(pattern, flags, engine))
+
+@contextlib.contextmanager
+def match_deadline(seconds):
+    """
+    Raise MatchTimeout in this block once `seconds` have passed, using an
+    interval timer signal: the 're' and 'regex' engines check for signals
+    while they backtrack, so even a runaway match is interrupted.
+    Timers only work on the main thread and not on Windows; elsewhere this
+    does nothing and yields False.
+    """
+    if not seconds or not can_use_match_deadline():
+        yield False
+        return
+
+    def on_alarm(signum, frame):
+        raise MatchTimeout(f"no result after {seconds} s")
+
+    previous = signal.signal(signal.SIGALRM, on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield True
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+# The WatchedPattern search running under a match_watchdog: when it is due
+# to give up (time.monotonic()) and its timeout; 'deadline' is None between searches
+MATCH_WATCH = {'deadline': None, 'seconds': None}
+
+@contextlib.contextmanager
+def match_watchdog():
+    """
+    Let WatchedPattern searches in this block raise MatchTimeout once they
+    overrun. A repeating timer signal looks at MATCH_WATCH every
+    MATCH_WATCH_TICK seconds and only raises while a search is running and
+    overdue, so the reading, writing and fsyncing around the searches are
+    never interrupted. Like match_deadline this needs the main thread and
+    does nothing (yielding False) elsewhere.
+    """
+    if not can_use_match_deadline():
+        yield False
+        return
+
+    def on_alarm(signum, frame):
+        deadline = MATCH_WATCH['deadline']
+        if deadline is not None and time.monotonic() >= deadline:
+            MATCH_WATCH['deadline'] = None
+            raise MatchTimeout(f"no result after {MATCH_WATCH['seconds']} s")
+
+    previous = signal.signal(signal.SIGALRM, on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, MATCH_WATCH_TICK, MATCH_WATCH_TICK)
+    try:
+        yield True
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+        MATCH_WATCH['deadline'] = None
+
+def can_use_match_deadline():
+    """True if match_deadline can actually interrupt matching in the current thread."""
+    return hasattr(signal, 'setitimer') and threading.current_thread() is threading.main_thread()
+
+class TimeLimitedPattern:
+    """
+    A compiled 'regex' module pattern whose searches share one deadline,
+    passed down as that module's own timeout argument. Used where
+    match_deadline cannot work (Windows, threads). The module's TimeoutError
+    is turned into MatchTimeout.
+    """
+    def __init__(self, pattern, seconds):
+        self.pattern = pattern
+        self.seconds = seconds
+        self.deadline = time.monotonic() + seconds
+
+    def __getattr__(self, name):
+        return getattr(self.pattern, name)
+
+    def time_left(self):
+        return max(0.001, self.deadline - time.monotonic())
+
+    def call(self, method, *args):
+        try:
+            return getattr(self.pattern, method)(*args, timeout=self.time_left())
+        except TimeoutError:
+            raise MatchTimeout(f"no result after {self.seconds} s")
+
+    def finditer(self, string, *args):
+        matches = self.call('finditer', string, *args)
+        while True:
+            try:
+                match = next(matches)
+            except StopIteration:
+                return
+            except TimeoutError:
+                raise MatchTimeout(f"no result after {self.seconds} s")
+            yield match
+
+    def findall(self, string, *args):
+        return self.call('findall', string, *args)
+
+    def search(self, string, *args):
+        return self.call('search', string, *args)
+
+    def subn(self, replacement, string, *args):
+        return self.call('subn', replacement, string, *args)
+
+class WatchedPattern:
+    """
+    A compiled pattern whose searches may each run for `seconds` inside a
+    match_watchdog before giving up with MatchTimeout. One search is one
+    findall/search/sub/subn call, or finding the next match of a finditer,
+    so a big file streamed window by window is not given up on as long as
+    no single search runs away, and time spent between searches (reading,
+    writing) does not count.
+    """
+    def __init__(self, pattern, seconds):
+        self.pattern = pattern
+        self.seconds = seconds
+
+    def __getattr__(self, name):
+        return getattr(self.pattern, name)
+
+    def timed(self, function, *args):
+        MATCH_WATCH['seconds'] = self.seconds
+        MATCH_WATCH['deadline'] = time.monotonic() + self.seconds
+        try:
+            return function(*args)
+        finally:
+            MATCH_WATCH['deadline'] = None
+
+    def finditer(self, string, *args):
+        matches = self.pattern.finditer(string, *args)
+        while True:
+            try:
+                match = self.timed(next, matches)
+            except StopIteration:
+                return
+            yield match
+
+    def findall(self, string, *args):
+        return self.timed(self.pattern.findall, string, *args)
+
+    def search(self, string, *args):
+        return self.timed(self.pattern.search, string, *args)
+
+    def sub(self, replacement, string, *args):
+        return self.timed(self.pattern.sub, replacement, string, *args)
+
+    def subn(self, replacement, string, *args):
+        return self.timed(self.pattern.subn, replacement, string, *args)
+
+def limit_pattern(compiled_pattern, match_timeout, engine):
+    """
+    Give each search of a compiled pattern (run by `engine`) match_timeout
+    seconds: a WatchedPattern where match_watchdog works, a
+    TimeLimitedPattern for the 'regex' engine elsewhere, else the pattern
+    as it is.
+    """
+    if not match_timeout:
+        return compiled_pattern
+    if can_use_match_deadline():
+        return WatchedPattern(compiled_pattern, match_timeout)
+    if engine == 'regex':
+        return TimeLimitedPattern(compiled_pattern, match_timeout)
+    return compiled_pattern
+
+def pattern_flags(names):
+    """Combine flag names (keys of PATTERN_FLAGS) into a flags value."""
+    flags = 0
+    for name in names:
+        flags |= PATTERN_FLAGS[name]
+    return flags
+
+def regex_replace_and_store(content, compiled_pattern, mode, replace_pattern=None):
+    """
+    Depending on the selected mode:
+    
+    1. 'match':
+       - Detect all matches. No modifications.
+       - Returns (None, list_of_matches).
+
+    2. 'invert':
+       - Treat all non-matching text as if it matched,
+         and keep the actual matches unchanged.
+       - If replace_pattern is provided, replace the non-matching segments with it,
+         otherwise remove them.
+       - Returns (updated_content, None).
+
+    3. 'replace':
+       - Standard search-and-replace for the matched text.
+       - Returns (updated_content, None).
+    """
+    updated_content, matches, _ = regex_replace_and_count(
+        content, compiled_pattern, mode, replace_pattern
+    )
+    return updated_content, matches
+
+def regex_replace_and_count(content, compiled_pattern, mode, replace_pattern=None):
+    """
+    Same as regex_replace_and_store, but also returns the number of matches:
+    (updated_content, list_of_matches, match_count). Used where hit counts
+    are reported (rule sets) without matching a second time.
+    """
+    try:
+        if mode == 'match':
+            all_matches = compiled_pattern.findall(content)
+            return None, all_matches, len(all_matches)
+
+        elif mode == 'invert':
+            # Every stretch of text between matches (empty ones included) gives
+            # way to the replacement; the matches themselves are kept as they are
+            replacement = replace_pattern if replace_pattern is not None else ''
+            updated_segments = []
+            match_count = 0
+            for match in compiled_pattern.finditer(content):
+                updated_segments.append(replacement)
+                updated_segments.append(match.group(0))
+                match_count += 1
+            updated_segments.append(replacement)
+            updated_content = ''.join(updated_segments)
+            return updated_content, None, match_count
+
+        elif mode == 'replace':
+            updated_content, match_count = compiled_pattern.subn(
+                replace_pattern if replace_pattern else '',
+                content
+            )
+            return updated_content, None, match_count
+
+        else:
+            return None, None, 0
+
+    except re.error as e:
+        print(f"Regex error: {e}", file=sys.stderr)
+        return None, None, 0
+
+def iter_edits(content, compiled_pattern, mode, replace_pattern=None, counts=None):
+    """
+    Yield the changes 'invert' or 'replace' would make to content as
+    (start, end, new_text) tuples, in order and without overlaps, from a
+    single finditer pass. Spans whose text would stay the same are left out.
+    Nothing is copied besides the replacement texts themselves.
+    If a dict is passed as counts, counts['matches'] is kept at the number
+    of matches seen so far.
+    """
+    replacement = replace_pattern if replace_pattern else ''
+    position = 0
+    if counts is not None:
+        counts['matches'] = 0
+    for match in compiled_pattern.finditer(content):
+        if counts is not None:
+            counts['matches'] += 1
+        if mode == 'replace':
+            expanded = match.expand(replacement)
+            if expanded != match.group(0):
+                yield match.start(), match.end(), expanded
+        elif content[position:match.start()] != replacement:
+            # 'invert': the text between matches gives way to the replacement
+            yield position, match.start(), replacement
+        position = match.end()
+    if mode == 'invert' and content[position:] != replacement:
+        yield position, len(content), replacement
+
+def apply_edits(content, edits, start=0, end=None):
+    """Return content[start:end] with the edits (from iter_edits) inside it applied."""
+    end = len(content) if end is None else end
+    pieces = []
+    position = start
+    for edit_start, edit_end, new_text in edits:
+        pieces.append(content[position:edit_start])
+        pieces.append(new_text)
+        position = edit_end
+    pieces.append(content[position:end])
+    return ''.join(pieces)
+
+def new_change_stats():
+    return {'substitutions': 0, 'bytes_removed': 0, 'bytes_added': 0}
+
+def count_edit(stats, old_text, new_text, encoding):
+    """Add one change to a change statistics dict (see new_change_stats)."""
+    stats['substitutions'] += 1
+    stats['bytes_removed'] += len(old_text.encode(encoding, 'replace'))
+    stats['bytes_added'] += len(new_text.encode(encoding, 'replace'))
+
+def split_lines(text):
+    """Split text after each '\\n' only (str.splitlines also splits at \\x0c, \\u2028, ...)."""
+    parts = text.split('\n')
+    lines = [part + '\n' for part in parts[:-1]]
+    if parts[-1]:
+        lines.append(parts[-1])
+    return lines
+
+def format_diff_range(start, length):
+    """Line range for a unified diff hunk header, as difflib writes it."""
+    if length == 1:
+        return f"{start + 1}"
+    if not length:
+        start -= 1
+    return f"{start + 1},{length}"
+
+def iter_unified_diff(content, edits, path, context=DIFF_CONTEXT_LINES):
+    """
+    Yield the lines of a unified diff between content and content with the
+    edits (from iter_edits) applied, without building the edited file.
+    Edits are grouped into regions of nearby lines; only those regions are
+    copied and compared line by line.
+    """
+    line_index = LineIndex(content)
+    starts = line_index.starts
+    line_count = len(starts) - 1 if content.endswith('\n') or not content else len(starts)
+    last_line = max(0, line_count - 1)
+
+    regions = []  # [first_line, last_line, edits], 0-based line numbers
+    for edit in edits:
+        first = min(line_index.locate(edit[0])[0] - 1, last_line)
+        # The line the edit ends in: for an edit that removes a line break
+        # that is the following line, which the edit joins to its own
+        last = min(line_index.locate(edit[1])[0] - 1, last_line)
+        if regions and first - regions[-1][1] - 1 <= 2 * context:
+            regions[-1][1] = max(regions[-1][1], last)
+            regions[-1][2].append(edit)
+        else:
+            regions.append([first, last, [edit]])
+
+    if regions:
+        yield f"--- {path}\n"
+        yield f"+++ {path}\n"
+    delta = 0  # lines added so far, to number the new file
+    for first, last, region_edits in regions:
+        first = max(0, first - context)
+        last = min(line_count - 1, last + context)
+        segment_start = starts[first] if line_count else 0
+        segment_end = starts[last + 1] if last + 1 < len(starts) else len(content)
+        old_lines = split_lines(content[segment_start:segment_end])
+        new_lines = split_lines(apply_edits(content, region_edits, segment_start, segment_end))
+
+        matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+        for group in matcher.get_grouped_opcodes(context):
+            i1, i2, j1, j2 = group[0][1], group[-1][2], group[0][3], group[-1][4]
+            yield (f"@@ -{format_diff_range(first + i1, i2 - i1)}"
+                   f" +{format_diff_range(first + delta + j1, j2 - j1)} @@\n")
+            for tag, a1, a2, b1, b2 in group:
+                if tag == 'equal':
+                    lines = [(' ', line) for line in old_lines[a1:a2]]
+                else:
+                    lines = [('-', line) for line in old_lines[a1:a2]]
+                    lines.extend(('+', line) for line in new_lines[b1:b2])
+                for marker, line in lines:
+                    if line.endswith('\n'):
+                        yield marker + line
+                    else:
+                        yield marker + line + '\n'
+                        yield "\\ No newline at end of file\n"
+        delta += len(new_lines) - len(old_lines)
+
+def dry_run_changes(content, compiled_pattern, mode, replace_pattern, encoding, path, with_diff=False):
+    """
+    Work out what 'invert'/'replace' would change in content without
+    writing anything. Returns (stats, diff_lines): stats as in
+    new_change_stats, diff_lines a list of unified diff lines (None unless
+    with_diff). Without a diff the edits are only counted, never collected.
+    """
+    stats = new_change_stats()
+    edits = iter_edits(content, compiled_pattern, mode, replace_pattern)
+    if with_diff:
+        edits = list(edits)
+    for start, end, new_text in edits:
+        count_edit(stats, content[start:end], new_text, encoding)
+    if not with_diff:
+        return stats, None
+    return stats, list(iter_unified_diff(content, edits, path))
+
+def load_rules(rules_path, flags=0, engine='re'):
+    """
+    Load a rule set: an ordered list of (pattern, replacement, mode) triples.
+
+    Two formats are accepted:
+      - '.json': a list of objects with "pattern", optional "replacement"
+        and optional "mode" (default 'replace')
+      - anything else: one rule per line, tab-separated as
+        mode<TAB>pattern[<TAB>replacement]; blank lines and lines starting
+        with '#' are ignored
+    Raises ValueError for malformed rules or for patterns that do not compile
+    with the flags and engine (see compile_pattern) the rules will run with.
+    """
+    rules = []
+    with open(rules_path, 'r', encoding='utf-8-sig') as f:
+        if rules_path.lower().endswith('.json'):
+            for number, entry in enumerate(json.load(f), start=1):
+                if not isinstance(entry, dict) or not entry.get('pattern'):
+                    raise ValueError(f"Rule {number}: expected an object with a \"pattern\"")
+                rules.append((
+                    entry['pattern'],
+                    entry.get('replacement'),
+                    entry.get('mode', 'replace'),
+                ))
+        else:
+            for number, line in enumerate(f, start=1):
+                line = line.rstrip('\r\n')
+                if not line.strip() or line.lstrip().startswith('#'):
+                    continue
+                fields = line.split('\t')
+                if len(fields) < 2 or not fields[1]:
+                    raise ValueError(f"Line {number}: expected mode<TAB>pattern[<TAB>replacement]")
+                rules.append((fields[1], fields[2] if len(fields) > 2 else None, fields[0].strip()))
+
+    for number, (pattern, _, mode) in enumerate(rules, start=1):
+        if mode not in ('match', 'invert', 'replace'):
+            raise ValueError(f"Rule {number}: unknown mode '{mode}'")
+        try:
+            compile_pattern(pattern, flags, engine)
+        except re.error as e:
+            raise ValueError(f"Rule {number}: invalid regex: {e}")
+    return rules
+
+def apply_rules(content, rules, flags=0, engine='re', rule_edits=None, match_timeout=None):
+    """
+    Apply a rule set (see load_rules) to content in one pass per rule, in
+    order, each rule seeing the output of the previous one. flags and
+    engine (see compile_pattern) apply to every rule's pattern.
+    Returns (updated_content, rule_matches, rule_hits): rule_matches maps
+    the index of each 'match' rule that found something to its matches,
+    rule_hits holds the match count of every rule.
+    Returns (None, None, None) on a regex error.
+    If a list is passed as rule_edits, each 'invert'/'replace' rule appends
+    (the text it was applied to, its edits from iter_edits) to it, for dry
+    runs to count and show the changes (rule_edits_diff) without running
+    the rules again. With match_timeout each search is limited (limit_pattern).
+    """
+    rule_matches = {}
+    rule_hits = []
+    for index, (pattern, replacement, mode) in enumerate(rules):
+        compiled_pattern = limit_pattern(compile_pattern(pattern, flags, engine), match_timeout,
+                                         resolve_engine(pattern, flags, engine))
+        if mode != 'match' and rule_edits is not None:
+            counts = {}
+            edits = list(iter_edits(content, compiled_pattern, mode, replacement, counts))
+            rule_edits.append((content, edits))
+            content = apply_edits(content, edits)
+            rule_hits.append(counts['matches'])
+            continue
+        updated_content, matches, match_count = regex_replace_and_count(
+            content, compiled_pattern, mode, replacement
+        )
+        if mode == 'match':
+            if matches is None:
+                return None, None, None
+            if matches:
+                rule_matches[index] = matches
+        else:
+            if updated_content is None:
+                return None, None, None
+            content = updated_content
+        rule_hits.append(match_count)
+    return content, rule_matches, rule_hits
+
+def rule_edits_stats(rule_edits, encoding):
+    """Change statistics (new_change_stats) of the rule_edits apply_rules collected."""
+    stats = new_change_stats()
+    for rule_content, edits in rule_edits:
+        for start, end, new_text in edits:
+            count_edit(stats, rule_content[start:end], new_text, encoding)
+    return stats
+
+def rule_edits_diff(content, updated_content, rule_edits, path):
+    """
+    Unified diff lines between content and what a rule set made of it, from
+    the rule_edits apply_rules collected. Only a single rewriting rule's
+    edits are positions in content itself; otherwise the whole text is
+    compared.
+    """
+    if len(rule_edits) == 1:
+        edits = rule_edits[0][1]
+    else:
+        edits = [(0, len(content), updated_content)]
+    return list(iter_unified_diff(content, edits, path))
+
+def findall_value(match):
+    """
+    Return what compiled_pattern.findall() would have reported for this match:
+    the whole match without groups, the group with one, a tuple with several.
+    """
+    groups = match.groups(match.re.pattern[:0])
+    if not groups:
+        return match.group(0)
+    if len(groups) == 1:
+        return groups[0]
+    return groups
+
+class LineIndex:
+    """
+    Start offset of every line of a text, built once so each match position
+    can be turned into a (line, column) with a bisect instead of counting
+    newlines from the top of the file for every match.
+    """
+    def __init__(self, text):
+        line_lengths = map(len, text.split('\n')[:-1])
+        # Line k (0-based) starts after the lengths of lines 0..k-1 plus k newlines
+        self.starts = [0]
+        self.starts.extend(map(operator.add, itertools.accumulate(line_lengths), itertools.count(1)))
+
+    def locate(self, offset):
+        """Return the 1-based (line, column) of a character offset."""
+        index = bisect.bisect_right(self.starts, offset) - 1
+        return index + 1, offset - self.starts[index] + 1
+
+def locate_matches(content, compiled_pattern, max_count=None, context_lines=None):
+    """
+    Find all matches in content together with where they are.
+    Returns (list_of_matches, spans, context): matches as findall() reports
+    them and, for each, a (start, end, line, column) tuple with character
+    offsets. Only the first max_count matches are taken (None = all).
+    With context_lines (a number of lines, 0 for just the matching line),
+    context holds a line_context() tuple per match; otherwise it is None.
+    """
+    matches = []
+    spans = []
+    context = [] if context_lines is not None else None
+    line_index = None
+    for match in itertools.islice(compiled_pattern.finditer(content), max_count):
+        if line_index is None:
+            line_index = LineIndex(content)
+        line, column = line_index.locate(match.start())
+        matches.append(findall_value(match))
+        spans.append((match.start(), match.end(), line, column))
+        if context is not None:
+            context.append(line_context(content, line_index, line, context_lines))
+    return matches, spans, context
+
+def preview_may_hang(pattern, flags, engine, match_timeout=None):
+    """
+    True if a live preview search for pattern could run away with no way to
+    stop it: the pattern nests unbounded quantifiers (has_nested_quantifiers)
+    and the engine that runs it (resolve_engine) is neither RE2 nor 'regex'
+    with a match_timeout. Such a search would hold the GIL and freeze the GUI.
+    """
+    resolved_engine = resolve_engine(pattern, flags, engine)
+    if resolved_engine == 're2' or (resolved_engine == 'regex' and match_timeout):
+        return False
+    try:
+        return has_nested_quantifiers(sre_parse.parse(pattern, flags))
+    except re.error:
+        return False  # syntax only another engine knows; nothing to go by
+
+def preview_spans(text, compiled_pattern, is_stale=None, max_count=LIVE_PREVIEW_MAX_MATCHES):
+    """
+    Return the (start, end) character offsets of the first max_count matches
+    in text, for the live preview. is_stale is checked before every match;
+    once it returns True the search stops and None is returned.
+    """
+    spans = []
+    for match in itertools.islice(compiled_pattern.finditer(text), max_count):
+        if is_stale is not None and is_stale():
+            return None
+        spans.append(match.span())
+    return spans
+
+def line_context(content, line_index, line, context_lines):
+    """
+    Return (before, text, after) for 1-based line `line` of content: the
+    line's text and lists of up to context_lines lines before and after it,
+    all without their line breaks.
+    """
+    starts = line_index.starts
+    last = len(starts)
+    if last > 1 and starts[-1] == len(content):
+        last -= 1  # content ends with a newline, not with an empty last line
+
+    def text(index):
+        end = starts[index + 1] - 1 if index + 1 < len(starts) else len(content)
+        return content[starts[index]:end]
+
+    index = line - 1
+    before = [text(i) for i in range(max(0, index - context_lines), index)]
+    after = [text(i) for i in range(index + 1, min(last, index + 1 + context_lines))]
+    return before, text(index), after
+
+def bytes_line_context(buffer, line_start, encoding, context_lines):
+    """
+    line_context for a bytes buffer (such as a memory map) that is searched
+    in place: line_start is the offset where the matching line begins.
+    Only the lines returned are decoded.
+    """
+    def decode(start, end):
+        return buffer[start:end].decode(encoding, 'replace').rstrip('\r')
+
+    line_end = buffer.find(b'\n', line_start)
+    if line_end < 0:
+        line_end = len(buffer)
+    before = []
+    end = line_start - 1
+    while end >= 0 and len(before) < context_lines:
+        start = buffer.rfind(b'\n', 0, end) + 1
+        before.append(decode(start, end))
+        end = start - 1
+    before.reverse()
+    after = []
+    start = line_end + 1
+    while start < len(buffer) and len(after) < context_lines:
+        end = buffer.find(b'\n', start)
+        if end < 0:
+            end = len(buffer)
+        after.append(decode(start, end))
+        start = end + 1
+    return before, decode(line_start, line_end), after
+
+def read_line_context(filepath, encoding, line_numbers, context_lines):
+    """
+    line_context for files too large to hold in memory: reads the file once
+    (collect_line_context) and returns a dict mapping each of the 1-based
+    line_numbers to its (before, text, after).
+    """
+    with open(filepath, 'r', encoding=encoding) as f:
+        return collect_line_context(f, line_numbers, context_lines)
+
+def collect_line_context(lines, line_numbers, context_lines):
+    """
+    Go through an iterable of lines (such as a text file) once, keeping only
+    the last context_lines of them, and return a dict mapping each of the
+    1-based line_numbers to its (before, text, after).
+    """
+    wanted = set(line_numbers)
+    found = {}
+    previous = collections.deque(maxlen=context_lines)
+    waiting = []  # after-lists of recent hits still short of context_lines
+    for number, text in enumerate(lines, 1):
+        text = text.rstrip('\n')
+        for after in waiting:
+            after.append(text)
+        waiting = [after for after in waiting if len(after) < context_lines]
+        if number in wanted:
+            wanted.discard(number)
+            after = []
+            found[number] = (list(previous), text, after)
+            if context_lines:
+                waiting.append(after)
+        if not wanted and not waiting:
+            break
+        previous.append(text)
+    return found
+
+def count_newlines(buffer, start, end, newline=b'\n'):
+    """Count newlines in buffer[start:end] a block at a time, so huge memory maps are never copied whole."""
+    count = 0
+    for block_start in range(start, end, STREAM_CHUNK_CHARS):
+        count += buffer[block_start:min(block_start + STREAM_CHUNK_CHARS, end)].count(newline)
+    return count
+
+def iter_stream_windows(reader, compiled_pattern, chunk_size=STREAM_CHUNK_CHARS,
+                        max_match_length=DEFAULT_MAX_MATCH_LENGTH, boundary='lines'):
+    """
+    Scan a text stream in overlapping windows.
+
+    Yields (window, start, end, matches): window[start:end] is the next slice
+    of the stream and matches are the match objects that start inside it.
+    Consecutive slices cover the stream exactly once. Each window also
+    carries up to max_match_length characters of the previous slice in front
+    of `start`, so lookbehinds and '^' / '\\b' see the real neighbouring text.
+
+    boundary decides where a slice may end:
+      - 'lines':  after the last newline at least max_match_length characters
+                  before the end of the window, so any match that does not
+                  span lines is found exactly as in a full read; falls back
+                  to 'window' for lines longer than a chunk.
+      - 'window': max_match_length characters before the end of the window,
+                  so matches up to that length are never cut in two.
+    Either way up to max_match_length characters of text follow the slice,
+    so '$', '\\Z' and lookaheads near its end see the real text instead of
+    taking the window's end for the end of the stream; a match that runs
+    into the end of the window is left for the next one. The last window
+    is yielded even if its slice is empty (an empty stream gives one).
+    """
+    context = ''
+    carry = ''
+    while True:
+        chunk = reader.read(chunk_size)
+        window = context + carry + chunk
+        start = len(context)
+
+        if not chunk:
+            end = len(window)
+        else:
+            lookahead_start = len(window) - max_match_length
+            end = 0
+            if boundary == 'lines':
+                end = window.rfind('\n', start, max(start, lookahead_start)) + 1
+            if end <= start:
+                end = lookahead_start
+
+        matches = []
+        if end > start or not chunk:
+            for match in compiled_pattern.finditer(window, start):
+                if chunk and match.start() >= end:
+                    break
+                if chunk and match.end() >= len(window):
+                    # Cut off by the end of the window: try again with more text
+                    end = match.start()
+                    break
+                matches.append(match)
+        if end <= start and chunk:
+            # Not enough text yet to commit anything; read more.
+            carry = window[start:]
+            continue
+        if matches:
+            end = max(end, matches[-1].end())
+
+        yield window, start, end, matches
+
+        if not chunk:
+            return
+        context = window[max(0, end - max_match_length):end]
+        carry = window[end:]
+
+def match_windows(windows, spans=None, max_count=None):
+    """
+    Collect the matches of iter_stream_windows output as findall() reports
+    them, stopping after max_count (None = all). If a spans list is given,
+    a (start, end, line, column) tuple is appended to it for every match
+    (character offsets into the stream), counting lines as the windows go by.
+    """
+    matches = []
+    line = 1
+    line_start = 0  # file offset where the current line starts
+    base = 0        # file offset of window[start]
+    for window, start, end, window_matches in windows:
+        if max_count is not None and len(matches) + len(window_matches) >= max_count:
+            window_matches = window_matches[:max_count - len(matches)]
+            end = None  # the remaining lines are not needed
+        matches.extend(findall_value(m) for m in window_matches)
+        if spans is None:
+            if end is None:
+                break
+            continue
+        position = start
+        for match in window_matches:
+            newlines = window.count('\n', position, match.start())
+            if newlines:
+                line += newlines
+                line_start = base + window.rfind('\n', position, match.start()) + 1 - start
+            position = match.start()
+            match_start = base + match.start() - start
+            spans.append((match_start, match_start + len(match.group(0)),
+                          line, match_start - line_start + 1))
+        if end is None:
+            break
+        newlines = window.count('\n', position, end)
+        if newlines:
+            line += newlines
+            line_start = base + window.rfind('\n', position, end) + 1 - start
+        base += end - start
+    return matches
+
+def stream_regex_file(filepath, compiled_pattern, mode, replace_pattern=None, encoding='utf-8',
+                      chunk_size=STREAM_CHUNK_CHARS, max_match_length=DEFAULT_MAX_MATCH_LENGTH,
+                      boundary='lines', spans=None, stats=None, max_count=None):
+    """
+    Streaming counterpart of regex_replace_and_store for files too large to read whole.
+    The file is scanned with iter_stream_windows, so peak memory stays around
+    one chunk no matter how big the file is.
+
+    1. 'match':
+       - Returns (None, list_of_matches), see match_windows for spans and max_count.
+
+    2. 'invert' / 'replace':
+       - The updated text is written incrementally to a temporary file next
+         to filepath. Returns (temp_path, None), or (None, None) if nothing
+         would change (the temporary file is removed again).
+       - If a stats dict (new_change_stats) is given, nothing is written: the
+         changes are only counted into it (dry run) and (None, None) is returned.
+    """
+    replacement = replace_pattern if replace_pattern else ''
+
+    with open(filepath, 'r', encoding=encoding) as reader:
+        windows = iter_stream_windows(
+            reader, compiled_pattern,
+            chunk_size=chunk_size,
+            max_match_length=max_match_length,
+            boundary=boundary
+        )
+
+        if mode == 'match':
+            return None, match_windows(windows, spans, max_count)
+
+        if stats is not None:
+            if mode == 'replace':
+                for window, start, end, window_matches in windows:
+                    for match in window_matches:
+                        expanded = match.expand(replacement)
+                        if expanded != match.group(0):
+                            count_edit(stats, match.group(0), expanded, encoding)
+            elif mode == 'invert':
+                # Gaps between matches can span windows: keep their encoded size
+                # and, while they are no longer than the replacement, their text
+                gap_head = ''
+                gap_bytes = 0
+                gap_longer = False
+                for window, start, end, window_matches in windows:
+                    position = start
+                    for match in window_matches:
+                        gap = window[position:match.start()]
+                        gap_bytes += len(gap.encode(encoding, 'replace'))
+                        if gap_longer or gap_head + gap != replacement:
+                            count_edit(stats, '', replacement, encoding)
+                            stats['bytes_removed'] += gap_bytes
+                        gap_head = ''
+                        gap_bytes = 0
+                        gap_longer = False
+                        position = match.end()
+                    if position < end:
+                        gap = window[position:end]
+                        gap_bytes += len(gap.encode(encoding, 'replace'))
+                        if not gap_longer:
+                            gap_head += gap
+                            if len(gap_head) > len(replacement):
+                                gap_longer = True
+                                gap_head = ''
+                if gap_longer or gap_head != replacement:
+                    count_edit(stats, '', replacement, encoding)
+                    stats['bytes_removed'] += gap_bytes
+            return None, None
+
+        fd, temp_path = create_temp_file(filepath)
+        changed = False
+        try:
+            with open(fd, 'w', encoding=encoding) as out_file:
+                if mode == 'invert':
+                    # The current non-matching segment may span several windows;
+                    # only its first few characters are kept to tell whether
+                    # swapping it for the replacement changes anything.
+                    gap_head = ''
+                    gap_longer = False
+                    for window, start, end, window_matches in windows:
+                        position = start
+                        for match in window_matches:
+                            gap_head += window[position:match.start()]
+                            if gap_longer or gap_head != replacement:
+                                changed = True
+                            out_file.write(replacement)
+                            out_file.write(match.group(0))
+                            gap_head = ''
+                            gap_longer = False
+                            position = match.end()
+                        if position < end and not gap_longer:
+                            gap_head += window[position:end]
+                            if len(gap_head) > len(replacement):
+                                gap_longer = True
+                                gap_head = ''
+                    if gap_longer or gap_head != replacement:
+                        changed = True
+                    out_file.write(replacement)
+
+                elif mode == 'replace':
+                    for window, start, end, window_matches in windows:
+                        position = start
+                        for match in window_matches:
+                            out_file.write(window[position:match.start()])
+                            expanded = match.expand(replacement)
+                            if expanded != match.group(0):
+                                changed = True
+                            out_file.write(expanded)
+                            position = match.end()
+                        out_file.write(window[position:end])
+                out_file.flush()
+                os.fsync(out_file.fileno())
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+        if not changed:
+            os.remove(temp_path)
+            return None, None
+        return temp_path, None
+
+def archive_kind(filepath):
+    """
+    Return 'tar', 'zip', 'gzip', 'bz2' or 'xz' if filepath is named like an
+    archive or compressed file (ARCHIVE_SUFFIXES), else None. Formats whose
+    compression library is missing from this Python are not recognised.
+    """
+    name = filepath.lower()
+    for suffix, kind in ARCHIVE_SUFFIXES:
+        if name.endswith(suffix):
+            if (kind == 'bz2' and bz2 is None) or (kind == 'xz' and lzma is None):
+                return None
+            return kind
+    return None
+
+def iter_archive_members(filepath, kind):
+    """
+    Yield (name, open_member) for every regular file in an archive of the
+    given archive_kind; open_member() returns a binary stream that
+    decompresses as it is read, so nothing is extracted to disk or held in
+    memory whole. A compressed single file has one member, named after the
+    file without its last suffix.
+    """
+    if kind == 'zip':
+        with zipfile.ZipFile(filepath) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    yield info.filename, functools.partial(archive.open, info)
+    elif kind == 'tar':
+        with tarfile.open(filepath, 'r:*') as archive:
+            for member in archive:
+                if member.isfile():
+                    yield member.name, functools.partial(archive.extractfile, member)
+    else:
+        opener = {'gzip': gzip.open, 'bz2': bz2 and bz2.open, 'xz': lzma and lzma.open}[kind]
+        name = os.path.basename(filepath)
+        yield os.path.splitext(name)[0], functools.partial(opener, filepath, 'rb')
+
+def search_archive_member(path, open_member, compiled_pattern,
+                          max_match_length=DEFAULT_MAX_MATCH_LENGTH, boundary='lines',
+                          with_spans=False, max_count=None, context_lines=None):
+    """
+    Search one archive member the way stream_regex_file searches a large
+    file: decompressed and decoded a chunk at a time (iter_stream_windows).
+    The encoding is detected from the first bytes; binary members are passed
+    over. Returns a result dict like process_file's for `path` (archive!member)
+    with status 'matched', 'no-match', 'binary' or 'unreadable', and 'spans'
+    (character offsets) and 'context' as requested.
+    """
+    result = {
+        'path': path,
+        'status': None,
+        'encoding': None,
+        'matches': None,
+        'error': None,
+        'stat': None,
+    }
+    if context_lines is not None:
+        with_spans = True
+    try:
+        stream = open_member()
+        head = stream.peek(SNIFF_BYTES)[:SNIFF_BYTES]
+        if looks_binary(head[:BINARY_SNIFF_BYTES]):
+            stream.close()
+            result['status'] = 'binary'
+            return result
+        for enc in encoding_fallbacks(detect_encoding(head)):
+            if stream is None:
+                # Only after a decoding failure: start the member over
+                stream = open_member()
+            spans = [] if with_spans else None
+            try:
+                with io.TextIOWrapper(stream, encoding=enc) as reader:
+                    windows = iter_stream_windows(
+                        reader, compiled_pattern,
+                        max_match_length=max_match_length,
+                        boundary=boundary
+                    )
+                    matches = match_windows(windows, spans, max_count)
+            except UnicodeDecodeError:
+                stream = None
+                continue
+            result['encoding'] = enc
+            break
+        else:
+            result['status'] = 'unreadable'
+            return result
+        if spans and context_lines is not None:
+            # A second pass over the member, as for streamed files
+            with io.TextIOWrapper(open_member(), encoding=result['encoding']) as reader:
+                found = collect_line_context(reader, [s[2] for s in spans], context_lines)
+            result['context'] = [found[s[2]] for s in spans]
+    except Exception as e:
+        result['status'] = 'unreadable'
+        result['error'] = str(e)
+        return result
+
+    if spans is not None:
+        result['spans'] = spans
+        result['offsets'] = 'chars'
+    result['status'] = 'matched' if matches else 'no-match'
+    result['matches'] = matches or None
+    return result
+
+def process_archive(result, filepath, kind, compiled_pattern, **member_options):
+    """
+    Archive branch of process_file ('match' mode): search every member with
+    search_archive_member (member_options are its keyword arguments). Adds
+    'members', the results of the members that matched or could not be read,
+    each with an archive!member path. The archive's own status is 'matched'
+    if any member matched, else 'unreadable' if the archive or a member
+    could not be read, else 'no-match'.
+    """
+    members = []
+    try:
+        for name, open_member in iter_archive_members(filepath, kind):
+            member = search_archive_member(
+                f"{filepath}{ARCHIVE_MEMBER_SEPARATOR}{name}", open_member, compiled_pattern,
+                **member_options
+            )
+            if member['status'] in ('matched', 'unreadable'):
+                members.append(member)
+    except Exception as e:
+        result['status'] = 'unreadable'
+        result['error'] = str(e)
+        return result
+    result['members'] = members
+    if any(m['status'] == 'matched' for m in members):
+        result['status'] = 'matched'
+    elif members:
+        result['status'] = 'unreadable'
+        result['error'] = members[0]['error']
+    else:
+        result['status'] = 'no-match'
+    return result
+
+def iter_member_results(result):
+    """Yield the member results of an archive result (process_archive), or the result itself."""
+    if result.get('members'):
+        yield from result['members']
+    else:
+        yield result
+
+def is_bytes_safe(parsed, ascii_flag=False):
+    """
+    Return True if a parsed (sre_parse) pattern matches exactly the same text
+    whether it runs on a decoded str or on the raw bytes of an ASCII-compatible
+    file (UTF-8, cp1252, ISO-8859-1).
+
+    That holds when every character the pattern can consume is a plain ASCII
+    literal or ASCII range: multi-byte UTF-8 sequences only use bytes >= 0x80,
+    so they can never be matched half-way. Anything whose meaning depends on
+    str vs bytes ('.', negated sets, \\w/\\d/\\s, \\b, IGNORECASE) is rejected,
+    as are '\\r', '\\n' and '$', which see different line endings in the raw
+    bytes than in text read with universal newlines. Under the ASCII flag
+    ((?a) or (?a:...)), \\d, \\w and \\b mean the same thing on str and bytes,
+    so they are allowed.
+    """
+    repeat_ops = (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT,
+                  getattr(sre_parse, 'POSSESSIVE_REPEAT', None))
+    safe_anchors = (sre_parse.AT_BEGINNING, sre_parse.AT_BEGINNING_STRING,
+                    sre_parse.AT_END_STRING)
+    unsafe_flags = sre_parse.SRE_FLAG_IGNORECASE | sre_parse.SRE_FLAG_LOCALE
+    if ascii_flag:
+        safe_categories = (sre_parse.CATEGORY_DIGIT, sre_parse.CATEGORY_WORD)
+        safe_anchors += (sre_parse.AT_BOUNDARY, sre_parse.AT_NON_BOUNDARY)
+    else:
+        safe_categories = ()
+
+    def safe_char(code):
+        return code < 0x80 and code not in (0x0A, 0x0D)
+
+    for op, av in parsed:
+        if op == sre_parse.LITERAL:
+            if not safe_char(av):
+                return False
+        elif op == sre_parse.IN:
+            for item_op, item_av in av:
+                if item_op == sre_parse.LITERAL:
+                    if not safe_char(item_av):
+                        return False
+                elif item_op == sre_parse.RANGE:
+                    low, high = item_av
+                    if high >= 0x80 or low <= 0x0D and high >= 0x0A:
+                        return False
+                elif item_op != sre_parse.CATEGORY or item_av not in safe_categories:
+                    return False  # NEGATE, or a category that differs on bytes
+        elif op == sre_parse.CATEGORY:
+            if av not in safe_categories:
+                return False
+        elif op in repeat_ops:
+            if not is_bytes_safe(av[2], ascii_flag):
+                return False
+        elif op == sre_parse.SUBPATTERN:
+            _, add_flags, _, subpattern = av
+            if add_flags & unsafe_flags:
+                return False
+            scoped_ascii = ascii_flag or bool(add_flags & sre_parse.SRE_FLAG_ASCII)
+            if not is_bytes_safe(subpattern, scoped_ascii):
+                return False
+        elif op == sre_parse.BRANCH:
+            if not all(is_bytes_safe(branch, ascii_flag) for branch in av[1]):
+                return False
+        elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            if not is_bytes_safe(av[1], ascii_flag):
+                return False
+        elif op == getattr(sre_parse, 'ATOMIC_GROUP', None):
+            if not is_bytes_safe(av, ascii_flag):
+                return False
+        elif op == sre_parse.GROUPREF_EXISTS:
+            _, yes_branch, no_branch = av
+            if not is_bytes_safe(yes_branch, ascii_flag):
+                return False
+            if no_branch is not None and not is_bytes_safe(no_branch, ascii_flag):
+                return False
+        elif op == sre_parse.AT:
+            if av not in safe_anchors:
+                return False
+        elif op != sre_parse.GROUPREF:
+            return False
+    return True
+
+@functools.lru_cache(maxsize=64)
+def compile_bytes_pattern(match_pattern, flags=0):
+    """
+    Compile match_pattern with flags for searching raw file bytes (see is_bytes_safe).
+    Returns None if the pattern cannot be searched as bytes without changing
+    its results, in which case the caller should decode the file instead.
+    """
+    if not match_pattern.isascii():
+        return None
+    try:
+        parsed = sre_parse.parse(match_pattern, flags)
+    except re.error:
+        return None
+    state = getattr(parsed, 'state', None) or parsed.pattern
+    # With MULTILINE, '^' would also have to match after a lone '\r', which
+    # universal newlines turn into a line end in the decoded text
+    unsafe_flags = sre_parse.SRE_FLAG_IGNORECASE | sre_parse.SRE_FLAG_LOCALE | sre_parse.SRE_FLAG_MULTILINE
+    if state.flags & unsafe_flags:
+        return None
+    if not is_bytes_safe(parsed, bool(state.flags & sre_parse.SRE_FLAG_ASCII)):
+        return None
+    # A pattern that can match the empty string matches between every two
+    # bytes, so it would find extra matches inside multi-byte characters
+    if parsed.getwidth()[0] == 0:
+        return None
+    try:
+        return re.compile(match_pattern.encode('ascii'), flags)
+    except re.error:
+        return None
+
+# A carriage return that is a line break of its own (old Mac line endings)
+LONE_CR = re.compile(rb'\r(?!\n)')
+
+def mmap_match_file(filepath, bytes_pattern, encoding=None, spans=None, max_count=None,
+                    context=None, context_lines=0):
+    """
+    Search a file for bytes_pattern (from compile_bytes_pattern) through a
+    read-only memory map, without reading or decoding the file as a whole.
+    The encoding is taken from `encoding` or detected from the first bytes.
+    Returns (encoding, list_of_matches), or (encoding, None) if the file is
+    not ASCII-compatible and has to go through the decoding path instead;
+    so do files with lone '\r' line breaks when spans are wanted, since
+    lines are counted at b'\n' here but at any line break when decoding.
+    Only the matched spans are decoded; they are ASCII by construction.
+    If a spans list is given, a (start, end, line, column) tuple is appended
+    for every match: start/end are byte offsets, the column counts characters.
+    If a context list is given (this needs spans too), a line_context() tuple
+    with context_lines lines around the match is appended for every match.
+    Only the first max_count matches are taken (None = all).
+    """
+    with open(filepath, 'rb') as f:
+        if encoding is None:
+            encoding = detect_encoding(f.read(SNIFF_BYTES))
+        if encoding not in ASCII_COMPATIBLE_ENCODINGS:
+            return encoding, None
+        if os.fstat(f.fileno()).st_size == 0:
+            return encoding, []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if spans is not None and mapped.find(b'\r') != -1 and LONE_CR.search(mapped):
+                return encoding, None
+            matches = []
+            line = 1
+            line_start = 0
+            position = 0
+            for match in itertools.islice(bytes_pattern.finditer(mapped), max_count):
+                value = findall_value(match)
+                if isinstance(value, tuple):
+                    matches.append(tuple(group.decode('ascii') for group in value))
+                else:
+                    matches.append(value.decode('ascii'))
+                if spans is None:
+                    continue
+                newlines = count_newlines(mapped, position, match.start())
+                if newlines:
+                    line += newlines
+                    line_start = mapped.rfind(b'\n', position, match.start()) + 1
+                position = match.start()
+                column = len(mapped[line_start:match.start()].decode(encoding, 'replace')) + 1
+                spans.append((match.start(), match.end(), line, column))
+                if context is not None:
+                    context.append(bytes_line_context(mapped, line_start, encoding, context_lines))
+            return encoding, matches
+
+def required_literal_sets(parsed):
+    """
+    Collect the literal text a parsed (sre_parse) pattern cannot match without.
+    Returns a list of requirements; each is a tuple of alternative strings of
+    which any match must contain at least one (a plain literal is a 1-tuple,
+    an alternation like 'ERROR|FATAL' yields ('ERROR', 'FATAL')).
+    Optional parts (repeats with a minimum of 0, negative lookarounds) and
+    case-insensitive groups contribute nothing.
+    """
+    repeat_ops = (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT,
+                  getattr(sre_parse, 'POSSESSIVE_REPEAT', None))
+    unsafe_flags = sre_parse.SRE_FLAG_IGNORECASE | sre_parse.SRE_FLAG_LOCALE
+    requirements = []
+    run = []
+
+    def flush():
+        if run:
+            requirements.append((''.join(run),))
+            run.clear()
+
+    for op, av in parsed:
+        if op == sre_parse.LITERAL:
+            run.append(chr(av))
+            continue
+        flush()
+        if op == sre_parse.SUBPATTERN:
+            _, add_flags, _, subpattern = av
+            if not add_flags & unsafe_flags:
+                requirements.extend(required_literal_sets(subpattern))
+        elif op in repeat_ops:
+            min_count, _, subpattern = av
+            if min_count >= 1:
+                requirements.extend(required_literal_sets(subpattern))
+        elif op == sre_parse.ASSERT:
+            requirements.extend(required_literal_sets(av[1]))
+        elif op == getattr(sre_parse, 'ATOMIC_GROUP', None):
+            requirements.extend(required_literal_sets(av))
+        elif op == sre_parse.BRANCH:
+            # Every branch must require something; take each branch's best literal
+            alternatives = []
+            for branch in av[1]:
+                branch_sets = required_literal_sets(branch)
+                if not branch_sets:
+                    alternatives = None
+                    break
+                alternatives.extend(max(branch_sets, key=lambda alts: min(map(len, alts))))
+            if alternatives:
+                requirements.append(tuple(dict.fromkeys(alternatives)))
+    flush()
+    return requirements
+
+@functools.lru_cache(maxsize=64)
+def extract_required_literals(match_pattern, flags=0):
+    """
+    Return the strongest required-literal sets of match_pattern under flags (see
+    required_literal_sets), longest first, or [] if nothing can be relied on.
+    Literals are cut at CR/LF, since line endings in the raw bytes may differ
+    from the decoded text.
+    """
+    try:
+        parsed = sre_parse.parse(match_pattern, flags)
+    except re.error:
+        return []
+    state = getattr(parsed, 'state', None) or parsed.pattern
+    if state.flags & (sre_parse.SRE_FLAG_IGNORECASE | sre_parse.SRE_FLAG_LOCALE):
+        return []
+
+    requirements = []
+    for alternatives in required_literal_sets(parsed):
+        pieces = tuple(max(re.split('[\r\n]', alt), key=len) for alt in alternatives)
+        if all(pieces):
+            requirements.append(pieces)
+    requirements.sort(key=lambda alts: min(map(len, alts)), reverse=True)
+    return requirements[:MAX_PREFILTER_LITERALS]
+
+@functools.lru_cache(maxsize=256)
+def literal_searchers(match_pattern, encoding, flags=0):
+    """
+    Encode the required literals of match_pattern the way they would appear
+    in the raw bytes of a file in `encoding` (or any encoding it may fall
+    back to when decoding). Each requirement becomes either a bytes literal
+    for bytes.find, or, with several variants, one compiled alternation that
+    finds any of them in a single pass.
+    """
+    byte_encodings = []
+    for enc in encoding_fallbacks(encoding):
+        if enc == 'utf-16':
+            byte_encodings.extend(['utf-16-le', 'utf-16-be'])
+        elif enc == 'utf-8-sig':
+            byte_encodings.append('utf-8')
+        else:
+            byte_encodings.append(enc)
+
+    searchers = []
+    for alternatives in extract_required_literals(match_pattern, flags):
+        variants = set()
+        for alt in alternatives:
+            for enc in byte_encodings:
+                try:
+                    variants.add(alt.encode(enc))
+                except UnicodeEncodeError:
+                    pass
+        if len(variants) == 1:
+            searchers.append(variants.pop())
+        elif variants:
+            searchers.append(re.compile(b'|'.join(re.escape(v) for v in sorted(variants))))
+    return searchers
+
+def file_may_match(filepath, match_pattern, encoding=None, flags=0):
+    """
+    Cheap check, before any decoding or regex work, that the raw bytes of the
+    file contain every required literal of match_pattern.
+    The file is scanned through a memory map; its encoding (needed to know
+    how the literals are encoded) is taken from `encoding` or detected.
+    Returns (may_match, encoding); may_match is False only if the pattern
+    definitely cannot match.
+    """
+    with open(filepath, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return False, encoding or detect_encoding(b'')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if encoding is None:
+                encoding = detect_encoding(mapped[:SNIFF_BYTES])
+            for searcher in literal_searchers(match_pattern, encoding, flags):
+                if isinstance(searcher, bytes):
+                    found = mapped.find(searcher) != -1
+                else:
+                    found = searcher.search(mapped) is not None
+                if not found:
+                    return False, encoding
+    return True, encoding
+
+def give_up_after_timeout(function):
+    """
+    Make process_file give up on a file once one of its searches runs past
+    its match_timeout keyword argument (seconds, see limit_pattern),
+    returning a 'timeout' result instead.
+    """
+    @functools.wraps(function)
+    def wrapper(filepath, *args, **kwargs):
+        seconds = kwargs.get('match_timeout')
+        if not seconds:
+            return function(filepath, *args, **kwargs)
+        try:
+            with match_watchdog():
+                return function(filepath, *args, **kwargs)
+        except MatchTimeout as e:
+            return {
+                'path': filepath,
+                'status': 'timeout',
+                'encoding': None,
+                'matches': None,
+                'error': str(e),
+                'stat': None,
+            }
+    return wrapper
+
+@give_up_after_timeout
+def process_file(filepath, match_pattern, mode, replace_pattern, flags=0, engine='re',
+                 stream_threshold=DEFAULT_STREAM_THRESHOLD,
+                 max_match_length=DEFAULT_MAX_MATCH_LENGTH, boundary='lines',
+                 use_mmap=True, use_prefilter=True, encoding_hint=None, rules=None,
+                 with_spans=False, preserve_mtime=False, journal_dir=None, defer_write=False,
+                 dry_run=None, match_timeout=None, max_count=None, context_lines=None,
+                 search_archives=True):
+    """
+    Read, match and (for 'invert'/'replace') rewrite a single file.
+    match_pattern is compiled with flags on the given engine (see compile_pattern);
+    the literal prefilter and byte-level search only apply to stdlib 're'.
+    With match_timeout (seconds) the file is abandoned with status 'timeout'
+    once a single search takes that long (give_up_after_timeout); reading and
+    writing the file are not timed and never interrupted.
+    With a rule set (rules, see load_rules) the pattern arguments are ignored
+    and the file is handled by process_file_rules instead.
+    In 'match' and 'replace' mode with use_prefilter, files whose raw bytes
+    lack a literal the pattern requires are rejected up front (file_may_match).
+    encoding_hint is a cached (size, mtime_ns, encoding) entry for the file;
+    if the file still has that size and mtime, encoding detection is skipped.
+    In 'match' mode with use_mmap, patterns that compile_bytes_pattern accepts
+    are searched directly on a memory map of the file (mmap_match_file).
+    Otherwise files larger than stream_threshold bytes (None = never) are
+    handled by stream_regex_file using max_match_length and boundary.
+    with_spans additionally records where each match is ('match' mode only).
+    In 'match' mode, only the first max_count matches of a file are taken,
+    and with context_lines (implies with_spans) each match also carries its
+    line and that many lines around it, like grep -C.
+    In 'match' mode with search_archives, archives and compressed files
+    (archive_kind) are searched member by member (process_archive). Other
+    modes and rule sets never touch them: they would have to be rewritten.
+    Rewritten files are replaced atomically (write_back / commit_temp_file),
+    optionally keeping their mtime and backing them up to journal_dir.
+    With defer_write, in-memory rewrites are not written but returned as
+    'pending-write' for finish_deferred_write, so a writer thread can do it.
+    With dry_run ('stats' or 'diff'), 'invert'/'replace' (and rule sets) only
+    report what would change and leave the file alone; streamed files get
+    statistics but no diff.
+
+    This is the unit of work handed to the worker pool, so it only takes and
+    returns plain picklable data. The result is a dict with:
+      - 'path':     the file that was processed
+      - 'status':   'missing', 'unreadable', 'regex-error', 'prefiltered',
+                    'matched', 'no-match', 'modified', 'unchanged',
+                    'no-permission', 'write-error', 'timeout', 'pending-write',
+                    'archive' (left alone, see search_archives) or (dry runs) 'would-modify'
+      - 'encoding': the encoding the file was read with (or None)
+      - 'matches':  the list of matches ('match' mode only)
+      - 'error':    error text for 'write-error'
+      - 'stat':     (size, mtime_ns) of the file after processing, for caching
+      - 'size':     the file's size in bytes before processing
+      - 'members':  archives only, per-member results (see process_archive)
+      - 'rule_hits', 'rule_matches': rule sets only, see process_file_rules
+      - 'spans':    with_spans only, a (start, end, line, column) tuple per
+                    match; lines and columns are 1-based
+      - 'offsets':  with_spans only, whether start/end count 'chars' or 'bytes'
+      - 'context':  context_lines only, a (before, line, after) tuple per
+                    match: the matching line and lists of lines around it
+      - 'changes':  dry runs only, substitution and byte counts (new_change_stats)
+      - 'diff':     dry_run='diff' only, the unified diff as a list of lines
+      - 'timings':  seconds spent per stage ('read', 'decode', 'match', 'write');
+                    the byte-level search and streamed files read and decode
+                    as they match, so all of that counts as 'match' there
+    """
+    result = {
+        'path': filepath,
+        'status': None,
+        'encoding': None,
+        'matches': None,
+        'error': None,
+        'stat': None,
+        'timings': {},
+    }
+    timings = result['timings']
+    clock = time.perf_counter()
+
+    try:
+        file_stat = os.stat(filepath)
+    except OSError:
+        file_stat = None
+    if file_stat is None or not stat.S_ISREG(file_stat.st_mode):
+        result['status'] = 'missing'
+        return result
+    result['stat'] = (file_stat.st_size, file_stat.st_mtime_ns)
+    result['size'] = file_stat.st_size
+
+    known_encoding = None
+    if encoding_hint is not None and tuple(encoding_hint[:2]) == result['stat']:
+        known_encoding = encoding_hint[2]
+
+    kind = archive_kind(filepath)
+    if kind is not None and (rules is not None or mode != 'match'):
+        result['status'] = 'archive'
+        return result
+
+    write_options = {
+        'preserve_mtime': preserve_mtime,
+        'journal_dir': journal_dir,
+        'defer_write': defer_write,
+    }
+    if rules is not None:
+        return process_file_rules(result, filepath, rules, known_encoding, write_options,
+                                  dry_run, flags, engine, match_timeout)
+
+    try:
+        compiled_pattern = compile_pattern(match_pattern, flags, engine)
+    except re.error as e:
+        result['status'] = 'regex-error'
+        result['error'] = str(e)
+        return result
+    resolved_engine = resolve_engine(match_pattern, flags, engine)
+    compiled_pattern = limit_pattern(compiled_pattern, match_timeout, resolved_engine)
+    # The byte-level helpers parse patterns with the stdlib parser, which
+    # does not know the other engines' syntax
+    stdlib_engine = resolved_engine == 're'
+
+    if kind is not None and search_archives:
+        process_archive(
+            result, filepath, kind, compiled_pattern,
+            max_match_length=max_match_length,
+            boundary=boundary,
+            with_spans=with_spans,
+            max_count=max_count,
+            context_lines=context_lines
+        )
+        add_stage_time(timings, 'match', clock)
+        return result
+
+    # 'invert' rewrites files without matches too, so it cannot skip them
+    if (use_prefilter and stdlib_engine and mode in ('match', 'replace')
+            and extract_required_literals(match_pattern, flags)):
+        try:
+            may_match, known_encoding = file_may_match(filepath, match_pattern, known_encoding, flags)
+        except (OSError, ValueError):
+            may_match = True
+        clock = add_stage_time(timings, 'read', clock)
+        if not may_match:
+            result['encoding'] = known_encoding
+            result['status'] = 'prefiltered'
+            return result
+
+    bytes_pattern = None
+    if mode == 'match' and use_mmap and stdlib_engine:
+        bytes_pattern = compile_bytes_pattern(match_pattern, flags)
+        if bytes_pattern is not None:
+            bytes_pattern = limit_pattern(bytes_pattern, match_timeout, 're')
+    if context_lines is not None:
+        with_spans = True
+    if bytes_pattern is not None:
+        spans = [] if with_spans else None
+        context = [] if context_lines is not None else None
+        try:
+            used_encoding, matches = mmap_match_file(filepath, bytes_pattern, known_encoding, spans,
+                                                     max_count, context, context_lines)
+        except (OSError, ValueError):
+            used_encoding, matches = None, None
+        clock = add_stage_time(timings, 'match', clock)
+        if matches is not None:
+            if with_spans:
+                result['spans'] = spans
+                result['offsets'] = 'bytes'
+            if context is not None:
+                result['context'] = context
+            result['encoding'] = used_encoding
+            result['status'] = 'matched' if matches else 'no-match'
+            result['matches'] = matches or None
+            return result
+
+    if stream_threshold is not None and file_stat.st_size > stream_threshold:
+        used_encoding = known_encoding
+        try:
+            if used_encoding is None:
+                with open(filepath, 'rb') as f:
+                    used_encoding = detect_encoding(f.read(SNIFF_BYTES))
+            # Detection only saw the start of the file; if the stream turns out
+            # not to decode, start over with the next candidate encoding.
+            for enc in encoding_fallbacks(used_encoding):
+                spans = [] if with_spans and mode == 'match' else None
+                stats = new_change_stats() if dry_run and mode != 'match' else None
+                try:
+                    temp_path, matches = stream_regex_file(
+                        filepath, compiled_pattern, mode, replace_pattern,
+                        encoding=enc,
+                        max_match_length=max_match_length,
+                        boundary=boundary,
+                        spans=spans,
+                        stats=stats,
+                        max_count=max_count if mode == 'match' else None
+                    )
+                    if spans and context_lines is not None:
+                        # A second pass, but only over the lines around the hits
+                        found = read_line_context(filepath, enc, [s[2] for s in spans], context_lines)
+                        result['context'] = [found[s[2]] for s in spans]
+                except UnicodeDecodeError:
+                    continue
+                result['encoding'] = enc
+                break
+            else:
+                result['status'] = 'unreadable'
+                return result
+        except PermissionError:
+            result['status'] = 'unreadable' if mode == 'match' else 'no-permission'
+            return result
+        except Exception as e:
+            result['status'] = 'unreadable' if mode == 'match' else 'write-error'
+            result['error'] = str(e)
+            return result
+        finally:
+            clock = add_stage_time(timings, 'match', clock)
+
+        if mode == 'match':
+            if spans is not None:
+                result['spans'] = spans
+                result['offsets'] = 'chars'
+            if context_lines is not None:
+                result.setdefault('context', [])
+            result['status'] = 'matched' if matches else 'no-match'
+            result['matches'] = matches or None
+            return result
+        if stats is not None:
+            result['changes'] = stats
+            result['diff'] = None
+            result['status'] = 'would-modify' if stats['substitutions'] else 'unchanged'
+            return result
+        if temp_path is None:
+            result['status'] = 'unchanged'
+            return result
+        try:
+            commit_temp_file(temp_path, filepath, preserve_mtime, journal_dir)
+            result['status'] = 'modified'
+            file_stat = os.stat(filepath)
+            result['stat'] = (file_stat.st_size, file_stat.st_mtime_ns)
+        except PermissionError:
+            result['status'] = 'no-permission'
+        except Exception as e:
+            result['status'] = 'write-error'
+            result['error'] = str(e)
+        add_stage_time(timings, 'write', clock)
+        return result
+
+    content, used_encoding = try_open_text_file(filepath, known_encoding, timings)
+    if content is None:
+        result['status'] = 'unreadable'
+        return result
+    result['encoding'] = used_encoding
+    clock = time.perf_counter()
+
+    if mode == 'match' and (with_spans or max_count is not None):
+        matches, result['spans'], context = locate_matches(content, compiled_pattern,
+                                                           max_count, context_lines)
+        result['offsets'] = 'chars'
+        if context is not None:
+            result['context'] = context
+        result['status'] = 'matched' if matches else 'no-match'
+        result['matches'] = matches or None
+        add_stage_time(timings, 'match', clock)
+        return result
+
+    if mode != 'match' and dry_run:
+        result['changes'], result['diff'] = dry_run_changes(
+            content, compiled_pattern, mode, replace_pattern, used_encoding,
+            filepath, with_diff=dry_run == 'diff'
+        )
+        add_stage_time(timings, 'match', clock)
+        result['status'] = 'would-modify' if result['changes']['substitutions'] else 'unchanged'
+        return result
+
+    updated_content, matches = regex_replace_and_store(
+        content=content,
+        compiled_pattern=compiled_pattern,
+        mode=mode,
+        replace_pattern=replace_pattern
+    )
+    add_stage_time(timings, 'match', clock)
+
+    if mode == 'match':
+        if matches is None:
+            result['status'] = 'regex-error'
+        elif matches:
+            result['status'] = 'matched'
+            result['matches'] = matches
+        else:
+            result['status'] = 'no-match'
+        return result
+
+    # 'invert' or 'replace'
+    if updated_content is None:
+        # Means a regex error or some unexpected error
+        result['status'] = 'regex-error'
+        return result
+    if updated_content == content:
+        result['status'] = 'unchanged'
+        return result
+    return write_updated(result, filepath, updated_content, used_encoding, **write_options)
+
+def create_temp_file(filepath):
+    """
+    mkstemp() for the rewritten contents of filepath, in the directory of the
+    file filepath really is (symlinks followed), as commit_temp_file needs.
+    Returns (fd, temp_path).
+    """
+    target = os.path.realpath(filepath)
+    return tempfile.mkstemp(
+        prefix=f".{os.path.basename(target)}.",
+        suffix='.tmp',
+        dir=os.path.dirname(target)
+    )
+
+def commit_temp_file(temp_path, filepath, preserve_mtime=False, journal_dir=None):
+    """
+    Atomically put a finished (already fsynced) temp file (create_temp_file)
+    in place of filepath. A symlink is followed, so its target is rewritten
+    and the link stays a link. The temp file is in the target's directory so
+    os.replace is a rename: readers see either the old or the new file, never
+    a truncated one. A file with several hard links is overwritten in place
+    instead, so all its names keep sharing the new contents (not atomic).
+    Permissions are copied over, and the access/modification times too with
+    preserve_mtime. With a journal_dir the original is backed up first
+    (backup_to_journal). The temp file is removed if anything fails.
+    """
+    target = os.path.realpath(filepath)
+    try:
+        original_stat = os.stat(target)
+        in_place = original_stat.st_nlink > 1
+        shutil.copymode(target, temp_path)
+        if journal_dir is not None:
+            backup_to_journal(target, journal_dir, copy=in_place)
+        if in_place:
+            shutil.copyfile(temp_path, target)
+            os.remove(temp_path)
+        else:
+            if preserve_mtime:
+                os.utime(temp_path, ns=(original_stat.st_atime_ns, original_stat.st_mtime_ns))
+            os.replace(temp_path, target)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    if in_place:
+        if preserve_mtime:
+            os.utime(target, ns=(original_stat.st_atime_ns, original_stat.st_mtime_ns))
+        with open(target, 'rb+') as f:
+            os.fsync(f.fileno())
+    else:
+        fsync_directory(os.path.dirname(target))
+
+def fsync_directory(dirpath):
+    """Make a rename in dirpath durable; not possible (nor needed) on Windows."""
+    if os.name == 'nt':
+        return
+    try:
+        fd = os.open(dirpath, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def write_back(result, filepath, updated_content, encoding, preserve_mtime=False, journal_dir=None):
+    """
+    Write updated_content to filepath and record the outcome in a process_file result.
+    The text goes to a temp file (create_temp_file), is fsynced, and then
+    replaces the original through commit_temp_file, so an interrupted run
+    never leaves a half-written file behind.
+    The time taken is added to the result's 'write' timing.
+    """
+    clock = time.perf_counter()
+    try:
+        fd, temp_path = create_temp_file(filepath)
+        try:
+            with open(fd, 'w', encoding=encoding) as out_file:
+                out_file.write(updated_content)
+                out_file.flush()
+                os.fsync(out_file.fileno())
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        commit_temp_file(temp_path, filepath, preserve_mtime, journal_dir)
+        result['status'] = 'modified'
+        file_stat = os.stat(filepath)
+        result['stat'] = (file_stat.st_size, file_stat.st_mtime_ns)
+    except PermissionError:
+        result['status'] = 'no-permission'
+    except Exception as e:
+        result['status'] = 'write-error'
+        result['error'] = str(e)
+    add_stage_time(result.setdefault('timings', {}), 'write', clock)
+    return result
+
+def finish_deferred_write(result, preserve_mtime=False, journal_dir=None):
+    """Carry out the write a process_file(..., defer_write=True) result is waiting for."""
+    updated_content, encoding = result.pop('pending_write')
+    return write_back(result, result['path'], updated_content, encoding, preserve_mtime, journal_dir)
+
+def write_updated(result, filepath, updated_content, encoding,
+                  preserve_mtime=False, journal_dir=None, defer_write=False):
+    """write_back, or with defer_write leave the write to the caller ('pending-write', see finish_deferred_write)."""
+    if defer_write:
+        result['status'] = 'pending-write'
+        result['pending_write'] = (updated_content, encoding)
+        return result
+    return write_back(result, filepath, updated_content, encoding, preserve_mtime, journal_dir)
+
+def process_file_rules(result, filepath, rules, encoding=None, write_options=None, dry_run=None,
+                       flags=0, engine='re', match_timeout=None):
+    """
+    Rule-set branch of process_file: read and decode the file once, run every
+    rule over it in memory (apply_rules) and write it back at most once.
+    Adds 'rule_hits' (match count per rule) and 'rule_matches' (index of
+    'match' rule -> matches) to the result.
+    write_options holds process_file's preserve_mtime, journal_dir and defer_write.
+    With dry_run the file is left alone and 'changes' (and for 'diff' the
+    unified diff) describe what the rules would do instead.
+    flags, engine and match_timeout apply to every rule (see apply_rules).
+    """
+    timings = result.setdefault('timings', {})
+    content, used_encoding = try_open_text_file(filepath, encoding, timings)
+    if content is None:
+        result['status'] = 'unreadable'
+        return result
+    result['encoding'] = used_encoding
+
+    clock = time.perf_counter()
+    rule_edits = [] if dry_run else None
+    try:
+        updated_content, rule_matches, rule_hits = apply_rules(content, rules, flags, engine, rule_edits,
+                                                               match_timeout)
+    except re.error as e:
+        updated_content, rule_matches, rule_hits = None, None, None
+        result['error'] = str(e)
+    clock = add_stage_time(timings, 'match', clock)
+    if updated_content is None:
+        result['status'] = 'regex-error'
+        return result
+    result['rule_hits'] = rule_hits
+    result['rule_matches'] = rule_matches or None
+
+    if dry_run:
+        result['changes'] = rule_edits_stats(rule_edits, used_encoding)
+        result['diff'] = None
+        if updated_content != content and dry_run == 'diff':
+            result['diff'] = rule_edits_diff(content, updated_content, rule_edits, filepath)
+        add_stage_time(timings, 'match', clock)
+        if updated_content != content:
+            result['status'] = 'would-modify'
+            return result
+    elif updated_content != content:
+        return write_updated(result, filepath, updated_content, used_encoding, **(write_options or {}))
+    if all(mode == 'match' for _, _, mode in rules):
+        result['status'] = 'matched' if rule_matches else 'no-match'
+    else:
+        result['status'] = 'unchanged'
+    return result
+
+def user_cache_dir():
+    """Return the per-user cache directory for this tool (created on demand)."""
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+        return os.path.join(base, 'RegexUtility', 'Cache')
+    if sys.platform == 'darwin':
+        return os.path.expanduser('~/Library/Caches/RegexUtility')
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'regex-utility')
+
+def default_cache_path():
+    """Return the location of the persistent 'match' result cache."""
+    return os.path.join(user_cache_dir(), 'results.sqlite3')
+
+def create_journal(root=None):
+    """
+    Create an empty undo journal for one run and return its directory
+    (under root, by default the 'journal' folder of the user cache directory).
+    Journals there older than JOURNAL_MAX_AGE are removed (prune_journals).
+    """
+    root = root or os.path.join(user_cache_dir(), 'journal')
+    os.makedirs(root, exist_ok=True)
+    prune_journals(root)
+    return tempfile.mkdtemp(prefix=time.strftime('%Y%m%d-%H%M%S-'), dir=root)
+
+def prune_journals(root, max_age=JOURNAL_MAX_AGE):
+    """Remove the journals under root last changed more than max_age seconds ago."""
+    cutoff = time.time() - max_age
+    try:
+        entries = list(os.scandir(root))
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False) and entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError:
+            continue
+
+def backup_to_journal(filepath, journal_dir, copy=False):
+    """
+    Keep the current contents of filepath in journal_dir and append it to the
+    journal's manifest. A hard link is enough since the file is about to be
+    replaced by a new one rather than overwritten; if linking is not
+    possible, or with copy (the file is about to be overwritten in place),
+    the file is copied. Safe to call from several processes.
+    """
+    backup_name = f"{os.getpid()}-{time.monotonic_ns()}-{os.path.basename(filepath)}"
+    backup_path = os.path.join(journal_dir, backup_name)
+    try:
+        if copy:
+            raise OSError('copy requested')
+        os.link(filepath, backup_path)
+    except OSError:
+        shutil.copy2(filepath, backup_path)
+    entry = {'path': os.path.abspath(filepath), 'backup': backup_name}
+    if copy:
+        entry['in_place'] = True  # to be put back in place too, see undo_journal
+    entry = json.dumps(entry) + '\n'
+    # A single O_APPEND write keeps lines from concurrent workers intact
+    fd = os.open(os.path.join(journal_dir, 'manifest.jsonl'), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+    try:
+        os.write(fd, entry.encode('utf-8'))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def undo_journal(journal_dir):
+    """
+    Put back every file recorded in a journal (create_journal), newest first,
+    each one atomically, except files that were overwritten in place
+    (several hard links, see commit_temp_file), which are overwritten in
+    place again so their links stay shared. Returns (restored_paths,
+    failures) where failures is a list of (path, error_text).
+    """
+    manifest_path = os.path.join(journal_dir, 'manifest.jsonl')
+    entries = []
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue  # a line cut short by a crash
+    restored = []
+    failures = []
+    for entry in reversed(entries):
+        filepath = entry['path']
+        backup_path = os.path.join(journal_dir, entry['backup'])
+        if entry.get('in_place'):
+            try:
+                shutil.copyfile(backup_path, filepath)
+                with open(filepath, 'rb+') as f:
+                    os.fsync(f.fileno())
+                restored.append(filepath)
+            except OSError as e:
+                failures.append((filepath, str(e)))
+            continue
+        try:
+            fd, temp_path = tempfile.mkstemp(
+                prefix=f".{os.path.basename(filepath)}.",
+                suffix='.tmp',
+                dir=os.path.dirname(filepath)
+            )
+            os.close(fd)
+            try:
+                shutil.copy2(backup_path, temp_path)
+                with open(temp_path, 'rb+') as f:
+                    os.fsync(f.fileno())
+                os.replace(temp_path, filepath)
+            except BaseException:
+                os.remove(temp_path)
+                raise
+            restored.append(filepath)
+        except OSError as e:
+            failures.append((filepath, str(e)))
+    return restored, failures
+
+class ResultCache:
+    """
+    Persistent 'match' mode results, stored in SQLite and keyed on
+    (path, size, mtime_ns, pattern, flags, mode, engine, max_count, options), so unchanged
+    files do not have to be read or matched again on the next run with the same pattern.
+    options are the process_file arguments that decide how a file is searched
+    and so the shape of its result (stream_threshold, boundary, use_mmap:
+    character or byte offsets, how lines are counted).
+
+    One instance serves one run (pattern, flags, mode, engine, max_count,
+    options and context_lines are fixed) and must
+    be used from the thread that created it. Least recently used entries
+    are evicted on close() once the cache exceeds max_entries rows or
+    max_bytes of stored matches.
+    """
+    def __init__(self, cache_path, match_pattern, flags, mode, engine='re', max_count=None,
+                 context_lines=None, options=None, max_entries=RESULT_CACHE_MAX_ENTRIES,
+                 max_bytes=RESULT_CACHE_MAX_BYTES):
+        self.match_pattern = match_pattern
+        self.flags = flags
+        self.mode = mode
+        self.engine = engine
+        # Part of the primary key, where NULLs would never compare equal
+        self.max_count = -1 if max_count is None else max_count
+        self.key = (match_pattern, flags, mode, engine, self.max_count,
+                    json.dumps(options or {}, sort_keys=True))
+        self.context_lines = context_lines
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.touched = []
+        self.pending_writes = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        self.connection = sqlite3.connect(cache_path, timeout=5)
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version != RESULT_CACHE_VERSION:
+            # Results from an older layout or older matching rules are not reusable
+            self.connection.execute("DROP TABLE IF EXISTS results")
+            self.connection.execute(f"PRAGMA user_version = {RESULT_CACHE_VERSION}")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " path TEXT, pattern TEXT, flags INTEGER, mode TEXT, engine TEXT, max_count INTEGER, options TEXT,"
+            " size INTEGER, mtime_ns INTEGER, status TEXT, encoding TEXT,"
+            " matches TEXT, spans TEXT, offsets TEXT, context TEXT, context_lines INTEGER,"
+            " bytes INTEGER, last_used REAL,"
+            " PRIMARY KEY (path, pattern, flags, mode, engine, max_count, options))"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS results_lru ON results (last_used)")
+        self.connection.commit()
+
+    def get(self, filepath, with_spans=False):
+        """
+        Return the cached result dict for filepath if the file is unchanged, else None.
+        With with_spans, entries stored without match positions count as misses;
+        when the run wants context lines, so do entries stored with a different amount.
+        """
+        try:
+            file_stat = os.stat(filepath)
+        except OSError:
+            return None
+        row = self.connection.execute(
+            "SELECT size, mtime_ns, status, encoding, matches, spans, offsets, context, context_lines"
+            " FROM results WHERE path = ? AND pattern = ? AND flags = ? AND mode = ? AND engine = ?"
+            " AND max_count = ? AND options = ?",
+            (filepath,) + self.key
+        ).fetchone()
+        if row is None or (row[0], row[1]) != (file_stat.st_size, file_stat.st_mtime_ns):
+            return None
+        context_lines = self.context_lines
+        if context_lines is not None:
+            with_spans = True
+            if row[4] is not None and row[8] != context_lines:
+                return None
+        if with_spans and row[4] is not None and row[5] is None:
+            return None
+
+        self.touched.append(filepath)
+        matches = json.loads(row[4]) if row[4] is not None else None
+        if matches is not None:
+            # JSON turns the tuples of multi-group matches into lists
+            matches = [tuple(m) if isinstance(m, list) else m for m in matches]
+        result = {
+            'path': filepath,
+            'status': row[2],
+            'encoding': row[3],
+            'matches': matches,
+            'error': None,
+            'stat': (row[0], row[1]),
+            'cached': True,
+        }
+        if with_spans:
+            result['spans'] = [tuple(s) for s in json.loads(row[5])] if row[5] is not None else []
+            result['offsets'] = row[6]
+        if context_lines is not None:
+            context = json.loads(row[7]) if row[7] is not None else []
+            result['context'] = [tuple(c) for c in context]
+        return result
+
+    def put(self, result):
+        """Store a fresh process_file result (only final 'match' outcomes of plain files are kept)."""
+        if result['status'] not in ('matched', 'no-match', 'prefiltered') or not result.get('stat'):
+            return
+        if 'members' in result or archive_kind(result['path']) is not None:
+            # How an archive is searched depends on the run's search_archives,
+            # which is not part of the key
+            return
+        matches = json.dumps(result['matches']) if result['matches'] is not None else None
+        spans = json.dumps(result['spans']) if result.get('spans') else None
+        context = json.dumps(result['context']) if result.get('context') else None
+        context_lines = self.context_lines if context is not None else None
+        size, mtime_ns = result['stat']
+        self.connection.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (result['path'],) + self.key + (
+             size, mtime_ns, result['status'], result['encoding'],
+             matches, spans, result.get('offsets'), context, context_lines,
+             len(matches or '') + len(spans or '') + len(context or ''), time.time())
+        )
+        self.pending_writes += 1
+        if self.pending_writes >= RESULT_CACHE_COMMIT_EVERY:
+            self.connection.commit()
+            self.pending_writes = 0
+
+    def evict(self):
+        """Drop least recently used entries until the cache is within its limits."""
+        count, total_bytes = self.connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM results"
+        ).fetchone()
+        if count <= self.max_entries and total_bytes <= self.max_bytes:
+            return
+        doomed = []
+        for rowid, row_bytes in self.connection.execute(
+                "SELECT rowid, bytes FROM results ORDER BY last_used"):
+            if count <= self.max_entries and total_bytes <= self.max_bytes:
+                break
+            doomed.append((rowid,))
+            count -= 1
+            total_bytes -= row_bytes
+        self.connection.executemany("DELETE FROM results WHERE rowid = ?", doomed)
+
+    def close(self):
+        """Record which entries were used, evict, and commit."""
+        try:
+            now = time.time()
+            self.connection.executemany(
+                "UPDATE results SET last_used = ?"
+                " WHERE path = ? AND pattern = ? AND flags = ? AND mode = ? AND engine = ?"
+                " AND max_count = ? AND options = ?",
+                [(now, path) + self.key for path in self.touched]
+            )
+            self.evict()
+            self.connection.commit()
+        finally:
+            self.connection.close()
+
+def iter_file_results(file_paths, match_pattern, mode, replace_pattern,
+                      workers=None, cancel_event=None, cache_path=None,
+                      force_rescan=False, write_workers=DEFAULT_WRITE_WORKERS,
+                      **file_options):
+    """
+    Run process_file over file_paths and yield each result dict.
+    Extra keyword arguments (stream_threshold, ...) are passed on to process_file.
+
+    With workers > 1 the files are handed to a process pool (regex matching is
+    CPU-bound, so threads would just queue up on the GIL). Only a few jobs per
+    worker are kept in flight, so file_paths may be a lazy iterable and
+    results come back in completion order rather than input order.
+    With workers <= 1 files are read and matched inline in the calling
+    thread, and rewritten files are handed to `write_workers` writer threads
+    (process_file's defer_write) so writing overlaps with matching the next file.
+    A match_timeout needs a timer signal (match_watchdog), which only the
+    main thread gets; off the main thread a single pool worker is used instead.
+
+    Setting cancel_event stops submitting new files and drops queued ones;
+    files that are already being processed are allowed to finish, and their
+    results are still yielded, so no write is cut off half-way or goes unreported.
+
+    Encodings found for each file are kept in ENCODING_CACHE and handed back
+    to process_file as encoding_hint on later runs over the same files.
+    In 'match' mode with a cache_path, unchanged files are answered from the
+    ResultCache (marked with 'cached': True) unless force_rescan is set;
+    fresh results are stored there either way.
+    """
+    if workers is None:
+        workers = DEFAULT_WORKERS
+    inline = workers <= 1
+    if inline and file_options.get('match_timeout') and hasattr(signal, 'setitimer'):
+        inline = can_use_match_deadline()
+
+    def cancelled():
+        return cancel_event is not None and cancel_event.is_set()
+
+    cache = None
+    if cache_path and mode == 'match':
+        try:
+            flags = file_options.get('flags', 0)
+            engine = file_options.get('engine', 're')
+            compiled_flags = getattr(compile_pattern(match_pattern, flags, engine), 'flags', flags)
+            options = {
+                'stream_threshold': file_options.get('stream_threshold', DEFAULT_STREAM_THRESHOLD),
+                'boundary': file_options.get('boundary', 'lines'),
+                'use_mmap': file_options.get('use_mmap', True),
+            }
+            cache = ResultCache(cache_path, match_pattern, compiled_flags, mode,
+                                resolve_engine(match_pattern, flags, engine),
+                                file_options.get('max_count'), file_options.get('context_lines'),
+                                options)
+        except (re.error, sqlite3.Error, OSError) as e:
+            print(f"Result cache unavailable: {e}", file=sys.stderr)
+
+    def lookup(filepath):
+        if cache is None or force_rescan:
+            return None
+        try:
+            return cache.get(filepath, file_options.get('with_spans', False))
+        except sqlite3.Error:
+            return None
+
+    def finish(result):
+        remember_encoding(result)
+        if cache is not None and not result.get('cached'):
+            try:
+                cache.put(result)
+            except sqlite3.Error as e:
+                print(f"Could not store result for '{result['path']}': {e}", file=sys.stderr)
+        return result
+
+    paths = iter(file_paths)
+    try:
+        if inline:
+            writer = None
+            if write_workers and mode != 'match' and not file_options.get('dry_run'):
+                writer = ThreadPoolExecutor(max_workers=write_workers)
+            writes = set()
+            max_writes = max(1, write_workers) * JOBS_PER_WORKER
+            try:
+                for filepath in paths:
+                    if cancelled():
+                        break
+                    result = lookup(filepath) or process_file(
+                        filepath, match_pattern, mode, replace_pattern,
+                        encoding_hint=ENCODING_CACHE.get(filepath),
+                        defer_write=writer is not None, **file_options
+                    )
+                    if result['status'] != 'pending-write':
+                        yield finish(result)
+                        continue
+                    writes.add(writer.submit(
+                        finish_deferred_write, result,
+                        file_options.get('preserve_mtime', False), file_options.get('journal_dir')
+                    ))
+                    # Each pending write holds a whole file's text, so only a few may queue up
+                    while len(writes) >= max_writes:
+                        done, writes = wait(writes, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            yield finish(future.result())
+                # Writes that were started always complete, even when cancelled
+                for future in writes:
+                    yield finish(future.result())
+            finally:
+                if writer is not None:
+                    writer.shutdown(wait=True)
+            return
+
+        # 'spawn' keeps the workers independent of the Tk process state on every platform
+        executor = ProcessPoolExecutor(
+            max_workers=max(1, workers),
+            mp_context=multiprocessing.get_context('spawn')
+        )
+        max_in_flight = max(1, workers) * JOBS_PER_WORKER
+        pending = {}
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(pending) < max_in_flight and not cancelled():
+                    try:
+                        filepath = next(paths)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    cached = lookup(filepath)
+                    if cached is not None:
+                        yield finish(cached)
+                        continue
+                    future = executor.submit(
+                        process_file, filepath, match_pattern, mode, replace_pattern,
+                        encoding_hint=ENCODING_CACHE.get(filepath), **file_options
+                    )
+                    pending[future] = filepath
+
+                if cancelled():
+                    # Files not started yet are dropped; those being processed
+                    # are waited for and reported, so every write is accounted for
+                    for future in [future for future in pending if future.cancel()]:
+                        del pending[future]
+                if not pending:
+                    return
+
+                done, _ = wait(pending, timeout=CANCEL_POLL_SECONDS, return_when=FIRST_COMPLETED)
+                for future in done:
+                    filepath = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result = {
+                            'path': filepath,
+                            'status': 'unreadable',
+                            'encoding': None,
+                            'matches': None,
+                            'error': str(e),
+                            'stat': None,
+                        }
+                    yield finish(result)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+    finally:
+        if cache is not None:
+            try:
+                cache.close()
+            except sqlite3.Error as e:
+                print(f"Could not update result cache: {e}", file=sys.stderr)
+
+def format_matches(matches, max_shown=None):
+    """Render a match list for the console, listing at most max_shown (None = all) of them."""
+    if max_shown is None or len(matches) <= max_shown:
+        return f"{matches}"
+    return f"{matches[:max_shown]} ... (+{len(matches) - max_shown} more)"
+
+def log_matches(output_widget, prefix, matches, max_shown=None):
+    """
+    Write one console line for a file's matches. If the list is cut short and
+    the widget supports it (ResultStore / ResultsView), the full list is
+    handed over too so it can be expanded on demand.
+    """
+    text = f"{prefix}{format_matches(matches, max_shown)}\n"
+    if max_shown is not None and len(matches) > max_shown and hasattr(output_widget, 'insert_matches'):
+        output_widget.insert_matches(END, text, prefix, matches)
+    else:
+        output_widget.insert(END, text)
+
+def format_match_lines(spans, context):
+    """
+    Lay out located matches (process_file's 'spans' and 'context') the way
+    grep -n -C does: 'LINE:COL: text' for a matching line (with the column of
+    every match on it), 'LINE- text' for the lines around it and '--' between
+    groups that are not adjacent. Returns (is_match_line, text) per console line.
+    """
+    rows = {}
+    for (_, _, line, column), (before, text, after) in zip(spans, context):
+        if line in rows and rows[line][0]:
+            rows[line][1].append(column)
+        else:
+            rows[line] = (True, [column], text)
+        for number, context_text in itertools.chain(
+                zip(range(line - len(before), line), before),
+                zip(itertools.count(line + 1), after)):
+            rows.setdefault(number, (False, None, context_text))
+
+    lines = []
+    previous = None
+    for number in sorted(rows):
+        is_match, columns, text = rows[number]
+        if previous is not None and number > previous + 1:
+            lines.append((False, '--'))
+        if is_match:
+            lines.append((True, f"{number}:{','.join(map(str, columns))}: {text}"))
+        else:
+            lines.append((False, f"{number}- {text}"))
+        previous = number
+    return lines
+
+def log_match_lines(output_widget, prefix, result, max_shown=None):
+    """
+    Write a file's located matches (format_match_lines) under a header line,
+    listing at most max_shown matching lines (None = all). The rest go into
+    a foldable '...' line when the widget supports it (see log_matches).
+    """
+    lines = format_match_lines(result['spans'], result['context'])
+    output_widget.insert(END, f"{prefix}{len(result['matches'])} matches\n")
+    match_rows = [index for index, (is_match, _) in enumerate(lines) if is_match]
+    cut = rest = len(lines)
+    if max_shown is not None and len(match_rows) > max_shown:
+        cut = rest = match_rows[max_shown]
+        # Cut at the '--' before the first hidden group, if it is a group of its own
+        for index in range(match_rows[max_shown - 1] + 1 if max_shown else 0, cut):
+            if lines[index][1] == '--':
+                cut, rest = index, index + 1
+    output_widget.insert(END, ''.join(f"    {text}\n" for _, text in lines[:cut]))
+    if cut == len(lines):
+        return
+    more = f"    ... (+{len(match_rows) - max_shown} more matching lines)\n"
+    if hasattr(output_widget, 'insert_matches'):
+        output_widget.insert_matches(END, more, None, [text for _, text in lines[rest:]])
+    else:
+        output_widget.insert(END, more)
+
+def log_result_matches(output_widget, result, max_shown=None, label='MATCH FOUND'):
+    """Log a matched result (each matched member, for archives) with log_match_lines or log_matches."""
+    for entry in iter_member_results(result):
+        if entry['status'] != 'matched':
+            continue
+        prefix = f"[{label}] {entry['path']} [Encoding: {entry['encoding']}] -> "
+        if entry.get('context') is not None:
+            log_match_lines(output_widget, prefix, entry, max_shown)
+        else:
+            log_matches(output_widget, f"{prefix}Matches: ", entry['matches'], max_shown)
+
+def format_change_stats(changes):
+    """One-line summary of a change statistics dict (new_change_stats)."""
+    return (f"{changes['substitutions']} substitution(s),"
+            f" -{changes['bytes_removed']}/+{changes['bytes_added']} bytes")
+
+class RunProgress:
+    """
+    Progress and timing figures for one run, shared between the directory
+    walk (track_paths, usually running ahead on the iter_prefetched thread),
+    the loop consuming results (add_result) and whoever shows them
+    (snapshot, format_progress); the counters are guarded by a lock.
+
+    Stage times other than 'walk' come from process_file's 'timings' and are
+    summed over all workers, so with a pool they can add up to more than
+    the elapsed time. The walk overlaps with everything else.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.finished = None
+        self.first_result = None
+        self.files_found = 0
+        self.bytes_found = 0
+        self.walk_done = False
+        self.files_done = 0
+        self.bytes_done = 0
+        self.statuses = collections.Counter()
+        self.stages = dict.fromkeys(STAGES, 0.0)
+
+    def track_paths(self, paths, sizes=None):
+        """
+        Yield paths, counting them and their sizes and timing the walk that
+        produces them. Sizes are taken (and removed) from the sizes dict
+        iter_file_paths fills in, if given; other paths are stat'ed.
+        """
+        paths = iter(paths)
+        while True:
+            clock = time.perf_counter()
+            try:
+                path = next(paths)
+            except StopIteration:
+                break
+            size = sizes.pop(path, None) if sizes is not None else None
+            if size is None:
+                try:
+                    size = os.stat(path).st_size
+                except OSError:
+                    size = 0
+            with self.lock:
+                self.stages['walk'] += time.perf_counter() - clock
+                self.files_found += 1
+                self.bytes_found += size
+            yield path
+        with self.lock:
+            self.walk_done = True
+
+    def add_result(self, result):
+        """Count a finished process_file result and its stage timings."""
+        size = result.get('size')
+        if size is None:
+            # Cached results: those files were not rewritten
+            size = result['stat'][0] if result.get('stat') else 0
+        with self.lock:
+            if self.first_result is None:
+                self.first_result = time.perf_counter() - self.started
+            self.files_done += 1
+            self.bytes_done += size
+            self.statuses[result['status']] += 1
+            for stage, seconds in (result.get('timings') or {}).items():
+                self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def finish(self):
+        """Stop the clock; later snapshots report the run's final figures."""
+        with self.lock:
+            if self.finished is None:
+                self.finished = time.perf_counter()
+
+    def snapshot(self):
+        """
+        Return the figures so far as a JSON-serialisable dict. 'eta' (seconds,
+        or None before the first result) assumes the remaining bytes go at the
+        rate seen so far; until 'walk_done', more files may still turn up.
+        """
+        with self.lock:
+            elapsed = (self.finished or time.perf_counter()) - self.started
+            snapshot = {
+                'elapsed': elapsed,
+                'first_result': self.first_result,
+                'files_done': self.files_done,
+                'files_found': max(self.files_found, self.files_done),
+                'bytes_done': self.bytes_done,
+                'bytes_found': max(self.bytes_found, self.bytes_done),
+                'walk_done': self.walk_done,
+                'statuses': dict(self.statuses),
+                'stages': dict(self.stages),
+            }
+        rate = snapshot['bytes_done'] / elapsed if elapsed > 0 else 0.0
+        snapshot['files_per_sec'] = snapshot['files_done'] / elapsed if elapsed > 0 else 0.0
+        snapshot['mb_per_sec'] = rate / (1024 * 1024)
+        remaining = snapshot['bytes_found'] - snapshot['bytes_done']
+        snapshot['eta'] = remaining / rate if rate > 0 else None
+        return snapshot
+
+def format_duration(seconds):
+    """Render seconds as m:ss (or h:mm:ss)."""
+    minutes, seconds = divmod(int(seconds + 0.5), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
+def format_progress(snapshot):
+    """One status line for a RunProgress snapshot: files, MB, rates and ETA."""
+    mb = 1024 * 1024
+    text = (f"{snapshot['files_done']}/{snapshot['files_found']} files, "
+            f"{snapshot['bytes_done'] / mb:.1f}/{snapshot['bytes_found'] / mb:.1f} MB, "
+            f"{snapshot['files_per_sec']:.1f} files/s, {snapshot['mb_per_sec']:.1f} MB/s")
+    finished = snapshot['walk_done'] and snapshot['files_done'] >= snapshot['files_found']
+    if snapshot['eta'] is not None and not finished:
+        # The total is still growing while the walk goes on
+        text += f", ETA {format_duration(snapshot['eta'])}{'' if snapshot['walk_done'] else '+'}"
+    return text
+
+def format_stage_timings(stages):
+    """Render the per-stage seconds of a RunProgress snapshot, e.g. 'walk 0.12s, read 1.50s, ...'."""
+    return ', '.join(f"{stage} {stages.get(stage, 0.0):.2f}s" for stage in STAGES)
+
+def process_files(file_paths, match_pattern, mode, replace_pattern, output_widget,
+                  workers=None, cancel_event=None, max_matches_shown=None, progress=None,
+                  watcher=None, **file_options):
+    """
+    Process each file in file_paths according to the chosen mode:
+      - 'match': Log matches, no modifications
+      - 'invert': Remove or replace non-matching parts
+      - 'replace': Replace matched text
+
+    Attempts multiple encodings. Skips files that cannot be read.
+    The files are spread over `workers` processes (see iter_file_results);
+    output_widget only needs insert() and see(), so a QueuedOutput can be
+    passed when this runs off the Tk thread. At most max_matches_shown
+    matches are listed per file (None = all; see log_matches). Results that
+    carry context_lines are listed line by line (log_match_lines), archives
+    member by member. Extra keyword arguments
+    (cache_path, force_rescan and the process_file options) go to
+    iter_file_results. For a rule set, pass mode='rules' and rules=[...]
+    (see load_rules); per-rule hit counts are added to the summary.
+    With dry_run='stats' or 'diff' no file is written; the changes each file
+    would get are logged instead (see process_file).
+    Every result is counted in `progress` (a RunProgress), whose figures end
+    the summary. Pass one whose track_paths already wraps the directory walk
+    to have the walk timed and the total size known for an ETA; otherwise
+    file_paths are tracked here.
+    Every result is also handed to `watcher` (a FileWatcher), if given, so a
+    watch_files run afterwards starts from what this run has seen.
+    """
+    rules = file_options.get('rules')
+    if rules is None:
+        try:
+            compile_pattern(match_pattern, file_options.get('flags', 0), file_options.get('engine', 're'))
+        except re.error as e:
+            output_widget.insert(END, f"Invalid Regex: {e}\n")
+            output_widget.see(END)
+            return
+
+    processed_count = 0
+    skipped_count = 0
+    prefiltered_count = 0
+    cached_count = 0
+    matched_files = 0  # Only used in 'match' mode and by 'match' rules
+    would_modify_files = 0
+    total_changes = new_change_stats()
+    rule_totals = [0] * len(rules or [])
+    if progress is None:
+        progress = RunProgress()
+        file_paths = progress.track_paths(file_paths)
+
+    results = iter_file_results(
+        file_paths, match_pattern, mode, replace_pattern,
+        workers=workers, cancel_event=cancel_event, **file_options
+    )
+    for result in results:
+        progress.add_result(result)
+        if watcher is not None:
+            watcher.add_result(result)
+        status = result['status']
+        filepath = result['path']
+        used_encoding = result['encoding']
+
+        if status == 'missing':
+            continue
+        if result.get('cached'):
+            cached_count += 1
+
+        if status == 'unreadable':
+            skipped_count += 1
+            output_widget.insert(END, f"Skipping (unreadable or missing permissions): {filepath}\n")
+            output_widget.see(END)
+            continue
+
+        if status == 'regex-error':
+            skipped_count += 1
+            output_widget.insert(END, f"Skipping (regex error): {filepath}\n")
+            output_widget.see(END)
+            continue
+
+        if status == 'timeout':
+            skipped_count += 1
+            output_widget.insert(END, f"Skipping (match timed out, {result['error']}): {filepath}\n")
+            output_widget.see(END)
+            continue
+
+        if status == 'archive':
+            skipped_count += 1
+            output_widget.insert(END, f"Skipping (archive, only searched in Just Match mode): {filepath}\n")
+            output_widget.see(END)
+            continue
+
+        for member in result.get('members') or ():
+            if member['status'] == 'unreadable':
+                output_widget.insert(END, f"Skipping (unreadable archive member): {member['path']}\n")
+
+        for index, hits in enumerate(result.get('rule_hits') or []):
+            rule_totals[index] += hits
+        if result.get('rule_matches'):
+            matched_files += 1
+            for index, matches in result['rule_matches'].items():
+                log_matches(
+                    output_widget,
+                    f"[MATCH FOUND] {filepath} [Encoding: {used_encoding}] -> Rule {index + 1} matches: ",
+                    matches, max_matches_shown
+                )
+
+        if status == 'prefiltered':
+            prefiltered_count += 1
+        elif status == 'matched' and rules is None:
+            matched_files += 1
+            log_result_matches(output_widget, result, max_matches_shown)
+        elif status == 'modified':
+            output_widget.insert(
+                END, f"Processed file: {filepath} [Encoding: {used_encoding}]\n"
+            )
+        elif status == 'would-modify':
+            would_modify_files += 1
+            changes = result['changes']
+            for key in total_changes:
+                total_changes[key] += changes[key]
+            output_widget.insert(
+                END,
+                f"Would modify: {filepath} [Encoding: {used_encoding}] -> {format_change_stats(changes)}\n"
+            )
+            if result.get('diff'):
+                output_widget.insert(END, ''.join(result['diff']))
+        elif status == 'no-permission':
+            output_widget.insert(
+                END, f"Skipping (no permission to write): {filepath}\n"
+            )
+        elif status == 'write-error':
+            output_widget.insert(
+                END, f"Skipping (error writing to file {filepath}): {result['error']}\n"
+            )
+
+        processed_count += 1
+        output_widget.see(END)
+
+    # Summaries
+    progress.finish()
+    if processed_count == 0 and skipped_count == 0:
+        output_widget.insert(END, "No files found to process.\n")
+    output_widget.insert(END, "\n--- Summary ---\n")
+    if cancel_event is not None and cancel_event.is_set():
+        output_widget.insert(END, "Run cancelled before all files were processed.\n")
+    output_widget.insert(END, f"Processed files: {processed_count}\n")
+    output_widget.insert(END, f"Skipped files:   {skipped_count}\n")
+    if cached_count:
+        output_widget.insert(END, f"Unchanged files answered from cache: {cached_count}\n")
+    if prefiltered_count:
+        output_widget.insert(END, f"Ruled out by literal prefilter (no regex run): {prefiltered_count}\n")
+    if file_options.get('dry_run') and mode != 'match':
+        output_widget.insert(END, f"Files that would change: {would_modify_files}"
+                                  f" ({format_change_stats(total_changes)})\n")
+    if mode == 'match' or any(rule_mode == 'match' for _, _, rule_mode in rules or []):
+        output_widget.insert(END, f"Files with matches: {matched_files}\n")
+    for index, (rule_pattern, _, rule_mode) in enumerate(rules or []):
+        output_widget.insert(
+            END, f"Rule {index + 1} ({rule_mode}) {rule_pattern!r}: {rule_totals[index]} hits\n"
+        )
+    snapshot = progress.snapshot()
+    output_widget.insert(END, f"Elapsed: {format_duration(snapshot['elapsed'])} ({format_progress(snapshot)})\n")
+    output_widget.insert(END, f"Time per stage (summed over workers): {format_stage_timings(snapshot['stages'])}\n")
+    output_widget.insert(END, "-----------------\n\n")
+    output_widget.see(END)
+
+def process_multiline_string(text_input, match_pattern, mode, replace_pattern, output_widget,
+                             flags=0, engine='re', match_timeout=None):
+    """
+    Process a user-provided multiline string instead of files.
+    Logs results to the output widget. With match_timeout (seconds) a
+    runaway pattern is abandoned instead of freezing the caller (this runs
+    on the Tk thread, where match_deadline works).
+    """
+    try:
+        compiled_pattern = compile_pattern(match_pattern, flags, engine)
+    except re.error as e:
+        output_widget.insert(END, f"Invalid Regex: {e}\n")
+        output_widget.see(END)
+        return text_input
+
+    try:
+        with match_deadline(match_timeout):
+            updated_content, matches = regex_replace_and_store(
+                content=text_input,
+                compiled_pattern=compiled_pattern,
+                mode=mode,
+                replace_pattern=replace_pattern
+            )
+    except MatchTimeout as e:
+        output_widget.insert(END, f"Gave up on the pattern: {e}\n")
+        output_widget.see(END)
+        return text_input
+    except Exception as e:
+        output_widget.insert(END, f"Error processing string with regex: {e}\n")
+        output_widget.see(END)
+        return text_input
+
+    if updated_content is None and matches is None:
+        output_widget.insert(END, "Skipping due to regex error.\n")
+        output_widget.see(END)
+        return text_input
+
+    if mode == 'match':
+        if matches:
+            output_widget.insert(END, f"Matches found: {matches}\n")
+        else:
+            output_widget.insert(END, "No matches found.\n")
+        return text_input
+    else:
+        # 'invert' or 'replace'
+        if updated_content != text_input:
+            output_widget.insert(END, "The text was modified.\n")
+            output_widget.insert(END, "--- Updated Text Below ---\n")
+            output_widget.insert(END, updated_content + "\n\n")
+        else:
+            output_widget.insert(END, "No change needed.\n")
+        return updated_content
+
+def parse_extension_filter(extension_filter):
+    """
+    Turn the extension filter text into a tuple of lowercase extensions.
+    Several extensions can be separated by commas, semicolons or spaces,
+    with or without the leading dot ("txt, .log md"). Returns None if empty.
+    """
+    if not extension_filter:
+        return None
+    extensions = []
+    for ext in re.split(r'[,;\s]+', extension_filter.strip()):
+        if not ext:
+            continue
+        # If the user typed "txt" instead of ".txt", add the leading dot
+        if not ext.startswith('.'):
+            ext = '.' + ext
+        extensions.append(ext.lower())
+    return tuple(extensions) or None
+
+def is_binary_file(filepath):
+    """
+    Sniff the first block of a file for NUL bytes, the usual sign of binary
+    data. UTF-16 text also contains NULs, so files detect_encoding recognises
+    as UTF-16 are still treated as text.
+    """
+    try:
+        with open(filepath, 'rb') as f:
+            block = f.read(BINARY_SNIFF_BYTES)
+    except OSError:
+        return False  # Let the processing stage report it as unreadable
+    return looks_binary(block)
+
+def looks_binary(block):
+    """is_binary_file's test on a block of bytes that has already been read."""
+    if b'\x00' not in block:
+        return False
+    return not detect_encoding(block).startswith('utf-16')
+
+def ignore_glob_to_regex(glob):
+    """Translate one .gitignore-style glob into a regex fragment ('**' spans directories)."""
+    out = []
+    i = 0
+    while i < len(glob):
+        c = glob[i]
+        if glob.startswith('**/', i):
+            out.append('(?:.*/)?')
+            i += 3
+            continue
+        if glob.startswith('**', i):
+            out.append('.*')
+            i += 2
+            continue
+        if c == '*':
+            out.append('[^/]*')
+        elif c == '?':
+            out.append('[^/]')
+        elif c == '[' and ']' in glob[i + 2:]:
+            end = glob.index(']', i + 2)
+            body = glob[i + 1:end]
+            if body.startswith('!'):
+                body = '^' + body[1:]
+            out.append('[' + body.replace('\\', '\\\\') + ']')
+            i = end + 1
+            continue
+        elif c == '\\' and i + 1 < len(glob):
+            out.append(re.escape(glob[i + 1]))
+            i += 2
+            continue
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return ''.join(out)
+
+def load_ignore_rules(directory, ignore_files):
+    """
+    Parse the ignore files (e.g. '.gitignore') found in directory.
+    Returns a list of (compiled_regex, negated, dir_only) rules, matched
+    against '/'-separated paths relative to directory, in file order.
+    """
+    rules = []
+    for name in ignore_files:
+        try:
+            with open(os.path.join(directory, name), 'r', encoding='utf-8', errors='replace') as f:
+                lines = f.read().splitlines()
+        except OSError:
+            continue
+        for line in lines:
+            line = line.rstrip()
+            if not line or line.startswith('#'):
+                continue
+            negated = line.startswith('!')
+            if negated:
+                line = line[1:]
+            dir_only = line.endswith('/')
+            line = line.rstrip('/')
+            if not line:
+                continue
+            if '/' in line:
+                # Contains a slash: anchored to the directory of the ignore file
+                regex = '^' + ignore_glob_to_regex(line.lstrip('/')) + '$'
+            else:
+                # Bare name: matches at any depth below it
+                regex = '(?:^|/)' + ignore_glob_to_regex(line) + '$'
+            try:
+                rules.append((re.compile(regex), negated, dir_only))
+            except re.error:
+                continue
+    return rules
+
+def is_ignored(full_path, is_dir, rule_sets):
+    """
+    Check a path against the ignore rules collected on the way down the tree.
+    rule_sets is a list of (base_directory, rules) from load_ignore_rules;
+    as in git, the last matching rule decides.
+    """
+    ignored = False
+    for base, rules in rule_sets:
+        relative = full_path[len(base):].lstrip(os.sep)
+        if os.sep != '/':
+            relative = relative.replace(os.sep, '/')
+        for regex, negated, dir_only in rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.search(relative):
+                ignored = not negated
+    return ignored
+
+def iter_file_paths(path, extension_filter=None, exclude_dirs=None,
+                    max_size=None, skip_binary=False, ignore_files=None, directories=None,
+                    sizes=None):
+    """
+    Lazily yield the files below directory `path`, one at a time, so
+    processing can start on the first file while the rest of the tree is
+    still being discovered. Uses os.scandir, reusing each DirEntry's type
+    (and, for max_size, stat) information instead of extra system calls.
+
+    Filters are applied during the walk so junk never reaches the regex stage:
+      - extension_filter: only files with one of these extensions (see parse_extension_filter)
+      - exclude_dirs: glob patterns for directory names (or paths relative
+        to `path`) that are not descended into, e.g. ['.git', 'node_modules']
+      - max_size: files larger than this many bytes are skipped
+      - skip_binary: files whose first block looks binary are skipped, except
+        archives and compressed files (archive_kind), which are searched inside
+      - ignore_files: names of .gitignore-style files to honour, e.g. ['.gitignore']
+    If a set is passed as directories, every directory walked is added to it.
+    If a dict is passed as sizes, each file's size (from its DirEntry) is
+    stored in it under its path just before the path is yielded, for
+    RunProgress.track_paths to take.
+    Like os.walk, unreadable directories are skipped and symlinked
+    directories are not followed.
+    """
+    extensions = parse_extension_filter(extension_filter)
+    exclude_dirs = [pattern.strip().rstrip('/\\') for pattern in exclude_dirs or [] if pattern.strip()]
+
+    # Directories still to visit, each with the ignore rules in effect there
+    stack = [(path, [])]
+    while stack:
+        directory, rule_sets = stack.pop()
+        if directories is not None:
+            directories.add(directory)
+        if ignore_files:
+            own_rules = load_ignore_rules(directory, ignore_files)
+            if own_rules:
+                rule_sets = rule_sets + [(directory, own_rules)]
+
+        subdirectories = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir():
+                            if entry.is_symlink():
+                                continue
+                            relative = os.path.relpath(entry.path, path).replace(os.sep, '/')
+                            if any(fnmatch.fnmatch(entry.name, pattern) or fnmatch.fnmatch(relative, pattern)
+                                   for pattern in exclude_dirs):
+                                continue
+                            if rule_sets and is_ignored(entry.path, True, rule_sets):
+                                continue
+                            subdirectories.append(entry.path)
+                            continue
+                        if not entry.is_file():
+                            continue
+
+                        # If filter is specified, check extension
+                        if extensions and not entry.name.lower().endswith(extensions):
+                            continue
+                        if rule_sets and is_ignored(entry.path, False, rule_sets):
+                            continue
+                        if max_size is not None and entry.stat().st_size > max_size:
+                            continue
+                        if skip_binary and not archive_kind(entry.name) and is_binary_file(entry.path):
+                            continue
+                        if sizes is not None:
+                            sizes[entry.path] = entry.stat().st_size
+                    except OSError:
+                        continue
+                    yield entry.path
+        except OSError:
+            continue
+
+        # Reversed so directories are visited in listing order
+        for subdirectory in reversed(subdirectories):
+            stack.append((subdirectory, rule_sets))
+
+def iter_prefetched(iterable, maxsize=WALK_QUEUE_SIZE):
+    """
+    Yield the items of iterable while a background thread produces them into
+    a bounded queue, so a slow producer (a directory walk on a network
+    share) overlaps with the consumer and memory stays flat: the producer
+    blocks once `maxsize` items are waiting. Exceptions raised by the
+    producer are re-raised here. Closing this generator stops the producer.
+    """
+    items = queue.Queue(maxsize=maxsize)
+    stop_event = threading.Event()
+    finished = object()
+
+    def put(item):
+        while not stop_event.is_set():
+            try:
+                items.put(item, timeout=CANCEL_POLL_SECONDS)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(('item', item)):
+                    return
+        except Exception as e:
+            put(('error', e))
+            return
+        put(('done', finished))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            kind, item = items.get()
+            if kind == 'done':
+                return
+            if kind == 'error':
+                raise item
+            yield item
+    finally:
+        stop_event.set()
+
+def gather_file_paths(input_type, path, extension_filter=None, exclude_dirs=None,
+                      max_size=None, skip_binary=False, ignore_files=None):
+    """
+    Return a list of file paths for 'single' or 'directory'.
+    If extension_filter is provided (non-empty), only files matching one of
+    its extensions will be included. Otherwise, all files are included.
+    The directory filters are those of iter_file_paths, which should be
+    used directly to stream paths instead of building the whole list.
+    """
+    try:
+        if input_type == 'single':
+            # Single file input -> ignore extension filter here
+            return [path] if os.path.isfile(path) else []
+        else:
+            return list(iter_file_paths(
+                path,
+                extension_filter=extension_filter,
+                exclude_dirs=exclude_dirs,
+                max_size=max_size,
+                skip_binary=skip_binary,
+                ignore_files=ignore_files
+            ))
+    except Exception as e:
+        print(f"Error gathering file paths: {e}")
+        return []
+
+class Inotify:
+    """
+    Minimal Linux inotify binding (through ctypes, so nothing needs to be
+    installed) that tells a FileWatcher which files of the watched
+    directories changed, so it does not have to stat every file to find out.
+    Raises OSError where inotify is not available; see open_inotify.
+    """
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    # Files or directories appearing or going away: the tree has to be walked again
+    TREE_EVENTS = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF
+    EVENTS = IN_MODIFY | IN_CLOSE_WRITE | TREE_EVENTS
+    EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len (then len bytes of name)
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        if not sys.platform.startswith('linux'):
+            raise OSError("inotify is only available on Linux")
+        self.ctypes = ctypes
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}  # watch descriptor -> directory
+        self.watched = set()
+        self.changed = set()
+        self.tree_changed = False
+        self.overflowed = False
+
+    def watch(self, directory):
+        """Watch a directory (again); raises OSError, e.g. when the system's watch limit is reached."""
+        if directory in self.watched:
+            return
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.EVENTS)
+        if wd < 0:
+            errno = self.ctypes.get_errno()
+            raise OSError(errno, f"cannot watch '{directory}': {os.strerror(errno)}")
+        self.watches[wd] = directory
+        self.watched.add(directory)
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for events and collect them; True if any arrived."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        self.read_events()
+        return True
+
+    def read_events(self):
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return
+            position = 0
+            while position + self.EVENT_HEADER.size <= len(data):
+                wd, mask, _, length = self.EVENT_HEADER.unpack_from(data, position)
+                position += self.EVENT_HEADER.size
+                name = data[position:position + length].rstrip(b'\0')
+                position += length
+                if mask & self.IN_Q_OVERFLOW:
+                    self.overflowed = True
+                    continue
+                directory = self.watches.get(wd)
+                if directory is None:
+                    continue
+                if mask & self.IN_IGNORED:
+                    # The directory is gone (or was unwatched)
+                    del self.watches[wd]
+                    self.watched.discard(directory)
+                    self.tree_changed = True
+                    continue
+                if mask & self.TREE_EVENTS:
+                    self.tree_changed = True
+                if name:
+                    self.changed.add(os.path.join(directory, os.fsdecode(name)))
+
+    def take(self):
+        """Return and reset (changed_paths, tree_changed, overflowed) collected since the last call."""
+        events = (self.changed, self.tree_changed, self.overflowed)
+        self.changed = set()
+        self.tree_changed = False
+        self.overflowed = False
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+def open_inotify():
+    """Return an Inotify, or None if inotify is not available here."""
+    try:
+        return Inotify()
+    except (OSError, AttributeError):
+        return None
+
+def newline_bytes(encoding):
+    """The bytes of '\\n' in an encoding (without a BOM), e.g. b'\\n\\x00' for UTF-16-LE."""
+    return 'a\n'.encode(encoding)[len('a'.encode(encoding)):]
+
+class FileWatcher:
+    """
+    Remembers how far each file of a run has been searched and, on every
+    poll(), searches only what was appended since: new files from the top,
+    grown files from the end of their last complete line. A file that
+    shrank, was replaced (new inode) or whose bytes before the remembered
+    offset changed is searched again from the top, with 'restarted' set on
+    its result. Only whole lines are searched, so a line is found once the
+    writer has finished it with a newline; a match spanning two appends is
+    not found.
+
+    roots are the files and directories of the run; directories are walked
+    again (iter_file_paths, with the same extension_filter and
+    walk_options) only when one of them changed. With inotify (Linux) a
+    poll only looks at the files it reported, plus a full stat sweep every
+    WATCH_SWEEP_EVERY polls; elsewhere every file is stat'ed each poll.
+
+    Seed it with the initial run's results (add_result, or process_files'
+    watcher argument) and call start() before the first poll, or every file
+    is taken for new. Archives and compressed files are searched whole
+    again (process_file) when they change.
+    """
+    def __init__(self, roots, match_pattern, flags=0, engine='re', context_lines=None,
+                 extension_filter=None, walk_options=None, use_inotify=True):
+        self.roots = list(roots)
+        self.match_pattern = match_pattern
+        self.flags = flags
+        self.engine = engine
+        self.compiled_pattern = compile_pattern(match_pattern, flags, engine)
+        self.context_lines = context_lines
+        self.extension_filter = extension_filter
+        self.walk_options = walk_options or {}
+        self.notifier = open_inotify() if use_inotify else None
+        self.files = {}  # path -> state, see new_state
+        self.directories = {}  # directory -> mtime_ns
+        self.path_keys = {}  # normalised path -> path in self.files
+        self.polls = 0
+
+    @staticmethod
+    def new_state(offset=0, encoding=None, file_stat=None):
+        return {
+            'offset': offset,        # bytes searched so far
+            'line': 0 if offset == 0 else None,  # newlines before offset (None = not counted yet)
+            'encoding': encoding,
+            'stat': file_stat,       # (size, mtime_ns) when last looked at
+            'inode': None,
+            'tail': b'',             # the last WATCH_TAIL_BYTES before offset, if read
+            'reported': 0,           # matches ending at or before this byte were already reported
+        }
+
+    def add_result(self, result):
+        """
+        Take a process_file result as searched up to the size it had then.
+        Its last line may still have been being written, so that line is
+        searched again once finished, leaving out the matches reported then.
+        """
+        if result['status'] == 'missing' or not result.get('stat'):
+            return
+        encoding = result['encoding'] if not result.get('members') else None
+        size = result['stat'][0]
+        offset = None
+        if encoding is not None and archive_kind(result['path']) is None:
+            try:
+                offset = self.last_line_start(result['path'], size, encoding)
+            except (OSError, LookupError):
+                pass
+        state = self.new_state(size if offset is None else offset, encoding, tuple(result['stat']))
+        state['reported'] = size
+        self.files[result['path']] = state
+
+    @staticmethod
+    def last_line_start(path, size, encoding):
+        """
+        The byte offset of the start of the line the first `size` bytes of a
+        file end in (`size` itself after a newline), or None if that line is
+        longer than WATCH_READ_BYTES.
+        """
+        with open(path, 'rb') as f:
+            if encoding == 'utf-16':
+                encoding = 'utf-16-be' if f.read(2) == codecs.BOM_UTF16_BE else 'utf-16-le'
+            newline = newline_bytes(encoding)
+            start = max(0, size - WATCH_READ_BYTES)
+            start -= start % len(newline)
+            f.seek(start)
+            data = f.read(size - start)
+        end = data.rfind(newline)
+        while end >= 0 and (start + end) % len(newline):
+            end = data.rfind(newline, 0, end)
+        if end >= 0:
+            return start + end + len(newline)
+        return 0 if start == 0 else None
+
+    def start(self):
+        """
+        Find the directories to watch and any file the initial run did not
+        see, and read the bytes before each remembered offset (see scan).
+        """
+        self.rewalk()
+        for path, state in self.files.items():
+            if state['offset'] and not state['tail']:
+                try:
+                    with open(path, 'rb') as f:
+                        f.seek(max(0, state['offset'] - WATCH_TAIL_BYTES))
+                        state['tail'] = f.read(min(state['offset'], WATCH_TAIL_BYTES))
+                except OSError:
+                    continue
+
+    def close(self):
+        if self.notifier is not None:
+            self.notifier.close()
+
+    def rewalk(self):
+        """Walk the roots again: start tracking new files and forget removed ones."""
+        found = set()
+        directories = set()
+        for root in self.roots:
+            if os.path.isdir(root):
+                found.update(iter_file_paths(root, extension_filter=self.extension_filter,
+                                             directories=directories, **self.walk_options))
+            else:
+                directories.add(os.path.dirname(root) or os.curdir)
+                if os.path.isfile(root):
+                    found.add(root)
+        for path in found.difference(self.files):
+            self.files[path] = self.new_state()
+        for path in set(self.files).difference(found):
+            del self.files[path]
+        self.path_keys = {os.path.normpath(path): path for path in self.files}
+
+        self.directories = {}
+        for directory in directories:
+            try:
+                self.directories[directory] = os.stat(directory).st_mtime_ns
+            except OSError:
+                continue
+            if self.notifier is not None:
+                try:
+                    self.notifier.watch(directory)
+                except OSError as e:
+                    print(f"Falling back to polling: {e}", file=sys.stderr)
+                    self.notifier.close()
+                    self.notifier = None
+
+    def directories_changed(self):
+        for directory, mtime_ns in self.directories.items():
+            try:
+                if os.stat(directory).st_mtime_ns != mtime_ns:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def wait(self, interval, cancel_event=None):
+        """Sleep until the next poll is due: `interval` seconds, or with inotify until something changes."""
+        deadline = time.monotonic() + interval
+        while cancel_event is None or not cancel_event.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            step = min(remaining, CANCEL_POLL_SECONDS) if cancel_event is not None else remaining
+            if self.notifier is not None:
+                if self.notifier.wait(step):
+                    time.sleep(WATCH_SETTLE_SECONDS)
+                    self.notifier.read_events()
+                    return
+            elif cancel_event is not None:
+                cancel_event.wait(step)
+            else:
+                time.sleep(step)
+
+    def poll(self):
+        """Search what changed since the last poll; returns the results that have matches."""
+        self.polls += 1
+        if self.notifier is not None and self.polls % WATCH_SWEEP_EVERY:
+            changed, tree_changed, overflowed = self.notifier.take()
+            # Event paths are directory + name; map them back to the walk's spelling
+            candidates = {self.path_keys.get(os.path.normpath(path), path) for path in changed}
+            if overflowed:
+                candidates = set(self.files)
+                tree_changed = True
+        else:
+            if self.notifier is not None:
+                self.notifier.take()
+            candidates = set(self.files)
+            tree_changed = self.directories_changed()
+        if tree_changed:
+            known = set(self.files)
+            self.rewalk()
+            candidates.update(set(self.files).difference(known))
+
+        results = []
+        for path in sorted(candidates):
+            if path not in self.files:
+                continue
+            result = self.scan(path)
+            if result is not None and result['status'] == 'matched':
+                results.append(result)
+        return results
+
+    def tail_matches(self, f, state):
+        """True if the bytes before the remembered offset are still the ones searched."""
+        if not state['tail']:
+            return True
+        f.seek(state['offset'] - len(state['tail']))
+        return f.read(len(state['tail'])) == state['tail']
+
+    def scan(self, path):
+        """Search the part of one file not searched yet; returns a result dict, or None if nothing changed."""
+        state = self.files[path]
+        try:
+            file_stat = os.stat(path)
+        except OSError:
+            return None  # gone; the next walk forgets it
+        current = (file_stat.st_size, file_stat.st_mtime_ns)
+        if current == state['stat'] and state['inode'] in (None, file_stat.st_ino):
+            state['inode'] = file_stat.st_ino
+            return None
+
+        try:
+            with open(path, 'rb') as f:
+                restarted = False
+                if ((state['inode'] is not None and state['inode'] != file_stat.st_ino)
+                        or file_stat.st_size < state['offset'] or not self.tail_matches(f, state)):
+                    restarted = state['offset'] > 0
+                    state.update(self.new_state())
+                state['inode'] = file_stat.st_ino
+                state['stat'] = current
+
+                if archive_kind(path) is not None:
+                    state['offset'] = file_stat.st_size
+                    result = process_file(path, self.match_pattern, 'match', None, flags=self.flags,
+                                          engine=self.engine, with_spans=True,
+                                          context_lines=self.context_lines)
+                else:
+                    result = self.search_appended(f, path, state, file_stat.st_size)
+        except OSError as e:
+            print(f"Unexpected error while reading '{path}': {e}", file=sys.stderr)
+            return None
+        result['restarted'] = restarted
+        return result
+
+    def search_appended(self, f, path, state, size):
+        """Search the complete lines between state['offset'] and size, moving the offset past them."""
+        result = {
+            'path': path,
+            'status': 'no-match',
+            'encoding': state['encoding'],
+            'matches': [],
+            'spans': [],
+            'offsets': 'bytes',
+            'context': [] if self.context_lines is not None else None,
+            'error': None,
+            'stat': state['stat'],
+        }
+        if state['encoding'] is None:
+            f.seek(state['offset'])
+            state['encoding'] = detect_encoding(f.read(SNIFF_BYTES))
+        if state['encoding'] in ('utf-16', 'utf-8-sig'):
+            # Appended bytes carry no BOM: go on in the encoding the file's BOM stands for
+            f.seek(0)
+            head = f.read(len(codecs.BOM_UTF8))
+            if state['encoding'] == 'utf-8-sig':
+                bom = codecs.BOM_UTF8 if head.startswith(codecs.BOM_UTF8) else b''
+                state['encoding'] = 'utf-8'
+            else:
+                bom = head[:2] if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)) else b''
+                state['encoding'] = 'utf-16-be' if head.startswith(codecs.BOM_UTF16_BE) else 'utf-16-le'
+            state['offset'] = max(state['offset'], len(bom))
+
+        f.seek(state['offset'])
+        while state['offset'] < size:
+            data = f.read(min(WATCH_READ_BYTES, size - state['offset']))
+            if not data:
+                break
+            newline = newline_bytes(state['encoding'])
+            end = data.rfind(newline)
+            # In UTF-16/32 a newline only counts at a character boundary
+            while end >= 0 and (state['offset'] + end) % len(newline):
+                end = data.rfind(newline, 0, end)
+            if end >= 0:
+                end += len(newline)
+            elif len(data) == WATCH_READ_BYTES:
+                end = len(data) - len(data) % len(newline)  # one enormous line: take it in pieces
+            else:
+                break  # only an unfinished line so far
+
+            chunk = data[:end]
+            self.search_chunk(path, chunk, state, result)
+            state['offset'] += end
+            state['tail'] = (state['tail'] + chunk)[-WATCH_TAIL_BYTES:]
+            if end < len(data):
+                break
+        result['encoding'] = state['encoding']
+        if result['matches']:
+            result['status'] = 'matched'
+        return result
+
+    def search_chunk(self, path, chunk, state, result):
+        """Search one block of complete lines and add its matches (at file positions) to result."""
+        text = None
+        for encoding in encoding_fallbacks(state['encoding']):
+            try:
+                text = chunk.decode(encoding)
+            except UnicodeDecodeError:
+                continue
+            state['encoding'] = encoding
+            break
+        if text is None:
+            return
+        matches, spans, context = locate_matches(text, self.compiled_pattern, None, self.context_lines)
+        if matches and state['line'] is None:
+            state['line'] = self.count_lines_before(path, state['offset'], state['encoding'])
+
+        # Byte positions, encoding only the text between one match and the next
+        encoding = state['encoding']
+        char_position = 0
+        byte_position = state['offset']
+        for index, (start, end, line, column) in enumerate(spans):
+            byte_position += len(text[char_position:start].encode(encoding))
+            char_position = start
+            spans[index] = (byte_position, byte_position + len(text[start:end].encode(encoding)),
+                            line + state['line'], column)
+            if context is not None and '\r' in text:
+                before, line_text, after = context[index]
+                context[index] = ([t.rstrip('\r') for t in before], line_text.rstrip('\r'),
+                                  [t.rstrip('\r') for t in after])
+        if state['reported'] > state['offset']:
+            # The start of a line the initial run searched unfinished
+            keep = [index for index, span in enumerate(spans) if span[1] > state['reported']]
+            matches = [matches[index] for index in keep]
+            spans = [spans[index] for index in keep]
+            if context is not None:
+                context = [context[index] for index in keep]
+        result['matches'].extend(matches)
+        result['spans'].extend(spans)
+        if context is not None:
+            result['context'].extend(context)
+        if state['line'] is not None:
+            state['line'] += text.count('\n')
+
+    @staticmethod
+    def count_lines_before(path, offset, encoding):
+        """Count the newlines in a file's first `offset` bytes (once per file, for line numbers)."""
+        newline = newline_bytes(encoding)
+        with open(path, 'rb') as f:
+            if len(newline) > 1:
+                return f.read(offset).decode(encoding, 'replace').count('\n')
+            if offset == 0:
+                return 0
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                return count_newlines(buffer, 0, min(offset, len(buffer)))
+
+def iter_watch_results(watcher, interval=DEFAULT_WATCH_INTERVAL, cancel_event=None):
+    """Poll a started FileWatcher every `interval` seconds (sooner with inotify) and yield its new results."""
+    while cancel_event is None or not cancel_event.is_set():
+        watcher.wait(interval, cancel_event)
+        if cancel_event is not None and cancel_event.is_set():
+            return
+        yield from watcher.poll()
+
+def watch_files(watcher, output_widget, interval=DEFAULT_WATCH_INTERVAL, cancel_event=None,
+                max_matches_shown=None):
+    """
+    After a process_files run that fed `watcher`, keep logging the matches
+    in new and appended lines (see FileWatcher) until cancel_event is set.
+    """
+    watcher.start()
+    how = "inotify" if watcher.notifier is not None else f"checking every {interval:g} s"
+    output_widget.insert(END, f"Watching {len(watcher.files)} files for new lines ({how}); cancel to stop.\n")
+    output_widget.see(END)
+    try:
+        for result in iter_watch_results(watcher, interval, cancel_event):
+            if result['restarted']:
+                output_widget.insert(END, f"Searching again from the top (truncated or replaced): {result['path']}\n")
+            log_result_matches(output_widget, result, max_matches_shown, label='NEW MATCH')
+            output_widget.see(END)
+    finally:
+        watcher.close()
+    output_widget.insert(END, "Stopped watching.\n")
+    output_widget.see(END)
+
+class QueuedOutput:
+    """
+    Write-only stand-in for the console Text widget.
+    process_files only calls insert() and see(), so a background thread can
+    write here while RegexApp drains the queue on the Tk event loop.
+    """
+    def __init__(self, message_queue):
+        self.message_queue = message_queue
+
+    def insert(self, index, text):
+        self.message_queue.put(('text', text))
+
+    def insert_matches(self, index, text, prefix, matches):
+        self.message_queue.put(('matches', (text, prefix, matches)))
+
+    def see(self, index):
+        pass
+
+class ResultStore:
+    """
+    Every line of console output, kept outside the Tk widget so the view
+    only has to draw the rows on screen (see ResultsView).
+
+    Rows are appended with insert(); lines whose match list was cut short
+    (log_matches) keep the full list, which toggle() unfolds into one row per
+    match and folds back again. An entry with prefix None holds the remaining
+    console lines of log_match_lines instead. Full lists stay in memory until they add up
+    to spill_bytes, after which they go to a private temporary SQLite
+    database that is deleted on close().
+    """
+    # Second field of a row: None for plain text, an entry key for a folded
+    # match list, or EXPANDED_ROW for a match shown by an unfolded entry
+    EXPANDED_ROW = -1
+
+    def __init__(self, spill_bytes=RESULT_STORE_SPILL_BYTES):
+        self.spill_bytes = spill_bytes
+        self.rows = []
+        self.line_open = False  # the last row has not seen its '\n' yet
+        self.entries = {}       # key -> (prefix, matches) while in memory
+        self.entry_count = 0
+        self.memory_bytes = 0
+        self.spill = None
+        self.expanded = {}      # key -> number of rows it unfolded into
+
+    def __len__(self):
+        return len(self.rows)
+
+    def insert(self, index, text):
+        """Append text (the index is ignored; output always goes to the end)."""
+        lines = text.split('\n')
+        if self.line_open:
+            self.rows[-1] = (self.rows[-1][0] + lines[0], self.rows[-1][1])
+        else:
+            self.rows.append((lines[0], None))
+        self.rows.extend((line, None) for line in lines[1:-1])
+        if lines[-1] or len(lines) == 1:
+            if len(lines) > 1:
+                self.rows.append((lines[-1], None))
+            self.line_open = True
+        else:
+            self.line_open = False
+
+    def insert_matches(self, index, text, prefix, matches):
+        """Append a folded match line, keeping the full list for toggle() and export()."""
+        if self.line_open:
+            self.insert(index, '\n')
+        key = self.entry_count
+        self.entry_count += 1
+        self.store_entry(key, prefix, matches)
+        self.rows.append((text.rstrip('\n'), key))
+        self.line_open = False
+
+    def see(self, index):
+        pass
+
+    def store_entry(self, key, prefix, matches):
+        if self.spill is None:
+            self.entries[key] = (prefix, matches)
+            self.memory_bytes += len(prefix or '') + sum(len(f"{m}") for m in matches)
+            if self.memory_bytes <= self.spill_bytes:
+                return
+            # An empty file name gives a private on-disk database that SQLite removes itself
+            self.spill = sqlite3.connect('')
+            self.spill.execute("CREATE TABLE entries (key INTEGER PRIMARY KEY, prefix TEXT, matches TEXT)")
+            entries, self.entries = self.entries, {}
+            self.memory_bytes = 0
+            for old_key, (old_prefix, old_matches) in entries.items():
+                self.store_entry(old_key, old_prefix, old_matches)
+            return
+        self.spill.execute("INSERT INTO entries VALUES (?, ?, ?)", (key, prefix, json.dumps(matches)))
+
+    def get_entry(self, key):
+        """Return (prefix, full_match_list) for an entry key."""
+        if key in self.entries:
+            return self.entries[key]
+        prefix, matches = self.spill.execute(
+            "SELECT prefix, matches FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        return prefix, [tuple(m) if isinstance(m, list) else m for m in json.loads(matches)]
+
+    def is_foldable(self, row):
+        return 0 <= row < len(self.rows) and self.rows[row][1] not in (None, self.EXPANDED_ROW)
+
+    def toggle(self, row):
+        """Unfold a folded match line into one row per match, or fold it back. Returns True if rows changed."""
+        if not self.is_foldable(row):
+            return False
+        key = self.rows[row][1]
+        if key in self.expanded:
+            del self.rows[row + 1:row + 1 + self.expanded.pop(key)]
+            return True
+        _, matches = self.get_entry(key)
+        self.rows[row + 1:row + 1] = [(f"    {match}", self.EXPANDED_ROW) for match in matches]
+        self.expanded[key] = len(matches)
+        return True
+
+    def export(self, path):
+        """Write the whole output to a text file, with every match list in full."""
+        with open(path, 'w', encoding='utf-8') as f:
+            for text, key in self.rows:
+                if key == self.EXPANDED_ROW:
+                    continue
+                if key is not None:
+                    prefix, matches = self.get_entry(key)
+                    if prefix is None:
+                        f.write(''.join(f"    {line}\n" for line in matches))
+                        continue
+                    text = f"{prefix}{matches}"
+                f.write(text + '\n')
+
+    def clear(self):
+        self.close()
+        self.__init__(self.spill_bytes)
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+
+class ResultsView:
+    """
+    Console for a ResultStore that only ever holds the visible rows in its
+    Tk Text widget, so the cost of drawing does not grow with the output.
+    The scrollbar and mouse wheel move a window over the store; clicking a
+    folded match line (ending in "(+N more)") unfolds or folds it.
+    Follows new output while scrolled to the bottom.
+
+    Offers insert()/see() like a Text widget; insert() only records the
+    text, and the screen is redrawn on see() or refresh().
+    """
+    def __init__(self, parent, store, height=15):
+        self.store = store
+        self.first = 0
+        self.follow = True
+
+        frame = tk.Frame(parent)
+        frame.pack(fill=tk.BOTH, expand=True)
+        self.scrollbar = tk.Scrollbar(frame, orient=tk.VERTICAL, command=self.yview)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.text = tk.Text(frame, height=height, wrap=tk.NONE, cursor='arrow')
+        self.text.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.text.tag_configure('foldable', foreground='blue')
+        self.height = height
+
+        self.text.bind('<Configure>', self.on_configure)
+        self.text.bind('<MouseWheel>', lambda e: self.scroll(-1 if e.delta > 0 else 1, 'units'))
+        self.text.bind('<Button-4>', lambda e: self.scroll(-1, 'units'))
+        self.text.bind('<Button-5>', lambda e: self.scroll(1, 'units'))
+        self.text.bind('<Button-1>', self.on_click)
+        # Keep the text read-only without disabling it (which would also block selection)
+        self.text.bind('<Key>', lambda e: None if e.state & 0x4 else 'break')
+
+    def insert(self, index, text):
+        self.store.insert(index, text)
+
+    def insert_matches(self, index, text, prefix, matches):
+        self.store.insert_matches(index, text, prefix, matches)
+
+    def see(self, index):
+        self.follow = True
+        self.refresh()
+
+    def clear(self):
+        self.store.clear()
+        self.first = 0
+        self.follow = True
+        self.refresh()
+
+    def on_configure(self, event):
+        line_height = max(1, tk.font.Font(font=self.text['font']).metrics('linespace'))
+        self.height = max(1, event.height // line_height)
+        self.refresh()
+
+    def refresh(self):
+        """Redraw the rows currently in view."""
+        total = len(self.store)
+        if self.follow:
+            self.first = max(0, total - self.height)
+        self.first = max(0, min(self.first, total - self.height))
+        last = min(total, self.first + self.height)
+
+        self.text.delete('1.0', tk.END)
+        for row in range(self.first, last):
+            text, _ = self.store.rows[row]
+            tags = ('foldable',) if self.store.is_foldable(row) else ()
+            self.text.insert(tk.END, text + ('\n' if row < last - 1 else ''), tags)
+        if total:
+            self.scrollbar.set(self.first / total, last / total)
+        else:
+            self.scrollbar.set(0, 1)
+
+    def scroll(self, amount, what):
+        step = self.height if what == 'pages' else 1
+        self.first = max(0, self.first + amount * step)
+        self.follow = self.first + self.height >= len(self.store)
+        self.refresh()
+        return 'break'
+
+    def yview(self, *args):
+        """Scrollbar callback: ('moveto', fraction) or ('scroll', n, 'units'|'pages')."""
+        if args[0] == 'moveto':
+            self.first = int(float(args[1]) * len(self.store))
+            self.follow = self.first + self.height >= len(self.store)
+            self.refresh()
+        elif args[0] == 'scroll':
+            self.scroll(int(args[1]), args[2])
+
+    def on_click(self, event):
+        line = int(self.text.index(f'@{event.x},{event.y}').split('.')[0])
+        if self.store.toggle(self.first + line - 1):
+            self.follow = False
+            self.refresh()
+
+class LivePreview:
+    """
+    Highlights the pattern's matches in a Text widget while the pattern or
+    the text is being edited (Multiline String mode).
+
+    Each change bumps a generation number and (re)starts a short timer, so a
+    search only starts once typing pauses for LIVE_PREVIEW_DELAY_MS. The
+    search runs on a background thread; a search that finds its generation
+    out of date stops between two matches, and its result is dropped. Only
+    the matches in view are tagged, and they are re-tagged as the view
+    scrolls, so a multi-MB sample is as quick to redraw as a short one.
+    A search stuck in one match cannot be stopped that way, so patterns that
+    could backtrack without end are not previewed (preview_may_hang).
+
+    get_query returns (pattern, flags, engine, match_timeout), or None
+    while the preview is off.
+    """
+    TAG = 'live_match'
+
+    def __init__(self, root, text_widget, status_var, get_query):
+        self.root = root
+        self.text = text_widget
+        self.status_var = status_var
+        self.get_query = get_query
+        self.generation = 0
+        self.after_id = None
+        self.redraw_pending = False
+
+        # The latest search not yet taken by the thread (older ones are replaced)
+        self.condition = threading.Condition()
+        self.request = None
+        self.results = queue.Queue()
+        self.thread = None
+        self.requested = None
+        self.waiting = False
+
+        # Matches of the last finished search, as sorted start/end offsets
+        self.line_index = None
+        self.starts = []
+        self.ends = []
+
+        self.text.tag_configure(self.TAG, background='#ffe680')
+        self.text.tag_raise('sel')
+        self.text.configure(yscrollcommand=self.on_view_change)
+        self.text.bind('<<Modified>>', self.on_text_modified, add='+')
+
+    def schedule(self, *args):
+        """Start a new search once the input has been left alone for a moment (also a trace callback)."""
+        self.generation += 1
+        if self.after_id is not None:
+            self.root.after_cancel(self.after_id)
+        self.after_id = self.root.after(LIVE_PREVIEW_DELAY_MS, self.evaluate)
+
+    def on_text_modified(self, event):
+        if not self.text.edit_modified():
+            return
+        self.text.edit_modified(False)
+        # The offsets no longer fit the text; the tags already shown move with it
+        self.line_index = None
+        self.schedule()
+
+    def clear(self, status=''):
+        self.line_index = None
+        self.starts = []
+        self.ends = []
+        self.text.tag_remove(self.TAG, '1.0', tk.END)
+        self.status_var.set(status)
+
+    def evaluate(self):
+        """Hand the current pattern and text to the search thread."""
+        self.after_id = None
+        query = self.get_query()
+        if query is None or not query[0]:
+            self.clear()
+            return
+        pattern, flags, engine, match_timeout = query
+        try:
+            compiled_pattern = compile_pattern(pattern, flags, engine)
+        except re.error as e:
+            self.clear(f"Live preview: invalid regex: {e}")
+            return
+        if preview_may_hang(pattern, flags, engine, match_timeout):
+            self.clear("Live preview: off for nested quantifiers such as (a+)+, which could freeze "
+                       "the window (use RE2, or 'regex' with a timeout)")
+            return
+        # Only the 'regex' engine can be timed out off the main thread
+        if match_timeout and resolve_engine(pattern, flags, engine) != 'regex':
+            match_timeout = None
+
+        self.requested = self.generation
+        with self.condition:
+            self.request = (self.generation, self.text.get('1.0', 'end-1c'), compiled_pattern, match_timeout)
+            self.condition.notify()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        self.status_var.set("Live preview: searching...")
+        if not self.waiting:
+            self.waiting = True
+            self.root.after(OUTPUT_POLL_MS, self.poll)
+
+    def run(self):
+        """Search thread: run the latest request, over and over."""
+        while True:
+            with self.condition:
+                while self.request is None:
+                    self.condition.wait()
+                generation, text, compiled_pattern, match_timeout = self.request
+                self.request = None
+
+            started = time.perf_counter()
+            spans = None
+            error = None
+            try:
+                if match_timeout:
+                    compiled_pattern = TimeLimitedPattern(compiled_pattern, match_timeout)
+                spans = preview_spans(text, compiled_pattern, lambda: self.generation != generation)
+            except MatchTimeout as e:
+                error = f"gave up on the pattern: {e}"
+            except Exception as e:
+                error = str(e)
+            if spans is None and error is None:
+                continue  # stale
+            result = {'generation': generation, 'error': error, 'elapsed': time.perf_counter() - started}
+            if spans is not None:
+                result['line_index'] = LineIndex(text)
+                result['starts'] = [start for start, _ in spans]
+                result['ends'] = [end for _, end in spans]
+            self.results.put(result)
+
+    def poll(self):
+        """Pick up the current generation's result, if the search has finished."""
+        current = None
+        try:
+            while True:
+                result = self.results.get_nowait()
+                if result['generation'] == self.generation:
+                    current = result
+        except queue.Empty:
+            pass
+
+        if current is None:
+            if self.requested == self.generation:
+                self.root.after(OUTPUT_POLL_MS, self.poll)
+            else:
+                self.waiting = False  # a newer search will poll for itself
+            return
+        self.waiting = False
+
+        if current['error'] is not None:
+            self.clear(f"Live preview: {current['error']}")
+            return
+        self.line_index = current['line_index']
+        self.starts = current['starts']
+        self.ends = current['ends']
+        count = len(self.starts)
+        more = '+' if count == LIVE_PREVIEW_MAX_MATCHES else ''
+        self.status_var.set(f"Live preview: {count}{more} match{'es' if count != 1 else ''} "
+                            f"({current['elapsed'] * 1000:.0f} ms)")
+        self.redraw()
+
+    def on_view_change(self, first, last):
+        """yscrollcommand: the view moved or was resized, so re-tag once things settle."""
+        if not self.redraw_pending:
+            self.redraw_pending = True
+            self.root.after_idle(self.redraw)
+
+    def offset_of(self, index):
+        """Character offset (in the searched text) of a Tk "line.column" index."""
+        line, column = map(int, self.text.index(index).split('.'))
+        starts = self.line_index.starts
+        if line > len(starts):
+            return self.ends[-1] if self.ends else 0
+        return starts[line - 1] + column
+
+    def tk_index(self, offset):
+        line, column = self.line_index.locate(offset)
+        return f"{line}.{column - 1}"
+
+    def redraw(self):
+        """Tag the matches that are at least partly in view, and only those."""
+        self.redraw_pending = False
+        if self.line_index is None:
+            return
+        self.text.tag_remove(self.TAG, '1.0', tk.END)
+        first = self.offset_of('@0,0')
+        last = self.offset_of(f'@{self.text.winfo_width()},{self.text.winfo_height()}') + 1
+        # Matches do not overlap, so their ends are sorted as well as their starts
+        begin = bisect.bisect_right(self.ends, first)
+        stop = bisect.bisect_left(self.starts, last)
+        for start, end in zip(self.starts[begin:stop], self.ends[begin:stop]):
+            if end > start:
+                self.text.tag_add(self.TAG, self.tk_index(start), self.tk_index(end))
+
+class RegexApp:
+    def __init__(self, root):
+        self.root = root
+        self.root.title("Regex Utility")
+
+        # 1) Frame: Input Source (directory vs. single file vs. multiline string)
+        input_src_frame = tk.Frame(root, padx=10, pady=5)
+        input_src_frame.pack(fill=tk.X)
+
+        tk.Label(input_src_frame, text="Input Source:").pack(side=tk.LEFT)
+        self.input_type_var = tk.StringVar(value='directory')
+
+        tk.Radiobutton(
+            input_src_frame, text="Directory", variable=self.input_type_var,
+            value='directory', command=self.update_ui_for_input_type
+        ).pack(side=tk.LEFT, padx=5)
+
+        tk.Radiobutton(
+            input_src_frame, text="Single File", variable=self.input_type_var,
+            value='single', command=self.update_ui_for_input_type
+        ).pack(side=tk.LEFT, padx=5)
+
+        tk.Radiobutton(
+            input_src_frame, text="Multiline String", variable=self.input_type_var,
+            value='string', command=self.update_ui_for_input_type
+        ).pack(side=tk.LEFT, padx=5)
+
+        # 2) Frame that will contain either path_frame or text_frame
+        self.input_details_frame = tk.Frame(root, padx=10, pady=5)
+        self.input_details_frame.pack(fill=tk.X)
+
+        # 2a) Path frame (for directory/single-file)
+        self.path_frame = tk.Frame(self.input_details_frame)
+        tk.Label(self.path_frame, text="Path:").pack(side=tk.LEFT)
+        self.path_var = tk.StringVar()
+        self.path_entry = tk.Entry(self.path_frame, textvariable=self.path_var, width=50)
+        self.path_entry.pack(side=tk.LEFT, padx=5)
+        self.browse_button = tk.Button(self.path_frame, text="Browse", command=self.on_browse)
+        self.browse_button.pack(side=tk.LEFT, padx=5)
+
+        # 2b) Extension filter frame (only applies to 'directory')
+        self.ext_filter_frame = tk.Frame(self.input_details_frame, pady=2)
+        tk.Label(self.ext_filter_frame, text="File Extension Filter (optional):").pack(side=tk.LEFT)
+        self.extension_var = tk.StringVar()
+        self.ext_entry = tk.Entry(self.ext_filter_frame, textvariable=self.extension_var, width=16)
+        self.ext_entry.pack(side=tk.LEFT, padx=5)
+
+        # 2b') Walk prefilters (only apply to 'directory')
+        self.walk_filter_frame = tk.Frame(self.input_details_frame, pady=2)
+        tk.Label(self.walk_filter_frame, text="Exclude dirs:").pack(side=tk.LEFT)
+        self.exclude_dirs_var = tk.StringVar(value=DEFAULT_EXCLUDE_DIRS)
+        tk.Entry(self.walk_filter_frame, textvariable=self.exclude_dirs_var, width=30).pack(side=tk.LEFT, padx=5)
+        tk.Label(self.walk_filter_frame, text="Max file size (MB):").pack(side=tk.LEFT, padx=(10, 0))
+        self.max_size_var = tk.StringVar()
+        tk.Entry(self.walk_filter_frame, textvariable=self.max_size_var, width=6).pack(side=tk.LEFT, padx=5)
+        self.skip_binary_var = tk.BooleanVar(value=True)
+        tk.Checkbutton(
+            self.walk_filter_frame, text="Skip binary files", variable=self.skip_binary_var
+        ).pack(side=tk.LEFT, padx=5)
+        self.use_ignore_files_var = tk.BooleanVar(value=True)
+        tk.Checkbutton(
+            self.walk_filter_frame, text="Honour .gitignore", variable=self.use_ignore_files_var
+        ).pack(side=tk.LEFT, padx=5)
+
+        # 2c) Text frame (for multiline string)
+        self.text_frame = tk.Frame(self.input_details_frame)
+        tk.Label(self.text_frame, text="Enter/paste your text below:").pack(anchor='w')
+
+        # Set default (minimum) height to 1
+        self.text_widget = tk.Text(self.text_frame, height=1, wrap=tk.WORD)
+        self.text_widget.pack(fill=tk.X, expand=True)
+        self.text_widget.bind("<KeyRelease>", self.auto_resize_text)
+
+        # 2d) Live preview of the matches in the text box
+        preview_frame = tk.Frame(self.text_frame)
+        preview_frame.pack(fill=tk.X)
+        self.live_preview_var = tk.BooleanVar(value=True)
+        tk.Checkbutton(
+            preview_frame, text="Live preview", variable=self.live_preview_var,
+            command=self.on_live_preview_toggle
+        ).pack(side=tk.LEFT)
+        self.preview_status_var = tk.StringVar(value='')
+        tk.Label(preview_frame, textvariable=self.preview_status_var, anchor='w').pack(side=tk.LEFT, padx=5)
+        self.live_preview = LivePreview(root, self.text_widget, self.preview_status_var, self.get_live_query)
+
+        # 3) Frame: Regex pattern
+        regex_frame = tk.Frame(root, padx=10, pady=5)
+        regex_frame.pack(fill=tk.X)
+        tk.Label(regex_frame, text="Regex pattern:").pack(side=tk.LEFT)
+        self.regex_var = tk.StringVar()
+        self.regex_entry = tk.Entry(regex_frame, textvariable=self.regex_var, width=50)
+        self.regex_entry.pack(side=tk.LEFT, padx=5)
+
+        # 3a) Frame: Regex flags (also applied to every rule of a rule set)
+        flags_frame = tk.Frame(root, padx=10, pady=0)
+        flags_frame.pack(fill=tk.X)
+        self.flag_vars = {}
+        for name, label in (('IGNORECASE', "Ignore case"), ('MULTILINE', "^/$ at every line"),
+                            ('DOTALL', ". matches newline"), ('VERBOSE', "Verbose")):
+            self.flag_vars[name] = tk.BooleanVar(value=False)
+            tk.Checkbutton(flags_frame, text=label, variable=self.flag_vars[name]).pack(side=tk.LEFT, padx=5)
+        tk.Label(flags_frame, text="Engine:").pack(side=tk.LEFT, padx=(15, 0))
+        self.engine_var = tk.StringVar(value='auto')
+        tk.OptionMenu(flags_frame, self.engine_var, *ENGINES).pack(side=tk.LEFT, padx=5)
+        tk.Label(flags_frame, text="Search timeout (s):").pack(side=tk.LEFT, padx=(15, 0))
+        self.match_timeout_var = tk.StringVar(value=str(DEFAULT_MATCH_TIMEOUT))
+        tk.Entry(flags_frame, textvariable=self.match_timeout_var, width=6).pack(side=tk.LEFT, padx=5)
+        for var in (self.regex_var, self.engine_var, *self.flag_vars.values()):
+            var.trace_add('write', self.live_preview.schedule)
+
+        # 3b) Frame: Rule set (replaces the single pattern for files/directories)
+        rules_frame = tk.Frame(root, padx=10, pady=5)
+        rules_frame.pack(fill=tk.X)
+        tk.Label(rules_frame, text="Rules file (optional):").pack(side=tk.LEFT)
+        self.rules_path_var = tk.StringVar()
+        tk.Entry(rules_frame, textvariable=self.rules_path_var, width=40).pack(side=tk.LEFT, padx=5)
+        tk.Button(rules_frame, text="Browse", command=self.on_browse_rules).pack(side=tk.LEFT, padx=5)
+
+        # 3c) Frame: Where matches are (Just Match)
+        location_frame = tk.Frame(root, padx=10, pady=0)
+        location_frame.pack(fill=tk.X)
+        self.show_lines_var = tk.BooleanVar(value=True)
+        tk.Checkbutton(
+            location_frame, text="Show matching lines", variable=self.show_lines_var
+        ).pack(side=tk.LEFT, padx=5)
+        tk.Label(location_frame, text="Context lines:").pack(side=tk.LEFT, padx=(15, 0))
+        self.context_lines_var = tk.StringVar(value='0')
+        tk.Entry(location_frame, textvariable=self.context_lines_var, width=4).pack(side=tk.LEFT, padx=5)
+        tk.Label(location_frame, text="Stop after matches per file:").pack(side=tk.LEFT, padx=(15, 0))
+        self.max_count_var = tk.StringVar(value='')
+        tk.Entry(location_frame, textvariable=self.max_count_var, width=6).pack(side=tk.LEFT, padx=5)
+        self.search_archives_var = tk.BooleanVar(value=True)
+        tk.Checkbutton(
+            location_frame, text="Search inside archives", variable=self.search_archives_var
+        ).pack(side=tk.LEFT, padx=(15, 5))
+
+        # 3d) Frame: Watch mode (Just Match on files/directories)
+        watch_frame = tk.Frame(root, padx=10, pady=0)
+        watch_frame.pack(fill=tk.X)
+        self.watch_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(
+            watch_frame, text="Keep watching for new lines (Just Match)", variable=self.watch_var
+        ).pack(side=tk.LEFT, padx=5)
+        tk.Label(watch_frame, text="Check every (s):").pack(side=tk.LEFT, padx=(15, 0))
+        self.watch_interval_var = tk.StringVar(value=f"{DEFAULT_WATCH_INTERVAL:g}")
+        tk.Entry(watch_frame, textvariable=self.watch_interval_var, width=6).pack(side=tk.LEFT, padx=5)
+
+        # 4) Frame: Operation mode
+        mode_frame = tk.Frame(root, padx=10, pady=5)
+        mode_frame.pack(fill=tk.X)
+        tk.Label(mode_frame, text="Operation Mode:").pack(side=tk.LEFT)
+        self.mode_var = tk.StringVar(value='match')
+
+        tk.Radiobutton(
+            mode_frame, text="Just Match",
+            variable=self.mode_var, value='match',
+            command=self.update_replacement_state
+        ).pack(side=tk.LEFT, padx=5)
+
+        tk.Radiobutton(
+            mode_frame, text="Invert Match",
+            variable=self.mode_var, value='invert',
+            command=self.update_replacement_state
+        ).pack(side=tk.LEFT, padx=5)
+
+        tk.Radiobutton(
+            mode_frame, text="Replace",
+            variable=self.mode_var, value='replace',
+            command=self.update_replacement_state
+        ).pack(side=tk.LEFT, padx=5)
+
+        # 5) Frame: Replacement pattern
+        replace_frame = tk.Frame(root, padx=10, pady=5)
+        replace_frame.pack(fill=tk.X)
+        tk.Label(replace_frame, text="Replacement pattern:").pack(side=tk.LEFT)
+        self.replace_var = tk.StringVar()
+        self.replace_entry = tk.Entry(replace_frame, textvariable=self.replace_var, width=50)
+        self.replace_entry.pack(side=tk.LEFT, padx=5)
+
+        # 5b) Frame: Large file streaming
+        stream_frame = tk.Frame(root, padx=10, pady=5)
+        stream_frame.pack(fill=tk.X)
+        tk.Label(stream_frame, text="Stream files larger than (MB):").pack(side=tk.LEFT)
+        self.stream_threshold_var = tk.StringVar(value=str(DEFAULT_STREAM_THRESHOLD // (1024 * 1024)))
+        tk.Entry(stream_frame, textvariable=self.stream_threshold_var, width=6).pack(side=tk.LEFT, padx=5)
+        tk.Label(stream_frame, text="Max match length:").pack(side=tk.LEFT, padx=(10, 0))
+        self.max_match_length_var = tk.StringVar(value=str(DEFAULT_MAX_MATCH_LENGTH))
+        tk.Entry(stream_frame, textvariable=self.max_match_length_var, width=7).pack(side=tk.LEFT, padx=5)
+        tk.Label(stream_frame, text="Split at:").pack(side=tk.LEFT, padx=(10, 0))
+        self.boundary_var = tk.StringVar(value='lines')
+        tk.Radiobutton(
+            stream_frame, text="Line ends", variable=self.boundary_var, value='lines'
+        ).pack(side=tk.LEFT)
+        tk.Radiobutton(
+            stream_frame, text="Fixed window", variable=self.boundary_var, value='window'
+        ).pack(side=tk.LEFT)
+
+        # 5c) Frame: Speed-ups that skip decoding or regex work
+        speedup_frame = tk.Frame(root, padx=10, pady=5)
+        speedup_frame.pack(fill=tk.X)
+        tk.Label(speedup_frame, text="Speed-ups:").pack(side=tk.LEFT)
+        self.use_mmap_var = tk.BooleanVar(value=True)
+        tk.Checkbutton(
+            speedup_frame, text="Byte-level search (Just Match)", variable=self.use_mmap_var
+        ).pack(side=tk.LEFT, padx=5)
+        self.use_prefilter_var = tk.BooleanVar(value=True)
+        tk.Checkbutton(
+            speedup_frame, text="Literal prefilter", variable=self.use_prefilter_var
+        ).pack(side=tk.LEFT, padx=5)
+        self.use_cache_var = tk.BooleanVar(value=True)
+        tk.Checkbutton(
+            speedup_frame, text="Reuse cached results (Just Match)", variable=self.use_cache_var
+        ).pack(side=tk.LEFT, padx=5)
+        self.force_rescan_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(
+            speedup_frame, text="Force full scan", variable=self.force_rescan_var
+        ).pack(side=tk.LEFT, padx=5)
+
+        # 5d) Frame: Write-back options (Invert Match / Replace)
+        write_frame = tk.Frame(root, padx=10, pady=5)
+        write_frame.pack(fill=tk.X)
+        self.preserve_mtime_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(
+            write_frame, text="Preserve modification times", variable=self.preserve_mtime_var
+        ).pack(side=tk.LEFT, padx=5)
+        self.use_journal_var = tk.BooleanVar(value=True)
+        tk.Checkbutton(
+            write_frame, text="Keep backups for undo", variable=self.use_journal_var
+        ).pack(side=tk.LEFT, padx=5)
+        self.undo_button = tk.Button(
+            write_frame, text="Undo last run", command=self.on_undo, state=tk.DISABLED
+        )
+        self.undo_button.pack(side=tk.LEFT, padx=5)
+        self.last_journal = None
+        tk.Label(write_frame, text="Dry run:").pack(side=tk.LEFT, padx=(15, 0))
+        self.dry_run_var = tk.StringVar(value='')
+        for label, value in (("Off", ''), ("Statistics", 'stats'), ("Unified diff", 'diff')):
+            tk.Radiobutton(
+                write_frame, text=label, variable=self.dry_run_var, value=value
+            ).pack(side=tk.LEFT)
+
+        # 6) Frame: Process / Cancel buttons and worker count
+        button_frame = tk.Frame(root, padx=10, pady=5)
+        button_frame.pack(fill=tk.X)
+        self.process_button = tk.Button(button_frame, text="Process", command=self.on_process)
+        self.process_button.pack(side=tk.LEFT)
+        self.cancel_button = tk.Button(
+            button_frame, text="Cancel", command=self.on_cancel, state=tk.DISABLED
+        )
+        self.cancel_button.pack(side=tk.LEFT, padx=5)
+        tk.Button(button_frame, text="Export...", command=self.on_export).pack(side=tk.LEFT, padx=5)
+        self.report_button = tk.Button(
+            button_frame, text="Save report...", command=self.on_save_report, state=tk.DISABLED
+        )
+        self.report_button.pack(side=tk.LEFT, padx=5)
+        tk.Label(button_frame, text="Workers:").pack(side=tk.LEFT, padx=(15, 0))
+        self.workers_var = tk.IntVar(value=DEFAULT_WORKERS)
+        tk.Spinbox(
+            button_frame, from_=1, to=max(64, DEFAULT_WORKERS),
+            textvariable=self.workers_var, width=4
+        ).pack(side=tk.LEFT, padx=5)
+        tk.Label(button_frame, text="Matches shown per file:").pack(side=tk.LEFT, padx=(15, 0))
+        self.max_matches_var = tk.StringVar(value=str(DEFAULT_MAX_MATCHES_SHOWN))
+        tk.Entry(button_frame, textvariable=self.max_matches_var, width=6).pack(side=tk.LEFT, padx=5)
+
+        # 6b) Progress of the current (or last) run
+        self.progress = None
+        self.progress_var = tk.StringVar(value='')
+        tk.Label(root, textvariable=self.progress_var, anchor='w', padx=10).pack(fill=tk.X)
+        self.stages_var = tk.StringVar(value='')
+        tk.Label(root, textvariable=self.stages_var, anchor='w', padx=10).pack(fill=tk.X)
+
+        # 7) Frame: Output (log)
+        output_frame = tk.Frame(root, padx=10, pady=10)
+        output_frame.pack(fill=tk.BOTH, expand=True)
+        tk.Label(output_frame, text="Console Output:").pack(anchor="w")
+        self.result_store = ResultStore()
+        self.output_text = ResultsView(output_frame, self.result_store, height=15)
+
+        # Background run state (see start_background_run)
+        self.message_queue = queue.Queue()
+        self.cancel_event = None
+        self.worker_thread = None
+        self.watching = False
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+
+        # Initialize UI
+        self.update_ui_for_input_type()
+        self.update_replacement_state()
+
+    def update_ui_for_input_type(self):
+        """ Show path_frame + extension filter if directory, or just path_frame if single file, or text_frame if string. """
+        input_type = self.input_type_var.get()
+
+        # Hide all relevant frames first
+        self.path_frame.pack_forget()
+        self.ext_filter_frame.pack_forget()
+        self.walk_filter_frame.pack_forget()
+        self.text_frame.pack_forget()
+
+        if input_type == 'directory':
+            # Show path frame and the extension filter frame
+            self.path_frame.pack(fill=tk.X)
+            self.ext_filter_frame.pack(fill=tk.X, padx=5)
+            self.walk_filter_frame.pack(fill=tk.X, padx=5)
+        elif input_type == 'single':
+            # Show path frame, hide extension filter
+            self.path_frame.pack(fill=tk.X)
+        else:  # 'string'
+            # Show text frame
+            self.text_frame.pack(fill=tk.X, expand=True)
+        self.live_preview.schedule()
+
+    def on_browse(self):
+        """Handle the Browse button for file/directory modes."""
+        input_type = self.input_type_var.get()
+        try:
+            if input_type == 'single':
+                filepath = filedialog.askopenfilename(
+                    title="Select a single file",
+                    filetypes=[("All files", "*.*")]
+                )
+                if filepath:
+                    self.path_var.set(filepath)
+            elif input_type == 'directory':
+                directory = filedialog.askdirectory(title="Select a directory containing files")
+                if directory:
+                    self.path_var.set(directory)
+        except Exception as e:
+            messagebox.showerror("Error", f"Error during file/directory selection: {e}")
+
+    def on_browse_rules(self):
+        """Handle the Browse button for the rules file."""
+        try:
+            rules_path = filedialog.askopenfilename(
+                title="Select a rules file",
+                filetypes=[("Rules files", "*.json *.tsv *.txt"), ("All files", "*.*")]
+            )
+            if rules_path:
+                self.rules_path_var.set(rules_path)
+        except Exception as e:
+            messagebox.showerror("Error", f"Error during file selection: {e}")
+
+    def update_replacement_state(self):
+        """Enable or disable the replacement pattern entry based on selected mode."""
+        mode = self.mode_var.get()
+        if mode == 'match':
+            self.replace_entry.configure(state=tk.DISABLED)
+            self.replace_var.set('')
+        else:
+            self.replace_entry.configure(state=tk.NORMAL)
+
+    def on_process(self):
+        """Collect user inputs and run the process."""
+        if self.worker_thread is not None:
+            return
+
+        input_type = self.input_type_var.get()  # 'single', 'directory', or 'string'
+        path = self.path_var.get().strip()
+        match_regex = self.regex_var.get().strip()
+        mode = self.mode_var.get()
+        replace_pattern = self.replace_var.get().strip() or None
+
+        # Only applies if user selected directory
+        extension_filter = None
+        if input_type == 'directory':
+            extension_filter = self.extension_var.get().strip() or None
+
+        # A rules file replaces the single pattern/mode/replacement for files
+        rules = None
+        rules_path = self.rules_path_var.get().strip()
+        if rules_path and input_type != 'string':
+            try:
+                rules = load_rules(rules_path, self.get_pattern_flags(), self.engine_var.get())
+            except (OSError, ValueError) as e:
+                messagebox.showerror("Invalid Rules File", f"Could not load rules: {e}")
+                return
+            if not rules:
+                messagebox.showwarning("Empty Rules File", "The rules file does not contain any rules.")
+                return
+            match_regex = None
+            replace_pattern = None
+            mode = 'rules'
+        elif not match_regex:
+            messagebox.showwarning("Missing Regex", "Please provide a regex pattern.")
+            return
+
+        modifies_files = mode in ('invert', 'replace') or (
+            rules is not None and any(rule_mode != 'match' for _, _, rule_mode in rules)
+        )
+        if self.dry_run_var.get():
+            modifies_files = False
+
+        watch = None
+        if self.watch_var.get() and input_type != 'string':
+            if mode != 'match':
+                messagebox.showwarning(
+                    "Watch Mode", "Watching for new lines only works in Just Match mode without a rules file."
+                )
+                return
+            watch = {
+                'roots': [path],
+                'extension_filter': extension_filter,
+                'walk_options': self.get_walk_options() if input_type == 'directory' else None,
+            }
+
+        # Warn if we're about to modify files
+        if modifies_files and input_type != 'string':
+            proceed = messagebox.askyesno(
+                "Warning",
+                "This operation may permanently modify files. Do you want to continue?"
+            )
+            if not proceed:
+                return
+
+        # Clear the output
+        self.output_text.clear()
+
+        try:
+            if input_type == 'string':
+                # Handle multiline string
+                text_input = self.text_widget.get("1.0", tk.END).rstrip('\n')
+                if not text_input:
+                    messagebox.showwarning("Empty Text", "Please enter or paste some text.")
+                    return
+
+                self.output_text.insert(tk.END, f"Starting processing in '{mode}' mode (Multiline String)...\n\n")
+                process_multiline_string(
+                    text_input=text_input,
+                    match_pattern=match_regex,
+                    mode=mode,
+                    replace_pattern=replace_pattern,
+                    output_widget=self.output_text,
+                    flags=self.get_pattern_flags(),
+                    engine=self.engine_var.get(),
+                    match_timeout=self.get_match_timeout()
+                )
+                self.output_text.insert(tk.END, "Processing complete.\n")
+                self.output_text.see(tk.END)
+                messagebox.showinfo("Done", "Processing completed!")
+
+            elif input_type == 'single':
+                # Single file
+                if not os.path.isfile(path):
+                    messagebox.showerror("Invalid File", "The selected path is not a valid file.")
+                    return
+                progress = RunProgress()
+                file_paths = progress.track_paths([path])
+
+                self.output_text.insert(tk.END, f"Starting processing in '{mode}' mode...\n\n")
+                self.start_background_run(
+                    progress=progress,
+                    file_paths=file_paths,
+                    match_pattern=match_regex,
+                    mode=mode,
+                    replace_pattern=replace_pattern,
+                    rules=rules,
+                    watch=watch
+                )
+
+            else:
+                # Directory
+                if not os.path.isdir(path):
+                    messagebox.showerror("Invalid Directory", "The selected path is not a valid directory.")
+                    return
+
+                # The walk runs lazily on its own thread and feeds the workers
+                # as files are found, so results start appearing right away.
+                # Tracking it there times the walk itself and adds up the sizes
+                # found so far for the ETA.
+                progress = RunProgress()
+                sizes = {}
+                file_paths = iter_prefetched(progress.track_paths(iter_file_paths(
+                    path,
+                    extension_filter=extension_filter,
+                    sizes=sizes,
+                    **self.get_walk_options()
+                ), sizes))
+
+                self.output_text.insert(tk.END, f"Starting processing in '{mode}' mode...\n\n")
+                self.start_background_run(
+                    progress=progress,
+                    file_paths=file_paths,
+                    match_pattern=match_regex,
+                    mode=mode,
+                    replace_pattern=replace_pattern,
+                    rules=rules,
+                    watch=watch
+                )
+
+        except Exception as e:
+            messagebox.showerror("Error", f"An unexpected error occurred: {e}")
+
+    def get_worker_count(self):
+        """Return the worker count from the spinbox, falling back to the default."""
+        try:
+            return max(1, int(self.workers_var.get()))
+        except (tk.TclError, ValueError):
+            return DEFAULT_WORKERS
+
+    def get_pattern_flags(self):
+        """Return the re flags ticked in the flags row."""
+        return pattern_flags(name for name, var in self.flag_vars.items() if var.get())
+
+    def get_match_timeout(self):
+        """Return the per-file timeout in seconds (None if the field is empty or 0)."""
+        try:
+            return max(0.0, float(self.match_timeout_var.get())) or None
+        except ValueError:
+            return DEFAULT_MATCH_TIMEOUT
+
+    def get_max_matches_shown(self):
+        """Return how many matches to list per file (None = all if the field is empty or 0)."""
+        try:
+            return max(0, int(self.max_matches_var.get())) or None
+        except ValueError:
+            return DEFAULT_MAX_MATCHES_SHOWN
+
+    def get_context_lines(self):
+        """Return the context line count, or None if matching lines are not shown."""
+        if not self.show_lines_var.get():
+            return None
+        try:
+            return max(0, int(self.context_lines_var.get()))
+        except ValueError:
+            return 0
+
+    def get_max_count(self):
+        """Return how many matches to take per file (None = all if the field is empty or 0)."""
+        try:
+            return max(0, int(self.max_count_var.get())) or None
+        except ValueError:
+            return None
+
+    def get_live_query(self):
+        """What the live preview searches for: (pattern, flags, engine, timeout), or None while it is off."""
+        if not self.live_preview_var.get() or self.input_type_var.get() != 'string':
+            return None
+        return self.regex_var.get().strip(), self.get_pattern_flags(), self.engine_var.get(), self.get_match_timeout()
+
+    def on_live_preview_toggle(self):
+        self.live_preview.schedule()
+
+    def get_watch_interval(self):
+        """Return the seconds between checks in watch mode, falling back to the default."""
+        try:
+            return max(0.1, float(self.watch_interval_var.get()))
+        except ValueError:
+            return DEFAULT_WATCH_INTERVAL
+
+    def get_walk_options(self):
+        """Collect the directory prefilter options passed to gather_file_paths."""
+        try:
+            max_size = int(float(self.max_size_var.get()) * 1024 * 1024)
+        except ValueError:
+            max_size = None
+        return {
+            'exclude_dirs': re.split(r'[,;]+', self.exclude_dirs_var.get()),
+            'max_size': max_size,
+            'skip_binary': self.skip_binary_var.get(),
+            'ignore_files': DEFAULT_IGNORE_FILES if self.use_ignore_files_var.get() else None,
+        }
+
+    def get_file_options(self):
+        """Collect the per-file options (flags, streaming, speed-ups, result cache) for process_files."""
+        try:
+            stream_threshold = int(float(self.stream_threshold_var.get()) * 1024 * 1024)
+        except ValueError:
+            stream_threshold = DEFAULT_STREAM_THRESHOLD
+        try:
+            max_match_length = max(1, int(self.max_match_length_var.get()))
+        except ValueError:
+            max_match_length = DEFAULT_MAX_MATCH_LENGTH
+        return {
+            'stream_threshold': stream_threshold,
+            'max_match_length': max_match_length,
+            'boundary': self.boundary_var.get(),
+            'use_mmap': self.use_mmap_var.get(),
+            'use_prefilter': self.use_prefilter_var.get(),
+            'cache_path': default_cache_path() if self.use_cache_var.get() else None,
+            'force_rescan': self.force_rescan_var.get(),
+            'preserve_mtime': self.preserve_mtime_var.get(),
+            'dry_run': self.dry_run_var.get() or None,
+            'flags': self.get_pattern_flags(),
+            'engine': self.engine_var.get(),
+            'match_timeout': self.get_match_timeout(),
+            'context_lines': self.get_context_lines(),
+            'max_count': self.get_max_count(),
+            'search_archives': self.search_archives_var.get(),
+        }
+
+    def start_background_run(self, **process_kwargs):
+        """
+        Run process_files on a background thread so the window stays responsive.
+        Output is funnelled through a QueuedOutput and drained by poll_messages.
+        With watch (roots, extension_filter, walk_options), the run goes on
+        with watch_files until it is cancelled.
+        """
+        watch = process_kwargs.pop('watch', None)
+        process_kwargs.update(self.get_file_options())
+        process_kwargs['max_matches_shown'] = self.get_max_matches_shown()
+        if process_kwargs['mode'] != 'match' and self.use_journal_var.get() and not process_kwargs['dry_run']:
+            # Only the last run can be undone; its predecessor's backups go
+            if self.last_journal is not None:
+                shutil.rmtree(self.last_journal, ignore_errors=True)
+                self.last_journal = None
+            try:
+                self.last_journal = create_journal()
+            except OSError as e:
+                messagebox.showerror("Error", f"Could not create the undo journal: {e}")
+                return
+            process_kwargs['journal_dir'] = self.last_journal
+            self.undo_button.configure(state=tk.NORMAL)
+
+        self.progress = process_kwargs.get('progress')
+        self.report_button.configure(state=tk.DISABLED)
+        self.cancel_event = threading.Event()
+        output = QueuedOutput(self.message_queue)
+        workers = self.get_worker_count()
+        cancel_event = self.cancel_event
+        watch_interval = self.get_watch_interval()
+        self.watching = watch is not None
+
+        def run():
+            try:
+                watcher = None
+                if watch is not None:
+                    try:
+                        watcher = FileWatcher(
+                            watch['roots'], process_kwargs['match_pattern'],
+                            process_kwargs['flags'], process_kwargs['engine'], process_kwargs['context_lines'],
+                            extension_filter=watch['extension_filter'], walk_options=watch['walk_options']
+                        )
+                    except re.error:
+                        pass  # process_files reports the invalid pattern
+                process_files(
+                    output_widget=output,
+                    workers=workers,
+                    cancel_event=cancel_event,
+                    watcher=watcher,
+                    **process_kwargs
+                )
+                if watcher is not None and not cancel_event.is_set():
+                    watch_files(watcher, output, watch_interval, cancel_event,
+                                process_kwargs['max_matches_shown'])
+            except Exception as e:
+                self.message_queue.put(('error', e))
+            finally:
+                self.message_queue.put(('done', None))
+
+        self.process_button.configure(state=tk.DISABLED)
+        self.cancel_button.configure(state=tk.NORMAL)
+        self.worker_thread = threading.Thread(target=run, daemon=True)
+        self.worker_thread.start()
+        self.root.after(OUTPUT_POLL_MS, self.poll_messages)
+
+    def poll_messages(self):
+        """
+        Move queued output into the result store and detect the end of a
+        background run. The view is redrawn once per poll, however many
+        lines arrived in between.
+        """
+        received = False
+        error = None
+        done = False
+        try:
+            while True:
+                kind, payload = self.message_queue.get_nowait()
+                if kind == 'text':
+                    self.result_store.insert(END, payload)
+                    received = True
+                elif kind == 'matches':
+                    self.result_store.insert_matches(END, *payload)
+                    received = True
+                elif kind == 'error':
+                    error = payload
+                else:  # 'done'
+                    done = True
+                    break
+        except queue.Empty:
+            pass
+
+        if received:
+            self.output_text.refresh()
+        self.show_progress()
+
+        if not done:
+            self.root.after(OUTPUT_POLL_MS, self.poll_messages)
+            return
+
+        cancelled = self.cancel_event.is_set()
+        self.worker_thread = None
+        self.cancel_event = None
+        self.process_button.configure(state=tk.NORMAL)
+        self.cancel_button.configure(state=tk.DISABLED)
+        if self.progress is not None:
+            self.progress.finish()
+            self.show_progress()
+            self.report_button.configure(state=tk.NORMAL)
+
+        if error is not None:
+            messagebox.showerror("Error", f"An unexpected error occurred: {error}")
+        elif cancelled and self.watching:
+            # Cancel is how a watch ends; watch_files has said so
+            self.output_text.see(tk.END)
+        elif cancelled:
+            self.output_text.insert(tk.END, "Processing cancelled.\n")
+            self.output_text.see(tk.END)
+            messagebox.showinfo("Cancelled", "Processing was cancelled.")
+        else:
+            self.output_text.insert(tk.END, "Processing complete.\n")
+            self.output_text.see(tk.END)
+            messagebox.showinfo("Done", "Processing completed!")
+
+    def show_progress(self):
+        """Show the running (or finished) run's figures under the buttons."""
+        if self.progress is None:
+            return
+        snapshot = self.progress.snapshot()
+        self.progress_var.set(f"Elapsed {format_duration(snapshot['elapsed'])}: {format_progress(snapshot)}")
+        self.stages_var.set(f"Time per stage: {format_stage_timings(snapshot['stages'])}")
+
+    def on_save_report(self):
+        """Save the last run's figures (RunProgress.snapshot) as a JSON report."""
+        if self.progress is None:
+            return
+        report_path = filedialog.asksaveasfilename(
+            title="Save run report",
+            defaultextension=".json",
+            filetypes=[("JSON files", "*.json"), ("All files", "*.*")]
+        )
+        if not report_path:
+            return
+        try:
+            with open(report_path, 'w', encoding='utf-8') as f:
+                json.dump(self.progress.snapshot(), f, indent=2)
+        except OSError as e:
+            messagebox.showerror("Save failed", f"Could not write '{report_path}': {e}")
+
+    def on_cancel(self):
+        """Ask the running background job to stop after the files in progress."""
+        if self.cancel_event is not None:
+            self.cancel_event.set()
+            self.cancel_button.configure(state=tk.DISABLED)
+            self.output_text.insert(tk.END, "Cancelling...\n")
+            self.output_text.see(tk.END)
+
+    def on_undo(self):
+        """Restore the files changed by the last Invert Match / Replace run from its journal."""
+        if self.last_journal is None or self.worker_thread is not None:
+            return
+        proceed = messagebox.askyesno(
+            "Undo",
+            "Restore every file changed by the last run to its previous contents?"
+        )
+        if not proceed:
+            return
+        restored, failures = undo_journal(self.last_journal)
+        self.output_text.insert(END, f"\nRestored {len(restored)} file(s) from {self.last_journal}\n")
+        for filepath, error in failures:
+            self.output_text.insert(END, f"Could not restore {filepath}: {error}\n")
+        self.output_text.see(END)
+        if not failures:
+            shutil.rmtree(self.last_journal, ignore_errors=True)
+            self.last_journal = None
+            self.undo_button.configure(state=tk.DISABLED)
+
+    def on_export(self):
+        """Save the whole console output, with every match list in full, to a file."""
+        export_path = filedialog.asksaveasfilename(
+            title="Export results",
+            defaultextension=".txt",
+            filetypes=[("Text files", "*.txt"), ("All files", "*.*")]
+        )
+        if not export_path:
+            return
+        try:
+            self.result_store.export(export_path)
+        except OSError as e:
+            messagebox.showerror("Export failed", f"Could not write '{export_path}': {e}")
+
+    def on_close(self):
+        """Stop any background run before closing the window."""
+        if self.cancel_event is not None:
+            self.cancel_event.set()
+        self.result_store.close()
+        self.root.destroy()
+
+    def auto_resize_text(self, event):
+        """
+        Dynamically adjust the text widget height based on the line count.
+        """
+        try:
+            line_count = int(self.text_widget.index("end-1c").split('.')[0])
+            min_height = 1
+            max_height = 20
+            new_height = max(min_height, min(line_count, max_height))
+            self.text_widget.config(height=new_height)
+        except Exception as e:
+            print(f"Error resizing text widget: {e}")
+
+def load_tkinter():
+    """Import tkinter on first use, so the command line never needs a display or Tk."""
+    global tk, filedialog, messagebox
+    if tk is None:
+        import tkinter
+        import tkinter.font
+        from tkinter import filedialog as tk_filedialog, messagebox as tk_messagebox
+        tk, filedialog, messagebox = tkinter, tk_filedialog, tk_messagebox
+
+def run_gui():
+    try:
+        load_tkinter()
+        root = tk.Tk()
+        app = RegexApp(root)
+        root.mainloop()
+    except Exception as e:
+        print(f"Fatal error: {e}")
+
+def build_arg_parser():
+    """Command line options; the defaults mirror the GUI's."""
+    parser = argparse.ArgumentParser(
+        description="Search (or rewrite) files with a regular expression. "
+                    "Results are written to stdout as JSON lines: one record "
+                    "per file, then a summary record. Without arguments the GUI starts."
+    )
+    parser.add_argument('paths', nargs='*', help="files or directories to process")
+    parser.add_argument('--gui', action='store_true', help="start the GUI")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('-e', '--regex', help="the regex pattern")
+    source.add_argument('-r', '--rules', help="rule set file (JSON or tab-separated), see the README")
+    parser.add_argument('--stdin', action='store_true', help="read the text to process from stdin")
+    parser.add_argument('-i', '--ignore-case', dest='ignorecase', action='store_true', help="re.IGNORECASE")
+    parser.add_argument('--multiline', action='store_true', help="re.MULTILINE: ^ and $ match at every line")
+    parser.add_argument('--dotall', action='store_true', help="re.DOTALL: . also matches a newline")
+    parser.add_argument('--verbose', action='store_true', help="re.VERBOSE: whitespace and # comments in the pattern are ignored")
+    parser.add_argument('--engine', choices=ENGINES, default='auto',
+                        help="regex engine (default: auto, see the README)")
+    parser.add_argument('--timeout', type=float,
+                        help="give up on a file once one search runs this many seconds (status 'timeout')")
+    parser.add_argument('--mode', choices=('match', 'invert', 'replace'), default='match',
+                        help="operation mode (default: match)")
+    parser.add_argument('--replace', default='', help="replacement text for invert/replace")
+    parser.add_argument('-C', '--context', type=int, metavar='NUM',
+                        help="include each match's line and NUM lines around it (0 = just the line)")
+    parser.add_argument('-m', '--max-count', type=int, metavar='NUM',
+                        help="stop reading a file after NUM matches")
+    parser.add_argument('--ext', help="extension filter for directories, e.g. '.txt, .log'")
+    parser.add_argument('--exclude-dir', action='append',
+                        help=f"directory glob to skip (repeatable; default: {DEFAULT_EXCLUDE_DIRS})")
+    parser.add_argument('--max-size', type=float, help="skip files larger than this many MB")
+    parser.add_argument('--include-binary', action='store_true', help="do not skip binary files")
+    parser.add_argument('--no-archives', action='store_true',
+                        help="search .gz/.bz2/.xz/.zip/.tar files as they are instead of inside them")
+    parser.add_argument('--no-ignore-files', action='store_true', help="do not honour .gitignore files")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help=f"worker processes (1 = no pool; default: {DEFAULT_WORKERS})")
+    parser.add_argument('--stream-threshold', type=float,
+                        default=DEFAULT_STREAM_THRESHOLD / (1024 * 1024),
+                        help="stream files larger than this many MB")
+    parser.add_argument('--max-match-length', type=int, default=DEFAULT_MAX_MATCH_LENGTH,
+                        help="longest match kept intact across streamed windows")
+    parser.add_argument('--boundary', choices=('lines', 'window'), default='lines',
+                        help="where streamed windows are split")
+    parser.add_argument('--no-mmap', action='store_true', help="disable the byte-level search")
+    parser.add_argument('--no-prefilter', action='store_true', help="disable the literal prefilter")
+    parser.add_argument('--no-cache', action='store_true', help="do not use the result cache")
+    parser.add_argument('--force-rescan', action='store_true', help="ignore cached results")
+    parser.add_argument('--preserve-mtime', action='store_true',
+                        help="keep the modification time of rewritten files")
+    parser.add_argument('--backup', action='store_true',
+                        help="back up rewritten files to an undo journal (its directory is in the summary)")
+    parser.add_argument('--undo', metavar='JOURNAL', help="restore the files recorded in an undo journal and exit")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="only report what invert/replace would change (substitutions, bytes)")
+    parser.add_argument('--diff', action='store_true', help="like --dry-run, with a unified diff per file")
+    parser.add_argument('--write-workers', type=int, default=DEFAULT_WRITE_WORKERS,
+                        help=f"writer threads for single-process runs (default: {DEFAULT_WRITE_WORKERS})")
+    parser.add_argument('--progress', action='store_true',
+                        help="show files, MB, rates and ETA on stderr while running")
+    parser.add_argument('--report', metavar='FILE',
+                        help="also write the run's figures (rates, per-stage times) to FILE as JSON")
+    parser.add_argument('--watch', action='store_true',
+                        help="after the run, keep searching new files and appended lines (match mode; Ctrl-C stops)")
+    parser.add_argument('--watch-interval', type=float, default=DEFAULT_WATCH_INTERVAL, metavar='SECONDS',
+                        help=f"seconds between checks for changes in watch mode (default: {DEFAULT_WATCH_INTERVAL:g})")
+    return parser
+
+def match_records(result):
+    """Pair each match of a result with its position (and context) for the JSON output."""
+    records = []
+    context = result.get('context')
+    for index, (value, (start, end, line, column)) in enumerate(
+            zip(result.get('matches') or (), result.get('spans') or ())):
+        record = {
+            'line': line,
+            'column': column,
+            'start': start,
+            'end': end,
+            'match': value,
+        }
+        if context is not None:
+            before, record['line_text'], after = context[index]
+            record['before'] = before
+            record['after'] = after
+        records.append(record)
+    return records
+
+def file_record(result):
+    """Turn a process_file result into the JSON record written by the command line."""
+    record = {
+        'type': 'file',
+        'path': result['path'],
+        'status': result['status'],
+        'encoding': result['encoding'],
+    }
+    if result.get('spans') is not None:
+        record['offsets'] = result.get('offsets')
+        record['matches'] = match_records(result)
+    elif result.get('matches') is not None:
+        record['matches'] = result['matches']
+    if result.get('rule_hits') is not None:
+        record['rule_hits'] = result['rule_hits']
+        record['rule_matches'] = {str(index): matches for index, matches
+                                  in (result.get('rule_matches') or {}).items()}
+    if result.get('changes') is not None:
+        record['changes'] = result['changes']
+    if result.get('diff'):
+        record['diff'] = ''.join(result['diff'])
+    if result.get('cached'):
+        record['cached'] = True
+    if result.get('error'):
+        record['error'] = result['error']
+    return record
+
+def process_stdin(match_pattern, mode, replace_pattern, rules=None, dry_run=None, flags=0, engine='re',
+                  max_count=None, context_lines=None):
+    """
+    Process text read from stdin; returns a result dict like process_file's.
+    With dry_run the updated text is replaced by 'changes' (and a 'diff').
+    """
+    data = sys.stdin.buffer.read()
+    content, used_encoding = decode_text(data, detect_encoding(data[:SNIFF_BYTES]))
+    result = {
+        'path': '<stdin>',
+        'status': None,
+        'encoding': used_encoding,
+        'matches': None,
+        'error': None,
+        'stat': None,
+    }
+    if content is None:
+        result['status'] = 'unreadable'
+        return result
+
+    try:
+        if rules is not None:
+            rule_edits = [] if dry_run else None
+            updated_content, rule_matches, rule_hits = apply_rules(content, rules, flags, engine, rule_edits)
+            if updated_content is None:
+                result['status'] = 'regex-error'
+                return result
+            result['rule_hits'] = rule_hits
+            result['rule_matches'] = rule_matches
+            result['status'] = 'modified' if updated_content != content else 'unchanged'
+            if dry_run:
+                result['changes'] = rule_edits_stats(rule_edits, used_encoding)
+                result['diff'] = None
+                if updated_content != content:
+                    result['status'] = 'would-modify'
+                    if dry_run == 'diff':
+                        result['diff'] = rule_edits_diff(content, updated_content, rule_edits, result['path'])
+                return result
+        else:
+            compiled_pattern = compile_pattern(match_pattern, flags, engine)
+            if mode == 'match':
+                matches, result['spans'], context = locate_matches(
+                    content, compiled_pattern, max_count, context_lines
+                )
+                result['offsets'] = 'chars'
+                if context is not None:
+                    result['context'] = context
+                result['status'] = 'matched' if matches else 'no-match'
+                result['matches'] = matches or None
+                return result
+            if dry_run:
+                result['changes'], result['diff'] = dry_run_changes(
+                    content, compiled_pattern, mode, replace_pattern, used_encoding,
+                    result['path'], with_diff=dry_run == 'diff'
+                )
+                result['status'] = 'would-modify' if result['changes']['substitutions'] else 'unchanged'
+                return result
+            updated_content, _ = regex_replace_and_store(content, compiled_pattern, mode, replace_pattern)
+            if updated_content is None:
+                result['status'] = 'regex-error'
+                return result
+            result['status'] = 'modified' if updated_content != content else 'unchanged'
+    except re.error as e:
+        result['status'] = 'regex-error'
+        result['error'] = str(e)
+        return result
+    result['content'] = updated_content
+    return result
+
+def iter_cli_paths(paths, extension_filter, walk_options, sizes=None):
+    """Yield the files named on the command line, walking directories (see iter_file_paths for sizes)."""
+    for path in paths:
+        if os.path.isdir(path):
+            yield from iter_file_paths(path, extension_filter=extension_filter, sizes=sizes,
+                                       **walk_options)
+        else:
+            yield path
+
+def run_cli(args):
+    """
+    Headless run: process the given paths (or stdin) and write one JSON
+    record per line to stdout. Exit status follows grep: 0 if something
+    matched or was modified, 1 if not, 2 on errors.
+    """
+    if args.undo:
+        restored, failures = undo_journal(args.undo)
+        for filepath in restored:
+            sys.stdout.write(json.dumps({'type': 'restored', 'path': filepath}) + '\n')
+        for filepath, error in failures:
+            sys.stdout.write(json.dumps({'type': 'restore-failed', 'path': filepath, 'error': error}) + '\n')
+        if failures:
+            return 2
+        shutil.rmtree(args.undo, ignore_errors=True)
+        return 0
+
+    flags = pattern_flags(name for name in PATTERN_FLAGS if getattr(args, name.lower()))
+    rules = None
+    if args.rules:
+        try:
+            rules = load_rules(args.rules, flags, args.engine)
+        except (OSError, ValueError) as e:
+            print(f"Could not load rules: {e}", file=sys.stderr)
+            return 2
+        mode = 'rules'
+    elif args.regex is not None:
+        mode = args.mode
+        try:
+            compile_pattern(args.regex, flags, args.engine)
+        except re.error as e:
+            print(f"Invalid Regex: {e}", file=sys.stderr)
+            return 2
+    else:
+        print("A regex (-e) or a rules file (-r) is required.", file=sys.stderr)
+        return 2
+    if not args.paths and not args.stdin:
+        print("No paths given (use --stdin to read from standard input).", file=sys.stderr)
+        return 2
+    if args.watch and (mode != 'match' or not args.paths):
+        print("--watch needs paths and a regex in match mode.", file=sys.stderr)
+        return 2
+
+    dry_run = 'diff' if args.diff else 'stats' if args.dry_run else None
+    progress = RunProgress()
+    context_lines = max(0, args.context) if args.context is not None else None
+    max_count = max(1, args.max_count) if args.max_count is not None else None
+    counts = collections.Counter()
+
+    def emit(record):
+        sys.stdout.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    if args.stdin:
+        try:
+            with match_deadline(args.timeout):
+                result = process_stdin(args.regex, mode, args.replace, rules, dry_run, flags, args.engine,
+                                       max_count, context_lines)
+        except MatchTimeout as e:
+            result = {'path': '<stdin>', 'status': 'timeout', 'encoding': None, 'matches': None, 'error': str(e)}
+        record = file_record(result)
+        if 'content' in result:
+            record['content'] = result['content']
+        emit(record)
+        counts[result['status']] += 1
+        progress.add_result(result)
+
+    journal_dir = None
+    if args.backup and mode != 'match' and not dry_run:
+        try:
+            journal_dir = create_journal()
+        except OSError as e:
+            print(f"Could not create the undo journal: {e}", file=sys.stderr)
+            return 2
+
+    if args.paths:
+        walk_options = {
+            'exclude_dirs': args.exclude_dir or re.split(r'[,;]+', DEFAULT_EXCLUDE_DIRS),
+            'max_size': int(args.max_size * 1024 * 1024) if args.max_size is not None else None,
+            'skip_binary': not args.include_binary,
+            'ignore_files': None if args.no_ignore_files else DEFAULT_IGNORE_FILES,
+        }
+        sizes = {}
+        file_paths = iter_prefetched(progress.track_paths(iter_cli_paths(
+            args.paths, args.ext, walk_options, sizes
+        ), sizes))
+        watcher = None
+        if args.watch:
+            watcher = FileWatcher(args.paths, args.regex, flags, args.engine, context_lines,
+                                  extension_filter=args.ext, walk_options=walk_options)
+        results = iter_file_results(
+            file_paths, args.regex, mode, args.replace,
+            workers=max(1, args.workers),
+            cache_path=None if args.no_cache else default_cache_path(),
+            force_rescan=args.force_rescan,
+            write_workers=max(0, args.write_workers),
+            preserve_mtime=args.preserve_mtime,
+            journal_dir=journal_dir,
+            dry_run=dry_run,
+            stream_threshold=int(args.stream_threshold * 1024 * 1024),
+            max_match_length=max(1, args.max_match_length),
+            boundary=args.boundary,
+            use_mmap=not args.no_mmap,
+            use_prefilter=not args.no_prefilter,
+            rules=rules,
+            flags=flags,
+            engine=args.engine,
+            match_timeout=args.timeout,
+            search_archives=not args.no_archives,
+            with_spans=rules is None,
+            max_count=max_count,
+            context_lines=context_lines,
+        )
+        shown = 0.0
+        for result in results:
+            for entry in iter_member_results(result):
+                emit(file_record(entry))
+            counts[result['status']] += 1
+            progress.add_result(result)
+            if watcher is not None:
+                watcher.add_result(result)
+            if args.progress and time.perf_counter() - shown >= PROGRESS_INTERVAL:
+                shown = time.perf_counter()
+                sys.stderr.write(f"\r{format_progress(progress.snapshot())}\033[K")
+                sys.stderr.flush()
+    progress.finish()
+    report = progress.snapshot()
+    if args.progress and args.paths:
+        sys.stderr.write(f"\r{format_progress(report)}\033[K\n")
+
+    summary = {'type': 'summary', 'files': sum(counts.values())}
+    summary.update(sorted(counts.items()))
+    if journal_dir is not None:
+        summary['journal'] = journal_dir
+    for key in ('elapsed', 'first_result', 'bytes_done', 'files_per_sec', 'mb_per_sec', 'stages'):
+        summary[key] = report[key]
+    emit(summary)
+    sys.stdout.flush()
+    if args.report:
+        try:
+            with open(args.report, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+        except OSError as e:
+            print(f"Could not write the report: {e}", file=sys.stderr)
+            return 2
+
+    if args.watch:
+        # One record per file with new matches, until interrupted
+        watcher.start()
+        try:
+            for result in iter_watch_results(watcher, max(0.1, args.watch_interval)):
+                for entry in iter_member_results(result):
+                    record = file_record(entry)
+                    if result['restarted']:
+                        record['restarted'] = True
+                    emit(record)
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+        return 0
+
+    if (counts['unreadable'] or counts['regex-error'] or counts['timeout']
+            or counts['no-permission'] or counts['write-error']):
+        return 2
+    if counts['matched'] or counts['modified'] or counts['would-modify']:
+        return 0
+    return 1
+
+def main(argv=None):
+    """Start the GUI, or run headless when paths or --stdin are given."""
+    args = build_arg_parser().parse_args(argv)
+    if args.gui or not (args.paths or args.stdin or args.regex or args.rules or args.undo):
+        run_gui()
+        return 0
+    try:
+        return run_cli(args)
+    except BrokenPipeError:
+        # The reader went away (e.g. piped into head); stop quietly
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        return 1
+    except KeyboardInterrupt:
+        return 130
+
+if __name__ == "__main__":
+    sys.exit(main())
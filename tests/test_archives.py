@@ -0,0 +1,50 @@
+import gzip
+import io
+import tarfile
+import threading
+import zipfile
+
+import regex
+
+
+def search(path):
+    """process_file on an archive, failing instead of hanging if it does not finish."""
+    results = []
+    thread = threading.Thread(target=lambda: results.append(
+        regex.process_file(str(path), r'ERROR \d', 'match', None, with_spans=True)), daemon=True)
+    thread.start()
+    thread.join(10)
+    assert results, "still running"
+    return results[0]
+
+
+def test_empty_gzip_file(tmp_path):
+    path = tmp_path / 'app.log.1.gz'
+    gzip.open(path, 'wb').close()
+
+    result = search(path)
+
+    assert result['status'] == 'no-match'
+
+
+def test_zip_with_an_empty_member(tmp_path):
+    path = tmp_path / 'logs.zip'
+    with zipfile.ZipFile(path, 'w') as archive:
+        archive.writestr('empty.log', '')
+        archive.writestr('app.log', "ok\nERROR 7\n")
+
+    result = search(path)
+
+    assert result['status'] == 'matched'
+    assert [(member['path'], member['matches']) for member in result['members']] == [
+        (f"{path}!app.log", ['ERROR 7'])]
+
+
+def test_tar_with_an_empty_member(tmp_path):
+    path = tmp_path / 'logs.tar'
+    with tarfile.open(path, 'w') as archive:
+        archive.addfile(tarfile.TarInfo('empty.log'), io.BytesIO(b''))
+
+    result = search(path)
+
+    assert result['status'] == 'no-match'
@@ -0,0 +1,37 @@
+import pytest
+
+import regex
+
+
+@pytest.mark.parametrize('pattern', [r'x*', r'a|', r'(?:)', r'caf(?:e)?'])
+def test_byte_search_matches_decoded_search(tmp_path, pattern):
+    path = tmp_path / 'text.txt'
+    path.write_text("café x naïve\nxx – fin\n", encoding='utf-8')
+
+    results = [
+        regex.process_file(str(path), pattern, 'match', None, use_mmap=use_mmap,
+                           use_prefilter=False, with_spans=True)
+        for use_mmap in (True, False)
+    ]
+    assert results[0]['matches'] == results[1]['matches']
+    assert [span[2:] for span in results[0]['spans']] == [span[2:] for span in results[1]['spans']]
+
+
+def test_empty_width_patterns_are_not_searched_as_bytes():
+    for pattern in (r'x*', r'a|', r'(?:)', r'\b'):
+        assert regex.compile_bytes_pattern(pattern) is None
+    assert regex.compile_bytes_pattern(r'id=[0-9]+') is not None
+
+
+def test_lone_carriage_returns_count_as_line_breaks(tmp_path):
+    path = tmp_path / 'mac.txt'
+    path.write_bytes(b"id=1\rnext id=22\r\nid=333 and id=4\r")
+
+    results = [
+        regex.process_file(str(path), r'id=[0-9]+', 'match', None, use_mmap=use_mmap,
+                           use_prefilter=False, with_spans=True)
+        for use_mmap in (True, False)
+    ]
+    assert results[0]['matches'] == results[1]['matches']
+    assert [span[2:] for span in results[0]['spans']] == [(1, 1), (2, 6), (3, 1), (3, 12)]
+    assert [span[2:] for span in results[1]['spans']] == [(1, 1), (2, 6), (3, 1), (3, 12)]
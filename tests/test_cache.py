@@ -0,0 +1,104 @@
+import gzip
+import os
+
+import regex
+
+
+def test_archive_result_without_search_archives_is_not_reused(tmp_path):
+    path = tmp_path / 'a.log.gz'
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        f.write("ERROR 1\n")
+    cache_path = str(tmp_path / 'cache.sqlite')
+
+    def run(**file_options):
+        return list(regex.iter_file_results([str(path)], r'ERROR \d', 'match', None, workers=1,
+                                            cache_path=cache_path, **file_options))
+
+    run(search_archives=False)
+    [result] = run()
+
+    assert not result.get('cached')
+    assert [member['matches'] for member in result['members']] == [['ERROR 1']]
+
+
+def run(paths, cache_path, pattern=r'ERROR \d', **options):
+    return {result['path']: result for result in regex.iter_file_results(
+        [str(path) for path in paths], pattern, 'match', None, workers=1, cache_path=cache_path, **options)}
+
+
+def test_unchanged_files_are_answered_from_the_cache(tmp_path):
+    path = tmp_path / 'app.log'
+    path.write_text("ok\nERROR 1\n", encoding='utf-8')
+    cache_path = str(tmp_path / 'cache.sqlite')
+
+    first = run([path], cache_path, with_spans=True)[str(path)]
+    second = run([path], cache_path, with_spans=True)[str(path)]
+
+    assert not first.get('cached')
+    assert second['cached']
+    assert second['matches'] == first['matches'] == ['ERROR 1']
+    assert second['spans'] == [tuple(span) for span in first['spans']]
+    assert not run([path], cache_path, r'ERROR')[str(path)].get('cached')  # another pattern
+
+
+def test_changed_files_are_searched_again(tmp_path):
+    path = tmp_path / 'app.log'
+    path.write_text("ERROR 1\n", encoding='utf-8')
+    cache_path = str(tmp_path / 'cache.sqlite')
+    run([path], cache_path)
+
+    path.write_text("ERROR 2\n", encoding='utf-8')  # same size, newer mtime
+    file_stat = os.stat(path)
+    os.utime(path, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns + 10 ** 9))
+    result = run([path], cache_path)[str(path)]
+    assert not result.get('cached') and result['matches'] == ['ERROR 2']
+
+    path.write_text("ERROR 2\nERROR 3\n", encoding='utf-8')
+    result = run([path], cache_path)[str(path)]
+    assert not result.get('cached') and result['matches'] == ['ERROR 2', 'ERROR 3']
+
+
+def test_force_rescan_skips_the_cache(tmp_path):
+    path = tmp_path / 'app.log'
+    path.write_text("ERROR 1\n", encoding='utf-8')
+    cache_path = str(tmp_path / 'cache.sqlite')
+    run([path], cache_path)
+
+    results = list(regex.iter_file_results([str(path)], r'ERROR \d', 'match', None, workers=1,
+                                           cache_path=cache_path, force_rescan=True))
+    assert not results[0].get('cached')
+
+
+def test_search_options_are_part_of_the_key(tmp_path):
+    path = tmp_path / 'app.log'
+    path.write_text("ok\nERROR 1\n", encoding='utf-8')
+    cache_path = str(tmp_path / 'cache.sqlite')
+
+    byte_offsets = run([path], cache_path, r'ERROR [0-9]', with_spans=True)[str(path)]
+    char_offsets = run([path], cache_path, r'ERROR [0-9]', with_spans=True, use_mmap=False)[str(path)]
+    streamed = run([path], cache_path, r'ERROR [0-9]', with_spans=True, use_mmap=False, stream_threshold=0)[str(path)]
+
+    assert byte_offsets['offsets'] == 'bytes'
+    assert not char_offsets.get('cached') and char_offsets['offsets'] == 'chars'
+    assert not streamed.get('cached')
+    assert run([path], cache_path, r'ERROR [0-9]', with_spans=True, use_mmap=False)[str(path)]['cached']
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    paths = []
+    for index in range(3):
+        path = tmp_path / f'{index}.log'
+        path.write_text(f"ERROR {index}\n", encoding='utf-8')
+        paths.append(str(path))
+    cache_path = str(tmp_path / 'cache.sqlite')
+    file_options = {'workers': 1, 'with_spans': False}
+    results = list(regex.iter_file_results(paths, r'ERROR \d', 'match', None, **file_options))
+
+    cache = regex.ResultCache(cache_path, r'ERROR \d', 0, 'match', max_entries=2)
+    for result in results:
+        cache.put(result)
+    cache.close()
+    cache = regex.ResultCache(cache_path, r'ERROR \d', 0, 'match', max_entries=2)
+    assert cache.get(paths[0]) is None
+    assert [cache.get(path)['matches'] for path in paths[1:]] == [['ERROR 1'], ['ERROR 2']]
+    cache.close()
@@ -0,0 +1,41 @@
+import json
+import os
+import subprocess
+import sys
+
+from conftest import ROOT
+
+
+def run_cli(*args, input=None):
+    completed = subprocess.run(
+        [sys.executable, os.path.join(ROOT, 'regex.py'), '--workers', '1', '--no-cache', *args],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, input=input
+    )
+    records = [json.loads(line) for line in completed.stdout.splitlines()]
+    return completed.returncode, records, completed.stderr
+
+
+def test_ext_filter_on_directory(tmp_path):
+    (tmp_path / 'a.log').write_text('id=1\n')
+    (tmp_path / 'b.txt').write_text('id=2\n')
+    (tmp_path / 'c.md').write_text('id=3\n')
+
+    status, records, stderr = run_cli('-e', r'id=\d', '--ext', '.log, txt', str(tmp_path))
+
+    assert status == 0, stderr
+    paths = sorted(os.path.basename(r['path']) for r in records if r['type'] == 'file')
+    assert paths == ['a.log', 'b.txt']
+    assert records[-1]['type'] == 'summary'
+
+
+def test_rules_dry_run_reports_changes_for_stdin_like_for_files(tmp_path):
+    rules = tmp_path / 'rules.tsv'
+    rules.write_text("replace\tfoo\tbar\n", encoding='utf-8')
+    path = tmp_path / 'a.txt'
+    path.write_text("foo foo\n", encoding='utf-8')
+
+    _, stdin_records, _ = run_cli('-r', str(rules), '--dry-run', '--stdin', input="foo foo\n")
+    _, file_records, _ = run_cli('-r', str(rules), '--dry-run', str(path))
+
+    assert stdin_records[0]['changes'] == file_records[0]['changes'] == {
+        'substitutions': 2, 'bytes_removed': 6, 'bytes_added': 6}
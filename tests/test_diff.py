@@ -0,0 +1,39 @@
+import difflib
+import re
+
+import pytest
+
+import regex
+
+TEXT = ''.join(f"line {index}\n" for index in range(1, 21)).replace("line 5\n", "a\nb\nc\n")
+
+
+def expected_diff(old, new, path='f.txt'):
+    lines = list(difflib.unified_diff(old.splitlines(True), new.splitlines(True), path, path))
+    # difflib leaves a last line without '\n' as it is
+    fixed = []
+    for line in lines:
+        if not line.endswith('\n'):
+            fixed.extend([line + '\n', "\\ No newline at end of file\n"])
+        else:
+            fixed.append(line)
+    return fixed
+
+
+@pytest.mark.parametrize('pattern, replacement', [
+    (r'b\n', ''),
+    (r'(?<=line 7)\n', ' '),     # joins two lines
+    (r'7\n', ''),
+    (r'\nc', ''),
+    (r'a\nb\nc\n', 'abc\n'),
+    (r'line 1\d\n', ''),
+    (r'line (\d+)', r'L\1'),
+    (r'line 20\n', 'last'),     # ends without a newline
+    (r'^', '> '),
+    (r'line 3\n', 'x\ny\nz\n'),
+])
+def test_diff_equals_difflib(pattern, replacement):
+    compiled_pattern = re.compile(pattern, re.MULTILINE)
+    stats, diff = regex.dry_run_changes(TEXT, compiled_pattern, 'replace', replacement, 'utf-8', 'f.txt',
+                                        with_diff=True)
+    assert diff == expected_diff(TEXT, compiled_pattern.sub(replacement, TEXT))
@@ -0,0 +1,65 @@
+import codecs
+import os
+
+import pytest
+
+import regex
+
+TEXT = "café naïve\nline two\n"
+
+
+@pytest.mark.parametrize('data, expected', [
+    (codecs.BOM_UTF8 + TEXT.encode('utf-8'), 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE + TEXT.encode('utf-16-le'), 'utf-16'),
+    (codecs.BOM_UTF16_BE + TEXT.encode('utf-16-be'), 'utf-16'),
+    (TEXT.encode('utf-16-le'), 'utf-16-le'),
+    (TEXT.encode('utf-16-be'), 'utf-16-be'),
+    (TEXT.encode('utf-8'), 'utf-8'),
+    ("café €5\n".encode('cp1252'), 'cp1252'),
+])
+def test_detect_encoding(data, expected):
+    assert regex.detect_encoding(data) == expected
+
+
+def test_binary_with_nuls_is_not_taken_for_utf16():
+    # NULs in both even and odd positions, as in most binaries
+    data = bytes(range(256)) * 8 + b'\x00\x00\x01\x00\x00\x02'
+    assert not regex.detect_encoding(data).startswith('utf-16')
+
+
+@pytest.mark.parametrize('encoding', ['utf-8-sig', 'utf-16', 'utf-16-le', 'cp1252'])
+def test_decode_text_round_trip(encoding):
+    text = "café €5\r\nold mac\rend\n"
+    data = text.encode(encoding)
+    content, used = regex.decode_text(data, regex.detect_encoding(data))
+    assert content == "café €5\nold mac\nend\n"
+    assert used in (encoding, 'utf-16')
+
+
+def test_decode_text_falls_back_to_cp1252():
+    data = "a € sign\n".encode('cp1252')
+    assert regex.decode_text(data, 'utf-8') == ("a € sign\n", 'cp1252')
+
+
+def test_cached_encoding_is_used_until_the_file_changes(tmp_path):
+    path = tmp_path / 'text.txt'
+    path.write_text("naïve\n", encoding='utf-8')
+    file_stat = os.stat(path)
+    hint = (file_stat.st_size, file_stat.st_mtime_ns, 'iso-8859-1')
+
+    result = regex.process_file(str(path), 'na.*', 'match', None, encoding_hint=hint, use_mmap=False)
+    assert result['encoding'] == 'iso-8859-1'
+    assert result['matches'] == ["naÃ¯ve"]
+
+    os.utime(path, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns + 10 ** 9))
+    result = regex.process_file(str(path), 'na.*', 'match', None, encoding_hint=hint, use_mmap=False)
+    assert result['encoding'] == 'utf-8'
+    assert result['matches'] == ["naïve"]
+
+
+def test_runs_remember_encodings(tmp_path):
+    path = tmp_path / 'text.txt'
+    path.write_bytes("café\n".encode('cp1252'))
+    list(regex.iter_file_results([str(path)], 'caf', 'match', None, workers=1))
+    file_stat = os.stat(path)
+    assert regex.ENCODING_CACHE[str(path)] == (file_stat.st_size, file_stat.st_mtime_ns, 'cp1252')
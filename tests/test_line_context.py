@@ -0,0 +1,135 @@
+import pytest
+
+import regex
+
+
+TEXT = "one\ntwo\n\nfour\nfive"
+
+
+def test_line_index_locates_offsets():
+    index = regex.LineIndex(TEXT)
+    assert index.starts == [0, 4, 8, 9, 14]
+    assert index.locate(0) == (1, 1)
+    assert index.locate(3) == (1, 4)    # the '\n' still belongs to its line
+    assert index.locate(4) == (2, 1)
+    assert index.locate(8) == (3, 1)    # an empty line
+    assert index.locate(16) == (5, 3)
+    assert index.locate(len(TEXT)) == (5, 5)
+
+
+def test_line_index_of_text_ending_in_a_newline():
+    index = regex.LineIndex("a\nb\n")
+    assert index.starts == [0, 2, 4]
+    assert index.locate(3) == (2, 2)
+    assert regex.LineIndex("").locate(0) == (1, 1)
+
+
+@pytest.mark.parametrize('line, context_lines, expected', [
+    (1, 2, ([], "one", ["two", ""])),
+    (3, 1, (["two"], "", ["four"])),
+    (4, 0, ([], "four", [])),
+    # The last line has no trailing newline
+    (5, 2, (["", "four"], "five", [])),
+    (2, 10, (["one"], "two", ["", "four", "five"])),
+])
+def test_line_context(line, context_lines, expected):
+    assert regex.line_context(TEXT, regex.LineIndex(TEXT), line, context_lines) == expected
+
+
+def test_line_context_does_not_add_a_line_after_the_final_newline():
+    content = "a\nb\n"
+    index = regex.LineIndex(content)
+    assert regex.line_context(content, index, 2, 3) == (["a"], "b", [])
+    assert regex.line_context(content, index, 1, 3) == ([], "a", ["b"])
+
+
+def test_format_match_lines_merges_overlapping_and_adjacent_context():
+    content = "\n".join(f"line {n}" for n in range(1, 21)) + "\n"
+    _, spans, context = regex.locate_matches(content, regex.compile_pattern(r'line (?:3|5|10|13)\b'),
+                                             context_lines=1)
+    assert regex.format_match_lines(spans, context) == [
+        (False, "2- line 2"),
+        (True, "3:1: line 3"),
+        (False, "4- line 4"),       # after 3 and before 5: one group
+        (True, "5:1: line 5"),
+        (False, "6- line 6"),
+        (False, "--"),
+        (False, "9- line 9"),
+        (True, "10:1: line 10"),
+        (False, "11- line 11"),     # 11 and 12 touch: no separator
+        (False, "12- line 12"),
+        (True, "13:1: line 13"),
+        (False, "14- line 14"),
+    ]
+
+
+def test_format_match_lines_lists_every_column_once_per_line():
+    content = "ab ab\nx\nab\n"
+    _, spans, context = regex.locate_matches(content, regex.compile_pattern(r'ab'), context_lines=1)
+    assert regex.format_match_lines(spans, context) == [
+        (True, "1:1,4: ab ab"),
+        (False, "2- x"),
+        (True, "3:1: ab"),
+    ]
+
+
+def test_format_match_lines_without_context_separates_every_gap():
+    content = "a\nb\na\na\n"
+    _, spans, context = regex.locate_matches(content, regex.compile_pattern(r'a'), context_lines=0)
+    assert regex.format_match_lines(spans, context) == [
+        (True, "1:1: a"),
+        (False, "--"),
+        (True, "3:1: a"),
+        (True, "4:1: a"),
+    ]
+
+
+def test_locate_matches_stops_at_max_count():
+    content = "x1 x2\nx3\nx4\n"
+    matches, spans, context = regex.locate_matches(content, regex.compile_pattern(r'x\d'), max_count=3,
+                                                   context_lines=1)
+    assert matches == ['x1', 'x2', 'x3']
+    assert spans == [(0, 2, 1, 1), (3, 5, 1, 4), (6, 8, 2, 1)]
+    assert context == [([], "x1 x2", ["x3"]), ([], "x1 x2", ["x3"]), (["x1 x2"], "x3", ["x4"])]
+    assert regex.locate_matches(content, regex.compile_pattern(r'x\d'), max_count=0) == ([], [], None)
+
+
+CRLF_FILE = b"a\r\nhit 1\r\nb\r\nc\r\nd\r\nhit 2\r\nlast hit"
+SEARCH_PATHS = [
+    {'use_mmap': True},
+    {'use_mmap': False},
+    {'use_mmap': False, 'stream_threshold': 1},
+]
+
+
+@pytest.mark.parametrize('options', SEARCH_PATHS)
+def test_crlf_file_lines_and_context(tmp_path, options):
+    path = tmp_path / 'crlf.txt'
+    path.write_bytes(CRLF_FILE)
+    result = regex.process_file(str(path), r'hit( [0-9])?', 'match', None, context_lines=1, **options)
+    assert [span[2:] for span in result['spans']] == [(2, 1), (6, 1), (7, 6)]
+    # No '\r' is left on any line, and the unterminated last line is complete
+    assert result['context'] == [
+        (["a"], "hit 1", ["b"]),
+        (["d"], "hit 2", ["last hit"]),
+        (["hit 2"], "last hit", []),
+    ]
+    assert regex.format_match_lines(result['spans'], result['context']) == [
+        (False, "1- a"),
+        (True, "2:1: hit 1"),
+        (False, "3- b"),
+        (False, "--"),
+        (False, "5- d"),
+        (True, "6:1: hit 2"),
+        (True, "7:6: last hit"),
+    ]
+
+
+@pytest.mark.parametrize('options', SEARCH_PATHS)
+def test_max_count_on_every_search_path(tmp_path, options):
+    path = tmp_path / 'crlf.txt'
+    path.write_bytes(CRLF_FILE)
+    result = regex.process_file(str(path), r'hit', 'match', None, max_count=2, context_lines=0, **options)
+    assert result['matches'] == ['hit', 'hit']
+    assert [span[2] for span in result['spans']] == [2, 6]
+    assert [text for _, text, _ in result['context']] == ["hit 1", "hit 2"]
@@ -0,0 +1,137 @@
+import re
+
+import pytest
+
+import regex
+
+
+def test_matches_are_reported_as_findall_reports_them():
+    text = "k1=v1, k2=v2"
+    for pattern in (r'k\d=v\d', r'k(\d)=v\d', r'(k\d)=(v\d)'):
+        compiled = regex.compile_pattern(pattern)
+        _, matches = regex.regex_replace_and_store(text, compiled, 'match')
+        assert matches == re.findall(pattern, text)
+        assert [regex.findall_value(m) for m in compiled.finditer(text)] == matches
+
+    # No group is wrapped around the pattern: the shapes are findall's own
+    assert regex.regex_replace_and_store(text, regex.compile_pattern(r'k\d=v\d'), 'match')[1] == ['k1=v1', 'k2=v2']
+    assert regex.regex_replace_and_store(text, regex.compile_pattern(r'k(\d)=v\d'), 'match')[1] == ['1', '2']
+    assert regex.regex_replace_and_store(text, regex.compile_pattern(r'(k\d)=(v\d)'), 'match')[1] == [
+        ('k1', 'v1'), ('k2', 'v2')]
+
+
+def test_findall_value_on_bytes_patterns():
+    compiled = re.compile(rb'(a)(b)?')
+    assert [regex.findall_value(m) for m in compiled.finditer(b'ab a')] == compiled.findall(b'ab a')
+
+
+def test_group_references_in_replacements_are_the_patterns_own():
+    compiled = regex.compile_pattern(r'(\w+)@(\w+)')
+    updated, _ = regex.regex_replace_and_store("me@host", compiled, 'replace', r'\2 at \1')
+    assert updated == "host at me"
+
+
+@pytest.mark.parametrize('pattern, text, replacement, expected', [
+    # Without groups
+    (r'\d+', 'a1b22c', '', '122'),
+    (r'\d+', 'a1b22c', '.', '.1.22.'),
+    (r'\d+', '1ab2', '-', '-1-2-'),
+    (r'\d+', 'abc', '-', '-'),
+    # With groups: the whole match is kept, not the groups
+    (r'(\d)(\w)', '1a 2b', '_', '_1a_2b_'),
+    (r'(\d)|x', 'a1x', '', '1x'),
+    # Zero-width matches: every stretch between them gives way
+    (r'(?=\d)', 'a1b2', '|', '|||'),
+    (r'\b', 'ab cd', '-', '-----'),
+    (r'x*', 'abc', '', ''),
+    (r'x*', 'axc', '.', '..x...'),
+])
+def test_invert_keeps_every_match_and_replaces_the_rest(pattern, text, replacement, expected):
+    compiled = regex.compile_pattern(pattern)
+    updated, matches = regex.regex_replace_and_store(text, compiled, 'invert', replacement)
+    assert updated == expected
+    assert matches is None
+    # The edits written back to files agree with the in-memory result
+    edits = list(regex.iter_edits(text, compiled, 'invert', replacement))
+    assert regex.apply_edits(text, edits) == expected
+
+
+@pytest.mark.parametrize('pattern, text, replacement', [
+    (r'\d+', 'a1b22c', '#'),
+    (r'(\d)(\w)', '1a 2b', r'\2\1'),
+    (r'x*', 'abc', '-'),
+    (r'\b', 'ab cd', '|'),
+    (r'^', 'one\ntwo\n', '> '),
+])
+def test_replace_edits_match_subn(pattern, text, replacement):
+    compiled = regex.compile_pattern(pattern, re.MULTILINE)
+    updated, _, count = regex.regex_replace_and_count(text, compiled, 'replace', replacement)
+    expected, expected_count = re.subn(pattern, replacement, text, flags=re.MULTILINE)
+    assert (updated, count) == (expected, expected_count)
+    counts = {}
+    edits = list(regex.iter_edits(text, compiled, 'replace', replacement, counts=counts))
+    assert regex.apply_edits(text, edits) == expected
+    assert counts['matches'] == expected_count
+
+
+def test_pattern_flags_combines_names():
+    assert regex.pattern_flags([]) == 0
+    assert regex.pattern_flags(['IGNORECASE', 'DOTALL']) == re.IGNORECASE | re.DOTALL
+    with pytest.raises(KeyError):
+        regex.pattern_flags(['UNICODE'])
+
+
+@pytest.mark.parametrize('names, pattern, text, expected', [
+    (['IGNORECASE'], r'error', "Error ERROR error", ['Error', 'ERROR', 'error']),
+    (['MULTILINE'], r'^\w+', "one\ntwo\n", ['one', 'two']),
+    (['DOTALL'], r'a.b', "a\nb", ['a\nb']),
+    (['VERBOSE'], r'\d+  # digits', "a12b3", ['12', '3']),
+])
+def test_flags_change_what_matches(names, pattern, text, expected):
+    assert regex.compile_pattern(pattern).findall(text) != expected
+    compiled = regex.compile_pattern(pattern, regex.pattern_flags(names))
+    assert regex.regex_replace_and_store(text, compiled, 'match')[1] == expected
+
+
+@pytest.mark.parametrize('options', [
+    {'use_mmap': True},
+    {'use_mmap': False},
+    {'use_mmap': False, 'stream_threshold': 1},
+])
+def test_flags_reach_every_file_search_path(tmp_path, options):
+    path = tmp_path / 'log.txt'
+    path.write_text("Error one\nERROR two\nok\n", encoding='utf-8')
+    result = regex.process_file(str(path), r'error \w+', 'match', None, flags=re.IGNORECASE, **options)
+    assert result['matches'] == ['Error one', 'ERROR two']
+    assert not regex.process_file(str(path), r'error \w+', 'match', None, **options)['matches']
+
+
+def test_compile_pattern_reuses_compilations():
+    regex.compile_pattern.cache_clear()
+    first = regex.compile_pattern(r'cache-me \d+')
+    assert regex.compile_pattern(r'cache-me \d+') is first
+    info = regex.compile_pattern.cache_info()
+    assert (info.hits, info.misses) == (1, 1)
+    assert info.maxsize == regex.PATTERN_CACHE_SIZE
+
+    # Flags are part of the key
+    folded = regex.compile_pattern(r'cache-me \d+', re.IGNORECASE)
+    assert folded is not first
+    assert folded.flags & re.IGNORECASE
+    assert regex.compile_pattern(r'cache-me \d+', re.IGNORECASE) is folded
+
+
+def test_compile_pattern_cache_is_bounded():
+    regex.compile_pattern.cache_clear()
+    regex.compile_pattern(r'evict-me')
+    for number in range(regex.PATTERN_CACHE_SIZE):
+        regex.compile_pattern(f'filler {number}')
+    assert regex.compile_pattern.cache_info().currsize == regex.PATTERN_CACHE_SIZE
+    regex.compile_pattern(r'evict-me')
+    # The oldest entry was dropped and had to be compiled again
+    assert regex.compile_pattern.cache_info().misses == regex.PATTERN_CACHE_SIZE + 2
+
+
+def test_invalid_patterns_raise_re_error():
+    with pytest.raises(re.error):
+        regex.compile_pattern(r'(unclosed')
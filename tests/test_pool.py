@@ -0,0 +1,26 @@
+import threading
+import time
+
+import regex
+
+
+def test_cancel_reports_every_file_written(tmp_path):
+    paths = []
+    for index in range(40):
+        path = tmp_path / f"f{index}.txt"
+        path.write_text("foo bar\n" * 20000)
+        paths.append(str(path))
+
+    cancel_event = threading.Event()
+    reported = set()
+    for result in regex.iter_file_results(paths, 'foo', 'replace', 'baz', workers=2,
+                                          cancel_event=cancel_event):
+        reported.add(result['path'])
+        cancel_event.set()
+
+    time.sleep(1)  # let any worker left running finish its write
+    # Once the results run out, no worker may still be writing, and
+    # every file that was rewritten must have been reported
+    written = {path for path in paths if open(path).read().startswith('baz')}
+    assert written <= reported
+    assert len(reported) < len(paths)
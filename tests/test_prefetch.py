@@ -0,0 +1,46 @@
+import itertools
+import threading
+import time
+
+import pytest
+
+import regex
+
+
+def test_items_come_in_order():
+    assert list(regex.iter_prefetched(range(1000), maxsize=4)) == list(range(1000))
+
+
+def test_producer_errors_are_raised_in_the_consumer():
+    def walk():
+        yield 'a'
+        yield 'b'
+        raise OSError("walk failed")
+
+    consumed = []
+    with pytest.raises(OSError, match="walk failed"):
+        for item in regex.iter_prefetched(walk()):
+            consumed.append(item)
+    assert consumed == ['a', 'b']
+
+
+def test_closing_early_stops_the_producer():
+    produced = itertools.count()
+
+    def endless():
+        while True:
+            yield next(produced)
+
+    before = set(threading.enumerate())
+    items = regex.iter_prefetched(endless(), maxsize=8)
+    assert [next(items) for _ in range(3)] == [0, 1, 2]
+    producers = set(threading.enumerate()) - before
+    assert len(producers) == 1
+    items.close()
+
+    producer = producers.pop()
+    producer.join(5)
+    assert not producer.is_alive()
+    stopped_at = next(produced)
+    time.sleep(0.2)
+    assert next(produced) == stopped_at + 1
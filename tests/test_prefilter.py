@@ -0,0 +1,68 @@
+import codecs
+import re
+
+import pytest
+
+import regex
+
+
+def literal_sets(pattern, flags=0):
+    return regex.required_literal_sets(regex.sre_parse.parse(pattern, flags))
+
+
+@pytest.mark.parametrize('pattern, expected', [
+    (r'ERROR: \d+', [('ERROR: ',)]),
+    (r'ERROR|FATAL', [('ERROR', 'FATAL')]),
+    (r'(?:ERROR|FATAL) in module', [('ERROR', 'FATAL'), (' in module',)]),
+    (r'colou?r', [('colo',), ('r',)]),
+    (r'(?:prefix)?body', [('body',)]),
+    (r'(?:abc)*x', [('x',)]),
+    (r'(?:abc)+x', [('abc',), ('x',)]),
+    (r'ERROR|\d+', []),                    # a branch without a literal
+    (r'(?i:error) code', [(' code',)]),    # case-insensitive parts give nothing
+    (r'(?!skip)keep', [('keep',)]),
+    (r'(?=must)\w+', [('must',)]),
+])
+def test_required_literal_sets(pattern, expected):
+    assert literal_sets(pattern) == expected
+
+
+def test_ignorecase_patterns_are_not_prefiltered():
+    assert regex.extract_required_literals(r'ERROR', re.IGNORECASE) == []
+    assert regex.extract_required_literals(r'(?i)ERROR') == []
+
+
+ENCODINGS = [
+    ('utf-8', b''),
+    ('utf-8', codecs.BOM_UTF8),
+    ('utf-16-le', codecs.BOM_UTF16_LE),
+    ('utf-16-be', codecs.BOM_UTF16_BE),
+    ('utf-16-le', b''),
+    ('utf-16-be', b''),
+    ('cp1252', b''),
+    ('iso-8859-1', b''),
+]
+PATTERNS = [r'café au lait', r'naïve|Zürich', r'ERROR \d+', r'(?:crème )?brûlée', r'line\nnext', r'ERROR',
+            r'caf(?:e|é)']
+TEXTS = ["the café au lait is naïve\nERROR 42\r\nline\r\nnext crème brûlée\n", "nothing to see here\n"]
+
+
+@pytest.mark.parametrize('encoding, bom', ENCODINGS)
+def test_file_may_match_never_rejects_a_matching_file(tmp_path, encoding, bom):
+    path = tmp_path / 'text.txt'
+    for text in TEXTS:
+        path.write_bytes(bom + text.encode(encoding))
+        content, _ = regex.try_open_text_file(str(path))
+        for pattern in PATTERNS:
+            may_match, _ = regex.file_may_match(str(path), pattern)
+            if re.search(pattern, content):
+                assert may_match, (pattern, text)
+
+
+@pytest.mark.parametrize('encoding, bom', ENCODINGS)
+def test_file_may_match_rejects_files_without_the_literal(tmp_path, encoding, bom):
+    path = tmp_path / 'text.txt'
+    path.write_bytes(bom + "nothing to see here, not even a café\n".encode(encoding))
+    assert regex.file_may_match(str(path), r'ERROR \d+')[0] is False
+    assert regex.file_may_match(str(path), r'naïve|Zürich')[0] is False
+    assert regex.file_may_match(str(path), r'café')[0] is True
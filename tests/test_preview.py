@@ -0,0 +1,8 @@
+import regex
+
+
+def test_runaway_patterns_are_not_previewed_without_a_timeout():
+    assert regex.preview_may_hang(r'(a+)+$', 0, 're')
+    assert regex.preview_may_hang(r'(\w*\s?)*x', 0, 're', match_timeout=5)
+    assert not regex.preview_may_hang(r'(a+)+$', 0, 'regex', match_timeout=5)
+    assert not regex.preview_may_hang(r'a+b*', 0, 're')
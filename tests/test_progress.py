@@ -0,0 +1,23 @@
+import os
+
+import regex
+
+
+def test_walk_sizes_are_used_without_another_stat(tmp_path, monkeypatch):
+    (tmp_path / 'sub').mkdir()
+    (tmp_path / 'a.txt').write_bytes(b'x' * 10)
+    (tmp_path / 'sub' / 'b.txt').write_bytes(b'x' * 32)
+
+    def no_stat(*args, **kwargs):
+        raise AssertionError("track_paths stat'ed a path the walk had a size for")
+
+    progress = regex.RunProgress()
+    sizes = {}
+    paths = progress.track_paths(regex.iter_file_paths(str(tmp_path), sizes=sizes), sizes)
+    monkeypatch.setattr(os, 'stat', no_stat)
+    found = list(paths)
+    monkeypatch.undo()
+
+    assert len(found) == 2
+    assert not sizes
+    assert progress.snapshot()['bytes_found'] == 42
@@ -0,0 +1,111 @@
+import regex
+
+
+def fill(store, files=3, per_file=5):
+    """Log `files` cut-short match lists of `per_file` matches each, plus a plain line."""
+    store.insert('end', "Searching...\n")
+    for number in range(files):
+        matches = [(f"m{number}-{index}", str(index)) for index in range(per_file)]
+        regex.log_matches(store, f"f{number}.txt: ", matches, max_shown=2)
+    return store
+
+
+def test_plain_text_is_split_into_rows():
+    store = regex.ResultStore()
+    store.insert('end', "one\ntw")
+    store.insert('end', "o\nthree\n")
+    assert [text for text, _ in store.rows] == ['one', 'two', 'three']
+    assert not store.is_foldable(0)
+
+
+def test_small_output_stays_in_memory():
+    store = fill(regex.ResultStore())
+    assert store.spill is None
+    assert len(store.entries) == 3
+
+
+def test_entries_spill_past_the_threshold_and_read_back():
+    store = fill(regex.ResultStore(spill_bytes=50), files=4)
+    try:
+        assert store.spill is not None
+        assert store.entries == {}
+        for key in range(4):
+            prefix, matches = store.get_entry(key)
+            assert prefix == f"f{key}.txt: "
+            assert matches == [(f"m{key}-{index}", str(index)) for index in range(5)]
+    finally:
+        store.close()
+
+
+def test_toggle_unfolds_and_folds_a_spilled_entry():
+    store = fill(regex.ResultStore(spill_bytes=0), files=2)
+    try:
+        folded = [text for text, _ in store.rows]
+        assert folded[1].endswith("(+3 more)")
+        assert store.is_foldable(1)
+
+        assert store.toggle(1)
+        assert len(store) == len(folded) + 5
+        assert [text for text, _ in store.rows[2:7]] == [
+            f"    {('m0-' + str(index), str(index))}" for index in range(5)]
+        # An unfolded match row cannot be toggled itself
+        assert not store.toggle(2)
+
+        assert store.toggle(1)
+        assert [text for text, _ in store.rows] == folded
+        assert not store.toggle(0)
+    finally:
+        store.close()
+
+
+def test_export_writes_every_match(tmp_path):
+    store = fill(regex.ResultStore(spill_bytes=50), files=3)
+    try:
+        store.toggle(2)
+        store.insert('end', "Done\n")
+        path = tmp_path / 'out.txt'
+        store.export(str(path))
+    finally:
+        store.close()
+
+    lines = path.read_text(encoding='utf-8').splitlines()
+    assert lines[0] == "Searching..."
+    for number in range(3):
+        matches = [(f"m{number}-{index}", str(index)) for index in range(5)]
+        assert lines[number + 1] == f"f{number}.txt: {matches}"
+    # The unfolded rows are not written again
+    assert lines[4:] == ["Done"]
+
+
+def test_export_lists_the_hidden_match_lines_in_full(tmp_path):
+    result = {
+        'matches': ['x'] * 4,
+        'spans': [(0, 1, line, 1) for line in (1, 2, 5, 9)],
+        'context': [([], f"x{line}", []) for line in (1, 2, 5, 9)],
+    }
+    store = regex.ResultStore(spill_bytes=0)
+    try:
+        regex.log_match_lines(store, "f.txt: ", result, max_shown=1)
+        assert store.rows[-1][0] == "    ... (+3 more matching lines)"
+        path = tmp_path / 'out.txt'
+        store.export(str(path))
+    finally:
+        store.close()
+
+    assert path.read_text(encoding='utf-8').splitlines() == [
+        "f.txt: 4 matches",
+        "    1:1: x1",
+        "    2:1: x2",
+        "    --",
+        "    5:1: x5",
+        "    --",
+        "    9:1: x9",
+    ]
+
+
+def test_clear_drops_the_spill():
+    store = fill(regex.ResultStore(spill_bytes=0))
+    store.clear()
+    assert len(store) == 0
+    assert store.spill is None and store.entries == {}
+    assert store.spill_bytes == 0
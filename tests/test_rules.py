@@ -0,0 +1,95 @@
+import difflib
+import json
+import re
+
+import pytest
+
+import regex
+
+RULES = [
+    (r'foo', 'FOO', 'replace'),
+    (r'(\w+)=(\d+)', r'\2=\1', 'replace'),
+    (r'\d+', None, 'match'),
+]
+
+
+class CountingPattern:
+    """Wraps a compiled pattern, counting the searches made with it."""
+    searches = 0
+
+    def __init__(self, compiled_pattern):
+        self.compiled_pattern = compiled_pattern
+
+    def __getattr__(self, name):
+        if name in ('finditer', 'findall', 'sub', 'subn'):
+            CountingPattern.searches += 1
+        return getattr(self.compiled_pattern, name)
+
+
+def test_dry_run_runs_each_rule_once(tmp_path, monkeypatch):
+    path = tmp_path / 'conf.txt'
+    text = "foo a=1\nkeep\nb=22 foo\n"
+    path.write_text(text, encoding='utf-8')
+    compile_pattern = regex.compile_pattern
+    monkeypatch.setattr(regex, 'compile_pattern',
+                        lambda *args, **kwargs: CountingPattern(compile_pattern(*args, **kwargs)))
+
+    result = regex.process_file(str(path), None, 'replace', None, rules=RULES, dry_run='diff')
+
+    assert CountingPattern.searches == len(RULES)
+    assert result['status'] == 'would-modify'
+    assert result['rule_hits'] == [2, 2, 2]
+    assert result['changes']['substitutions'] == 4
+    expected = "FOO 1=a\nkeep\n22=b FOO\n"
+    assert result['diff'] == list(difflib.unified_diff(
+        text.splitlines(True), expected.splitlines(True), str(path), str(path)))
+    assert path.read_text(encoding='utf-8') == text
+
+
+def write_rules(tmp_path, name, text):
+    path = tmp_path / name
+    path.write_text(text, encoding='utf-8')
+    return str(path)
+
+
+def test_json_and_tab_separated_rules_load_the_same(tmp_path):
+    json_path = write_rules(tmp_path, 'rules.json', json.dumps([
+        {'pattern': 'foo', 'replacement': 'FOO'},
+        {'pattern': r'^#.*\n', 'mode': 'invert', 'replacement': ''},
+        {'pattern': r'\d+', 'mode': 'match'},
+    ]))
+    tsv_path = write_rules(tmp_path, 'rules.tsv', "# comment\n\nreplace\tfoo\tFOO\ninvert\t^#.*\\n\t\nmatch\t\\d+\n")
+
+    expected = [('foo', 'FOO', 'replace'), (r'^#.*\n', '', 'invert'), (r'\d+', None, 'match')]
+    assert regex.load_rules(json_path) == expected
+    assert regex.load_rules(tsv_path) == expected
+
+
+@pytest.mark.parametrize('name, text, message', [
+    ('bad.tsv', "delete\tfoo\n", "unknown mode"),
+    ('bad.tsv', "replace\n", "expected mode<TAB>pattern"),
+    ('bad.tsv', "replace\tfoo(\tx\n", "invalid regex"),
+    ('bad.json', '[{"replacement": "x"}]', "expected an object"),
+    ('bad.json', '[{"pattern": "x", "mode": "swap"}]', "unknown mode"),
+])
+def test_malformed_rules_are_rejected(tmp_path, name, text, message):
+    with pytest.raises(ValueError, match=message):
+        regex.load_rules(write_rules(tmp_path, name, text))
+
+
+def test_rules_are_checked_with_the_run_flags_and_engine(tmp_path):
+    path = write_rules(tmp_path, 'rules.tsv', "replace\tfoo  # the ( is in a comment\tbar\n")
+    with pytest.raises(ValueError):
+        regex.load_rules(path)
+    assert regex.load_rules(path, re.VERBOSE) == [('foo  # the ( is in a comment', 'bar', 'replace')]
+    if regex.load_engine('regex') is None:
+        with pytest.raises(ValueError, match="not installed"):
+            regex.load_rules(write_rules(tmp_path, 'ok.tsv', "replace\tfoo\tbar\n"), engine='regex')
+
+
+def test_rule_hits_count_every_rule(tmp_path):
+    rules = [('a', 'b', 'replace'), ('b', None, 'match'), (r'b+', '-', 'invert'), ('zzz', 'y', 'replace')]
+    updated, rule_matches, rule_hits = regex.apply_rules("aab c ab", rules)
+    assert updated == "-bbb-bb-"
+    assert rule_matches == {1: ['b'] * 5}
+    assert rule_hits == [3, 5, 2, 0]
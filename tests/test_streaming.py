@@ -0,0 +1,66 @@
+import codecs
+import io
+import re
+import threading
+
+import regex
+
+# 64-character lines, so reads of 4096 characters end right after a newline
+TEXT = ''.join(f"line {index:06d} and ".ljust(60, 'w') + "end\n" for index in range(3000)) + "the end  \n"
+
+
+def stream(tmp_path, pattern, mode, replacement=None, boundary='lines'):
+    path = tmp_path / 'big.txt'
+    path.write_text(TEXT, encoding='utf-8')
+    temp_path, matches = regex.stream_regex_file(
+        str(path), re.compile(pattern), mode, replacement,
+        chunk_size=4096, max_match_length=256, boundary=boundary
+    )
+    if mode == 'match':
+        return matches
+    if temp_path is None:
+        return TEXT
+    with open(temp_path, encoding='utf-8', newline='') as f:
+        return f.read()
+
+
+def test_end_anchor_only_matches_at_end_of_file(tmp_path):
+    for boundary in ('lines', 'window'):
+        assert stream(tmp_path, r'$', 'match', boundary=boundary) == re.findall(r'$', TEXT)
+        assert stream(tmp_path, r'end\s*\Z', 'match', boundary=boundary) == ['end  \n']
+
+
+def test_end_anchored_replace_matches_full_read(tmp_path):
+    for boundary in ('lines', 'window'):
+        assert stream(tmp_path, r'end\s*\Z', 'replace', 'END', boundary) == re.sub(r'end\s*\Z', 'END', TEXT)
+        assert stream(tmp_path, r'\w+(?=\n\Z)', 'replace', 'X', boundary) == re.sub(r'\w+(?=\n\Z)', 'X', TEXT)
+
+
+def test_streamed_matches_equal_full_read(tmp_path):
+    assert stream(tmp_path, r'line \d+', 'match') == re.findall(r'line \d+', TEXT)
+    assert stream(tmp_path, r'and', 'replace', 'AND') == TEXT.replace('and', 'AND')
+
+
+def run_briefly(function, seconds=10):
+    """Return function() run on a thread, or fail if it is still running after `seconds`."""
+    results = []
+    thread = threading.Thread(target=lambda: results.append(function()), daemon=True)
+    thread.start()
+    thread.join(seconds)
+    assert results, "still running"
+    return results[0]
+
+
+def test_empty_stream_gives_one_empty_window():
+    windows = run_briefly(lambda: list(regex.iter_stream_windows(io.StringIO(''), re.compile(r'x'))))
+    assert [(window, start, end, matches) for window, start, end, matches in windows] == [('', 0, 0, [])]
+    matches = run_briefly(lambda: regex.match_windows(regex.iter_stream_windows(io.StringIO(''), re.compile(r'$'))))
+    assert matches == re.findall(r'$', '')
+
+
+def test_bom_only_file_above_stream_threshold(tmp_path):
+    path = tmp_path / 'bom.txt'
+    path.write_bytes(codecs.BOM_UTF8)
+    result = run_briefly(lambda: regex.process_file(str(path), 'x', 'match', None, stream_threshold=0,
+                                                    use_mmap=False, use_prefilter=False))
+    assert result['status'] == 'no-match'
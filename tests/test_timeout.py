@@ -0,0 +1,34 @@
+import regex
+
+CATASTROPHIC = r'(a+)+$'
+
+
+def test_runaway_search_times_out(tmp_path):
+    path = tmp_path / 'input.txt'
+    path.write_text('a' * 40 + '!\n', encoding='utf-8')
+
+    for use_mmap in (True, False):
+        result = regex.process_file(str(path), CATASTROPHIC, 'match', None, match_timeout=0.3,
+                                    use_mmap=use_mmap)
+        assert result['status'] == 'timeout'
+
+
+def test_writes_are_never_interrupted(tmp_path, monkeypatch):
+    fsync_directory = regex.fsync_directory
+
+    def slow_fsync_directory(path):
+        deadline = regex.time.monotonic() + 0.5
+        while regex.time.monotonic() < deadline:
+            pass
+        fsync_directory(path)
+
+    monkeypatch.setattr(regex, 'fsync_directory', slow_fsync_directory)
+    for stream_threshold in (regex.DEFAULT_STREAM_THRESHOLD, 0):
+        path = tmp_path / f'input{stream_threshold}.txt'
+        path.write_text("foo bar\n" * 100, encoding='utf-8')
+
+        result = regex.process_file(str(path), 'foo', 'replace', 'baz', match_timeout=0.2,
+                                    stream_threshold=stream_threshold)
+
+        assert result['status'] == 'modified'
+        assert path.read_text(encoding='utf-8') == "baz bar\n" * 100
@@ -0,0 +1,105 @@
+import codecs
+import os
+
+import pytest
+
+import regex
+
+
+def ignored(tmp_path, rules, path, is_dir=False):
+    (tmp_path / '.gitignore').write_text('\n'.join(rules) + '\n', encoding='utf-8')
+    rule_set = regex.load_ignore_rules(str(tmp_path), ['.gitignore'])
+    return regex.is_ignored(os.path.join(str(tmp_path), *path.split('/')), is_dir, [(str(tmp_path), rule_set)])
+
+
+@pytest.mark.parametrize('rule, path, is_dir, expected', [
+    # A name without a slash matches at any depth
+    ('*.log', 'a.log', False, True),
+    ('*.log', 'deep/down/a.log', False, True),
+    ('*.log', 'a.log.txt', False, False),
+    # A leading (or inner) slash anchors the rule to the ignore file's directory
+    ('/build', 'build', True, True),
+    ('/build', 'src/build', True, False),
+    ('doc/*.txt', 'doc/a.txt', False, True),
+    ('doc/*.txt', 'doc/sub/a.txt', False, False),
+    ('doc/*.txt', 'x/doc/a.txt', False, False),
+    # A trailing slash only matches directories
+    ('tmp/', 'tmp', True, True),
+    ('tmp/', 'tmp', False, False),
+    ('tmp/', 'a/tmp', True, True),
+    # '**' spans any number of directories, including none
+    ('**/cache', 'cache', True, True),
+    ('**/cache', 'a/b/cache', True, True),
+    ('docs/**/*.md', 'docs/a.md', False, True),
+    ('docs/**/*.md', 'docs/x/y/a.md', False, True),
+    ('docs/**/*.md', 'other/docs/a.md', False, False),
+    ('logs/**', 'logs/x/y.txt', False, True),
+    # '*' and '?' do not cross directories
+    ('a*z', 'abz', False, True),
+    ('a*z', 'a/z', False, False),
+    ('?.txt', 'a.txt', False, True),
+    ('?.txt', 'ab.txt', False, False),
+    # Character classes, negated with '!'
+    ('[ab].txt', 'b.txt', False, True),
+    ('[!a].txt', 'b.txt', False, True),
+    ('[!a].txt', 'a.txt', False, False),
+    # Escapes and comments
+    ('\\#notes', '#notes', False, True),
+    ('#notes', '#notes', False, False),
+])
+def test_ignore_rule(tmp_path, rule, path, is_dir, expected):
+    assert ignored(tmp_path, [rule], path, is_dir) is expected
+
+
+@pytest.mark.parametrize('rules, path, expected', [
+    (['*.log', '!keep.log'], 'keep.log', False),
+    (['*.log', '!keep.log'], 'drop.log', True),
+    (['!keep.log', '*.log'], 'keep.log', True),  # the last matching rule decides
+])
+def test_negation(tmp_path, rules, path, expected):
+    assert ignored(tmp_path, rules, path) is expected
+
+
+def make_tree(root, files):
+    for path, data in files.items():
+        full_path = root / path
+        full_path.parent.mkdir(parents=True, exist_ok=True)
+        full_path.write_bytes(data)
+
+
+def walk(root, **options):
+    return sorted(os.path.relpath(path, root).replace(os.sep, '/')
+                  for path in regex.iter_file_paths(str(root), **options))
+
+
+def test_nested_ignore_files_apply_below_their_directory(tmp_path):
+    make_tree(tmp_path, {
+        '.gitignore': b'*.log\nbuild/\n',
+        'a.log': b'x', 'a.txt': b'x', 'build/out.txt': b'x',
+        'sub/.gitignore': b'secret.txt\n!keep.log\n',
+        'sub/secret.txt': b'x', 'sub/keep.log': b'x', 'sub/b.log': b'x',
+        'other/secret.txt': b'x',
+    })
+    assert walk(tmp_path, ignore_files=['.gitignore']) == [
+        '.gitignore', 'a.txt', 'other/secret.txt', 'sub/.gitignore', 'sub/keep.log']
+
+
+def test_exclude_dirs_and_max_size(tmp_path):
+    make_tree(tmp_path, {
+        'small.txt': b'x' * 10, 'big.txt': b'x' * 1000,
+        'node_modules/m.txt': b'x', 'src/.git/config': b'x', 'src/vendor/v.txt': b'x', 'src/a.txt': b'x',
+    })
+    assert walk(tmp_path, exclude_dirs=['node_modules', '.git', 'src/vendor'], max_size=100) == [
+        'small.txt', 'src/a.txt']
+
+
+def test_binary_files_are_skipped_but_utf16_text_is_not(tmp_path):
+    make_tree(tmp_path, {
+        'text.txt': b'plain text\n',
+        'utf16.txt': codecs.BOM_UTF16_LE + "text with NULs\n".encode('utf-16-le'),
+        'utf16-nobom.txt': "text with NULs\n".encode('utf-16-le'),
+        'image.bin': b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x01\x00' * 20,
+    })
+    assert walk(tmp_path, skip_binary=True) == ['text.txt', 'utf16-nobom.txt', 'utf16.txt']
+    assert regex.is_binary_file(str(tmp_path / 'image.bin'))
+    assert not regex.is_binary_file(str(tmp_path / 'utf16.txt'))
@@ -0,0 +1,33 @@
+import regex
+
+
+def watch(path, pattern):
+    watcher = regex.FileWatcher([str(path)], pattern, use_inotify=False)
+    watcher.add_result(regex.process_file(str(path), pattern, 'match', None, with_spans=True))
+    watcher.start()
+    return watcher
+
+
+def test_line_unfinished_during_initial_run_is_searched(tmp_path):
+    path = tmp_path / 'app.log'
+    path.write_bytes(b"ERROR 1\nERR")
+    watcher = watch(path, r'ERROR \d')
+
+    with open(path, 'ab') as f:
+        f.write(b"OR 2\nERROR 3\n")
+    results = watcher.poll()
+
+    assert [match for result in results for match in result['matches']] == ['ERROR 2', 'ERROR 3']
+    assert [span[2] for span in results[0]['spans']] == [2, 3]
+
+
+def test_matches_reported_by_initial_run_are_not_repeated(tmp_path):
+    path = tmp_path / 'app.log'
+    path.write_bytes(b"ERROR 1\nERROR 2 and")
+    watcher = watch(path, r'ERROR \d')
+
+    with open(path, 'ab') as f:
+        f.write(b" ERROR 4\n")
+    results = watcher.poll()
+
+    assert [match for result in results for match in result['matches']] == ['ERROR 4']
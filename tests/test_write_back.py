@@ -0,0 +1,74 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import regex
+
+
+@pytest.mark.parametrize('stream_threshold', [regex.DEFAULT_STREAM_THRESHOLD, 1])
+def test_replace_through_symlink_keeps_the_link(tmp_path, stream_threshold):
+    (tmp_path / 'real').mkdir()
+    (tmp_path / 'tree').mkdir()
+    target = tmp_path / 'real' / 'target.txt'
+    target.write_text("foo bar\n", encoding='utf-8')
+    link = tmp_path / 'tree' / 'link.txt'
+    link.symlink_to(target)
+
+    result = regex.process_file(str(link), 'foo', 'replace', 'baz',
+                                stream_threshold=stream_threshold)
+
+    assert result['status'] == 'modified'
+    assert link.is_symlink()
+    assert target.read_text(encoding='utf-8') == "baz bar\n"
+    assert not [name for name in os.listdir(tmp_path / 'tree') if name.endswith('.tmp')]
+
+
+def test_replace_keeps_hard_links_and_undo_restores_them(tmp_path):
+    original = tmp_path / 'a.txt'
+    original.write_text("foo bar\n", encoding='utf-8')
+    other = tmp_path / 'b.txt'
+    os.link(original, other)
+    journal_dir = tmp_path / 'journal'
+    journal_dir.mkdir()
+
+    result = regex.process_file(str(original), 'foo', 'replace', 'baz',
+                                journal_dir=str(journal_dir))
+
+    assert result['status'] == 'modified'
+    assert os.path.samefile(original, other)
+    assert other.read_text(encoding='utf-8') == "baz bar\n"
+
+    regex.undo_journal(str(journal_dir))
+    assert os.path.samefile(original, other)
+    assert original.read_text(encoding='utf-8') == "foo bar\n"
+    assert other.read_text(encoding='utf-8') == "foo bar\n"
+
+
+def test_old_journals_are_pruned(tmp_path):
+    old = regex.create_journal(str(tmp_path))
+    week_ago = regex.time.time() - 7 * 24 * 3600
+    os.utime(old, (week_ago, week_ago))
+    older = regex.create_journal(str(tmp_path))
+    month_ago = regex.time.time() - 30 * 24 * 3600
+    os.utime(older, (month_ago, month_ago))
+
+    new = regex.create_journal(str(tmp_path))
+
+    assert sorted(os.listdir(tmp_path)) == sorted([os.path.basename(old), os.path.basename(new)])
+
+
+def test_command_line_undo_removes_the_journal(tmp_path):
+    path = tmp_path / 'a.txt'
+    path.write_text("foo bar\n", encoding='utf-8')
+    journal_dir = tmp_path / 'journal'
+    journal_dir.mkdir()
+    regex.process_file(str(path), 'foo', 'replace', 'baz', journal_dir=str(journal_dir))
+
+    completed = subprocess.run([sys.executable, regex.__file__, '--undo', str(journal_dir)],
+                               stdout=subprocess.PIPE, check=False)
+
+    assert completed.returncode == 0
+    assert path.read_text(encoding='utf-8') == "foo bar\n"
+    assert not journal_dir.exists()